@@ -8,28 +8,167 @@ Serves the web app and handles API calls
 
 VERSION = "0.27"
 
+import base64
+import bisect
+import gzip
 import json
-import urllib.request
+import hashlib
+import http.client
+import io
+import itertools
+import mimetypes
+import multiprocessing
+import urllib.error
+import urllib.parse
 import os
+import queue
+import random
 import re
+import sqlite3
+import sys
 import time
-from flask import Flask, request, jsonify, send_from_directory
+import threading
+import uuid
+import zipfile
+import xml.etree.ElementTree as ET
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait as wait_futures
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, Response, g, request, jsonify
+from pypdf import PdfReader
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-app = Flask(__name__, static_folder=BASE_DIR, static_url_path='')
+# Static files are served by static_files() through the asset pipeline
+app = Flask(__name__, static_folder=None)
 
 # Get HF token from environment
 HF_TOKEN = os.environ.get('HF_TOKEN', '')
 
+# Concurrency limits for LLM calls
+LLM_MAX_INFLIGHT = int(os.environ.get('LLM_MAX_INFLIGHT', '8'))          # per process
+EXTRACT_MAX_PARALLEL = int(os.environ.get('EXTRACT_MAX_PARALLEL', '4'))  # per request
+
+# Token budgets for splitting documents into prompt-sized chunks
+CHUNK_TOKENS = int(os.environ.get('CHUNK_TOKENS', '6000'))                 # /api/extract, /api/extract-hf
+STAGE1_CHUNK_TOKENS = int(os.environ.get('STAGE1_CHUNK_TOKENS', '1000'))   # two-stage stage 1
+STAGE2_BATCH_QUOTES = int(os.environ.get('STAGE2_BATCH_QUOTES', '25'))     # two-stage stage 2 quotes per call
+STAGE2_PARALLEL = int(os.environ.get('STAGE2_PARALLEL', '8'))              # stage 2 batches at once, within LLM slots
+STAGE2_LOCAL_CLASSIFIER = os.environ.get('STAGE2_LOCAL_CLASSIFIER', '1') == '1'  # decide obvious quotes lexically
+STAGE2_LABEL_LOG = os.environ.get('STAGE2_LABEL_LOG', '')                   # JSONL of LLM labels, for benchmarks
+CLASSIFIER_MIN_SCORE = float(os.environ.get('CLASSIFIER_MIN_SCORE', '3'))   # lexicon weight needed to decide locally
+CLASSIFIER_MARGIN = float(os.environ.get('CLASSIFIER_MARGIN', '2'))         # best criterion vs runner-up score ratio
+CHUNK_OVERLAP_TOKENS = int(os.environ.get('CHUNK_OVERLAP_TOKENS', '150'))
+PACK_TOKENS = int(os.environ.get('PACK_TOKENS', '3000'))                   # small documents share one call up to this
+FUNCTIONAL_MAP_REDUCE = os.environ.get('FUNCTIONAL_MAP_REDUCE', '1') == '1'  # per-document calls plus a merge call
+FUNCTIONAL_MAP_PARALLEL = int(os.environ.get('FUNCTIONAL_MAP_PARALLEL', '8'))  # all documents at once, within LLM slots
+PRESCAN_DOC_TOKENS = int(os.environ.get('PRESCAN_DOC_TOKENS', '1000'))
+
+# Report prompt planning: documents fill what the template and max_tokens leave of the context
+REPORT_CONTEXT_TOKENS = int(os.environ.get('REPORT_CONTEXT_TOKENS', '0'))  # prompt + completion; 0 = the backend's window
+REPORT_DOC_TOKENS = int(os.environ.get('REPORT_DOC_TOKENS', '0'))          # optional cap on document excerpts per report
+REPORT_OUTPUT_RATIO = float(os.environ.get('REPORT_OUTPUT_RATIO', '2'))     # filled text vs template length
+REPORT_SECTION_TOKENS = int(os.environ.get('REPORT_SECTION_TOKENS', '120'))   # completion allowance per template section
+REPORT_MAX_TOKENS = int(os.environ.get('REPORT_MAX_TOKENS', '8000'))
+REPORT_PASSAGE_TOKENS = int(os.environ.get('REPORT_PASSAGE_TOKENS', '200'))   # excerpt granularity
+# Report types generated section by section in parallel, each section with its own excerpts
+REPORT_SECTIONAL_TYPES = set(filter(None, os.environ.get('REPORT_SECTIONAL_TYPES', 'ndis,caregiver')
+                                    .replace(' ', '').split(',')))
+REPORT_SECTION_PARALLEL = int(os.environ.get('REPORT_SECTION_PARALLEL', '6'))       # sections in flight per report
+REPORT_SECTION_DOC_TOKENS = int(os.environ.get('REPORT_SECTION_DOC_TOKENS', '0'))  # optional cap per section
+_llm_slots = threading.BoundedSemaphore(LLM_MAX_INFLIGHT)
+
+# LLM provider endpoint, model and keep-alive connection pool settings
+HF_API_URL = os.environ.get('HF_API_URL', 'https://router.huggingface.co/novita/v3/openai/chat/completions')
+HF_MODEL = os.environ.get('HF_MODEL', 'meta-llama/llama-3.3-70b-instruct')
+HF_CONTEXT_TOKENS = int(os.environ.get('HF_CONTEXT_TOKENS', '131072'))  # HF_MODEL's context window
+OLLAMA_URL = os.environ.get('OLLAMA_URL', 'http://localhost:11434')
+OLLAMA_MODEL = os.environ.get('OLLAMA_MODEL', 'llama3.3:70b')
+OLLAMA_PIN_MODEL = os.environ.get('OLLAMA_PIN_MODEL', '1') == '1'   # ignore per-request models, so nothing reloads
+OLLAMA_KEEP_ALIVE = os.environ.get('OLLAMA_KEEP_ALIVE', '30m')      # how long Ollama keeps the model loaded
+OLLAMA_NUM_CTX = int(os.environ.get('OLLAMA_NUM_CTX', '16384'))      # Ollama's 2048 default silently truncates prompts
+
+# LLM backends: 'hf' (OpenAI-compatible HF router), 'ollama' or 'fake' (offline, deterministic).
+# LLM_ENDPOINT_BACKENDS overrides per endpoint, e.g. "prescan=ollama,report=hf"; requests
+# can pick one with a 'backend' field or 'useCloud'
+LLM_BACKEND = os.environ.get('LLM_BACKEND', 'hf')
+LLM_ENDPOINT_BACKENDS = dict(item.split('=', 1) for item in
+                             os.environ.get('LLM_ENDPOINT_BACKENDS', '').replace(' ', '').split(',') if '=' in item)
+FAKE_LATENCY = float(os.environ.get('FAKE_LATENCY', '0.2'))              # seconds before the first token
+FAKE_TOKENS_PER_SEC = float(os.environ.get('FAKE_TOKENS_PER_SEC', '200'))  # 0 = instant
+FAKE_ERROR_RATE = float(os.environ.get('FAKE_ERROR_RATE', '0'))           # fraction of calls failing with 503
+
+# LLM call resilience: retries for 429/5xx, hedging slow calls, circuit breaker
+LLM_RETRIES = int(os.environ.get('LLM_RETRIES', '2'))                    # extra attempts after a transient error
+LLM_RETRY_BASE = float(os.environ.get('LLM_RETRY_BASE', '1'))            # backoff seconds, doubled per attempt, jittered
+LLM_RETRY_CAP = float(os.environ.get('LLM_RETRY_CAP', '20'))
+LLM_HEDGE = os.environ.get('LLM_HEDGE', '1') == '1'
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get('LLM_HEDGE_MIN_SAMPLES', '20'))  # latencies needed before hedging
+LLM_HEDGE_MIN_DELAY = float(os.environ.get('LLM_HEDGE_MIN_DELAY', '2'))     # never hedge sooner than this
+LLM_HEDGE_MAX_RATIO = float(os.environ.get('LLM_HEDGE_MAX_RATIO', '0.1'))   # hedges per call, at most
+LLM_LATENCY_WINDOW = int(os.environ.get('LLM_LATENCY_WINDOW', '200'))
+LLM_BREAKER_FAILURES = int(os.environ.get('LLM_BREAKER_FAILURES', '5'))  # consecutive failures that open it
+LLM_BREAKER_COOLDOWN = float(os.environ.get('LLM_BREAKER_COOLDOWN', '30'))
+POOL_MAX_PER_HOST = int(os.environ.get('POOL_MAX_PER_HOST', '8'))
+POOL_IDLE_TIMEOUT = float(os.environ.get('POOL_IDLE_TIMEOUT', '60'))
+
+# Caches, case documents, jobs and metrics hold patient data, so they live
+# outside BASE_DIR, which is the web root
+DATA_DIR = os.environ.get('DATA_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'aurum-asd'))
+
+# LLM response cache (memory LRU in front of a SQLite file shared by all workers)
+LLM_CACHE_PATH = os.environ.get('LLM_CACHE_PATH', os.path.join(DATA_DIR, 'llm_cache.sqlite3'))
+LLM_CACHE_TTL = float(os.environ.get('LLM_CACHE_TTL', str(7 * 24 * 3600)))
+LLM_CACHE_MEMORY_MB = float(os.environ.get('LLM_CACHE_MEMORY_MB', '32'))
+LLM_CACHE_DISK_MB = float(os.environ.get('LLM_CACHE_DISK_MB', '256'))
+# Reports are left out: the UI regenerates a report by sending the same request again
+LLM_CACHE_ENDPOINTS = set(filter(None, os.environ.get(
+    'LLM_CACHE_ENDPOINTS', 'prescan,extract,twostage,functional').split(',')))
+
+# Background jobs for long-running pipeline endpoints
+JOB_DB_PATH = os.environ.get('JOB_DB_PATH', os.path.join(DATA_DIR, 'jobs.sqlite3'))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '4'))             # per process
+JOB_MAX_PENDING = int(os.environ.get('JOB_MAX_PENDING', '16'))    # queued + running, per process
+JOB_TIMEOUT = float(os.environ.get('JOB_TIMEOUT', '900'))         # jobs not finished by then expire
+JOB_RESULT_TTL = float(os.environ.get('JOB_RESULT_TTL', '3600'))  # how long finished results are kept
+JOB_MAX_WAIT = float(os.environ.get('JOB_MAX_WAIT', '25'))        # long-poll cap
+
+# Case documents are uploaded once and stored content-addressed, shared by all workers
+CASE_DB_PATH = os.environ.get('CASE_DB_PATH', os.path.join(DATA_DIR, 'cases.sqlite3'))
+CASE_TTL = float(os.environ.get('CASE_TTL', str(24 * 3600)))                 # since last use
+CASE_MAX_DOCS = int(os.environ.get('CASE_MAX_DOCS', '200'))                   # per case
+CASE_MAX_DOC_MB = float(os.environ.get('CASE_MAX_DOC_MB', '20'))              # per document
+CASE_MAX_MB = float(os.environ.get('CASE_MAX_MB', '100'))                     # per case
+CASE_STORE_MAX_MB = float(os.environ.get('CASE_STORE_MAX_MB', '1024'))        # whole store, LRU cases evicted
+CASE_MEMORY_MB = float(os.environ.get('CASE_MEMORY_MB', '64'))                # per-process hot document cache
+
+# Metrics: each worker snapshots its values here; /metrics merges all live workers
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(DATA_DIR, 'metrics'))
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+LOG_JSON = os.environ.get('LOG_JSON', '1') == '1'   # one JSON line per request, stage and LLM call
+
+# Upload text extraction runs in a process pool so parsing never blocks request threads
+EXTRACT_PROCESSES = int(os.environ.get('EXTRACT_PROCESSES', '2'))                       # per gunicorn worker
+EXTRACT_MAX_BYTES = int(os.environ.get('EXTRACT_MAX_BYTES', str(25 * 1024 * 1024)))      # per uploaded file
+EXTRACT_MAX_XML_BYTES = int(os.environ.get('EXTRACT_MAX_XML_BYTES', str(200 * 1024 * 1024)))  # unzipped document.xml
+EXTRACT_TIMEOUT = float(os.environ.get('EXTRACT_TIMEOUT', '120'))                        # per request
+
+# Static assets: inline images are extracted and every asset is precompressed at startup
+ASSET_DIR = os.environ.get('ASSET_DIR', os.path.join(DATA_DIR, 'assets'))
+ASSET_EXTENSIONS = ('.html', '.css', '.js', '.json', '.svg', '.ico', '.png', '.jpg', '.jpeg', '.webp', '.gif')
+ASSET_MAX_AGE = 365 * 24 * 3600  # fingerprinted assets never change
+
 # ============== Static File Serving ==============
 
 @app.route('/')
 def index():
-    return send_from_directory(BASE_DIR, 'asd_workflow_aurum.html')
+    return static_assets.response('asd_workflow_aurum.html')
 
 @app.route('/<path:path>')
 def static_files(path):
-    return send_from_directory(BASE_DIR, path)
+    # Only registered assets are served; nothing else under BASE_DIR is reachable
+    if static_assets.has(path):
+        return static_assets.response(path)
+    return 'Not found', 404
 
 # ============== API Endpoints ==============
 
@@ -37,20 +176,26 @@ def static_files(path):
 def handle_status():
     """Check if Ollama is running and which models are available"""
     try:
-        req = urllib.request.Request('http://localhost:11434/api/tags')
-        with urllib.request.urlopen(req, timeout=5) as resp:
-            data = json.loads(resp.read())
-            models = [m['name'] for m in data.get('models', [])]
-            return jsonify({'status': 'ok', 'models': models})
+        body = http_pool.request('GET', f'{OLLAMA_URL}/api/tags', timeout=5)
+        data = json.loads(body)
+        models = [m['name'] for m in data.get('models', [])]
+        return jsonify({'status': 'ok', 'models': models, 'backends': backend_config(),
+                        'pool': http_pool.stats(), 'cache': llm_cache.stats(), 'resilience': guard_stats()})
     except Exception as e:
-        return jsonify({'status': 'error', 'error': str(e)})
+        return jsonify({'status': 'error', 'error': str(e), 'backends': backend_config(),
+                        'pool': http_pool.stats(), 'cache': llm_cache.stats(), 'resilience': guard_stats()})
+
+@app.route('/metrics', methods=['GET'])
+def handle_metrics():
+    """Prometheus text exposition, merged across gunicorn workers"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 @app.route('/api/prescan-batch', methods=['POST'])
 def handle_prescan_batch():
     """Hybrid prescan: filename matching first, then AI for unresolved items"""
     try:
         data = request.get_json()
-        documents = data.get('documents', {})
+        documents = request_documents(data)
         use_cloud = data.get("useCloud", False)
 
         print(f"\n[PreScan] {len(documents)} documents")
@@ -68,39 +213,41 @@ def handle_prescan_batch():
 
         # PASS 1: Filename + content keyword matching (instant)
         print("[PreScan] Pass 1: Filename matching...")
+        pass1_start = time.time()
 
         for filename, text in documents.items():
-            lower_name = filename.lower()
-            lower_text = text.lower()
+            # One pass over each name and text finds every keyword group
+            name_hits = PRESCAN_NAME_MATCHER.scan(filename.lower())
+            text_hits = PRESCAN_TEXT_MATCHER.scan(text.lower())
 
             # GP Referral
-            if any(kw in lower_name for kw in ['gp', 'referral', 'paed']):
+            if 'gp_referral' in name_hits:
                 metadata['gp_referral'] = {'status': 'present', 'source': filename}
 
                 # Check for hearing test in GP referral content
-                if any(kw in lower_text for kw in ['bera', 'abr', 'audiometry', 'audiolog', 'hearing screen', 'peripheral hearing', 'hearing test', 'brainstem auditory']):
-                    if any(kw in lower_text for kw in ['normal', 'passed', 'within normal', 'no concerns']):
+                if 'hearing_test' in text_hits:
+                    if 'hearing_normal' in text_hits:
                         metadata['hearing_test'] = {'status': 'normal', 'source': filename}
                     else:
                         metadata['hearing_test'] = {'status': 'concerns', 'source': filename}
 
                 # Check for developmental history
-                if any(kw in lower_text for kw in ['milestone', 'developmental history', 'birth history', 'pregnancy', 'early development', 'developmental concerns']):
+                if 'gp_dev_history' in text_hits:
                     if metadata['dev_history']['status'] == 'missing':
                         metadata['dev_history'] = {'status': 'present', 'source': filename}
 
             # Teacher/School input
-            if any(kw in lower_name for kw in ['teacher', 'school', 'educator', 'kindergarten']):
+            if 'teacher_input' in name_hits:
                 metadata['teacher_input'] = {'status': 'present', 'source': filename}
 
             # Other reports with developmental history
-            if any(kw in lower_name for kw in ['speech', 'psych', 'social', 'worker', 'ot', 'occupational']):
-                if any(kw in lower_text for kw in ['developmental history', 'milestone', 'birth', 'early development', 'background information']):
+            if 'allied_report' in name_hits:
+                if 'report_dev_history' in text_hits:
                     if metadata['dev_history']['status'] == 'missing':
                         metadata['dev_history'] = {'status': 'present', 'source': filename}
 
             # Previous ASD assessment mentioned
-            if any(kw in lower_text for kw in ['previous autism', 'prior asd', 'previously assessed for autism', 'earlier autism assessment']):
+            if 'previous_asd' in text_hits:
                 if metadata['previous_asd']['status'] == 'none':
                     metadata['previous_asd'] = {'status': 'missing', 'source': None}
 
@@ -115,6 +262,7 @@ def handle_prescan_batch():
         if metadata['teacher_input']['status'] == 'missing':
             missing_items.append('teacher_input')
 
+        record_stage('prescan_pass1', time.time() - pass1_start, documents=len(documents))
         print(f"[PreScan] Pass 1 results: {len(missing_items)} items unresolved: {missing_items}")
 
         # PASS 2: AI analysis only if critical items still missing
@@ -124,8 +272,9 @@ def handle_prescan_batch():
             # Build combined text
             combined = ""
             filenames_list = list(documents.keys())
+            budgets = allocate_token_budgets(documents, PRESCAN_DOC_TOKENS * len(documents))
             for filename, text in documents.items():
-                combined += f"\n\n=== {filename} ===\n{text[:4000]}\n"
+                combined += f"\n\n=== {filename} ===\n{truncate_to_tokens(text, budgets[filename])}\n"
 
             prompt = f"""<start_of_turn>user
 I have these clinical documents for an autism assessment:
@@ -153,8 +302,9 @@ Status options: "present", "missing", "normal" (for hearing), "not_done" (for he
             try:
                 start = time.time()
                 print("[PreScan] Using Llama 3.3 70B...")
-                response = call_huggingface(prompt, timeout=120)
+                response = call_llm(prompt, timeout=120, cache=llm_cache_mode('prescan'), backend=llm_backend('prescan'))
                 elapsed = time.time() - start
+                record_stage('prescan_pass2', elapsed, unresolved=len(missing_items))
                 print(f"[PreScan] AI response in {elapsed:.1f}s")
 
                 # Parse AI response
@@ -194,6 +344,8 @@ Status options: "present", "missing", "normal" (for hearing), "not_done" (for he
 
         return jsonify({'success': True, 'metadata': metadata, 'time': 0})
 
+    except CaseNotFound as e:
+        return case_not_found(e)
     except Exception as e:
         print(f"[PreScan Error] {e}")
         import traceback
@@ -206,68 +358,85 @@ def handle_extract():
     try:
         data = request.get_json()
         model = data.get('model', 'llama-3.3-70b')
-        text = data.get('text', '')
+        text = request_text(data)
 
         print(f"\n[Extract] Model: {model}, Text length: {len(text)}")
 
         # Split into individual documents
-        docs = []
-        current_doc = ""
-        current_name = ""
-        for line in text.split('\n'):
-            if line.startswith('--- ') and line.endswith(' ---'):
-                if current_doc.strip():
-                    docs.append((current_name, current_doc.strip()))
-                current_name = line[4:-4]
-                current_doc = ""
-            else:
-                current_doc += line + "\n"
-        if current_doc.strip():
-            docs.append((current_name, current_doc.strip()))
+        docs = split_documents(text)
 
         print(f"[Extract] Split into {len(docs)} documents")
 
         # Process each document separately
         merged = {"A1":[],"A2":[],"A3":[],"B1":[],"B2":[],"B3":[],"B4":[],"C":[],"D":[],"E":[]}
+        doc_status = []
+        quote_index = QuoteIndex()
+        cache = llm_cache_mode('extract')
+        backend = llm_backend('extract')
+
+        # Send every document concurrently, then merge in document order
+        # Long documents are split into overlapping chunks on sentence boundaries,
+        # short ones share a call
+        calls = pack_chunks(chunk_documents(docs, CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS), PACK_TOKENS)
+        print(f"[Extract] {len(calls)} calls")
+        workers = parallel_workers(data.get('maxParallel'))
+        results = run_parallel(
+            lambda call: timed('extract_call', call_llm,
+                               build_extraction_prompt(call['text'], packed=len(call['members']) > 1),
+                               timeout=120, cache=cache, backend=backend),
+            calls, max_workers=workers, timeout=fanout_timeout(len(calls), workers, 120))
+
+        for call, (result, error) in zip(calls, results):
+            members = call['members']
+            print(f"[Extract] Processing: {', '.join(m['source'] + ' chunk ' + m['part'] for m in members)} ({len(call['text'])} chars)")
+
+            statuses = [{'source': m['source'], 'part': m['part'], 'status': 'ok'} for m in members]
+            doc_status.extend(statuses)
+            if error:
+                print(f"[Extract]   Failed: {error}")
+                for status in statuses:
+                    status.update(status='error', error=str(error) or type(error).__name__)
+                continue
 
-        for doc_name, doc_text in docs:
-            print(f"[Extract] Processing: {doc_name} ({len(doc_text)} chars)")
-
-            prompt = build_extraction_prompt(doc_text)
-            result = call_huggingface(prompt, timeout=120)
-
-            # Clean markdown
-            clean = result.replace('```json', '').replace('```', '').strip()
-
-            start_idx = clean.find('{')
-            end_idx = clean.rfind('}') + 1
-
-            if start_idx >= 0 and end_idx > start_idx:
-                json_str = clean[start_idx:end_idx]
-
-                # Fix inconsistent quoting from model
-                json_str = fix_json_quotes(json_str)
+            try:
+                # Tolerant parse fixes inconsistent quoting from the model
+                doc_evidence = parse_llm_object(result, parse_llm_json)
+            except json.JSONDecodeError as e:
+                print(f"[Extract]   JSON error: {e}")
+                print(f"[Extract]   Raw response (first 500 chars): {result[:500]}")
+                for status in statuses:
+                    status.update(status='error', error=f"invalid JSON in response: {e}")
+                continue
 
-                try:
-                    doc_evidence = json.loads(json_str)
-                    for key in merged:
-                        if key in doc_evidence and isinstance(doc_evidence[key], list):
-                            for quote in doc_evidence[key]:
-                                q = quote.strip().strip('"')
-                                if q and len(q) > 25 and not is_prompt_echo(q) and not any(existing["text"] == q for existing in merged[key]):
-                                    merged[key].append({"text": q, "source": doc_name})
-                    print(f"[Extract]   Got {sum(len(doc_evidence.get(k,[])) for k in merged)} quotes")
-                except json.JSONDecodeError as e:
-                    print(f"[Extract]   JSON error: {e}")
-                    print(f"[Extract]   Raw response (first 500 chars): {json_str[:500]}")
-            else:
+            if doc_evidence is None:
                 print(f"[Extract]   No JSON found in response")
+                for status in statuses:
+                    status.update(status='error', error='no JSON found in response')
+                continue
+
+            source_of = quote_locator(call)
+            for key in merged:
+                if key in doc_evidence and isinstance(doc_evidence[key], list):
+                    for quote in doc_evidence[key]:
+                        if not isinstance(quote, str):
+                            continue
+                        q = quote.strip().strip('"')
+                        if q and len(q) > 25 and not is_prompt_echo(q):
+                            entry, is_new = quote_index.add(q, source_of(q), group=key)
+                            if is_new:
+                                merged[key].append(entry)
+            print(f"[Extract]   Got {sum(len(doc_evidence.get(k,[])) for k in merged)} quotes")
+
+        # Check every quote really appears in the source documents
+        verification = verify_quotes(dict(docs), [q for quotes in merged.values() for q in quotes])
 
         response = json.dumps(merged)
         print(f"[Extract] Final: {sum(len(v) for v in merged.values())} total quotes")
 
-        return jsonify({'success': True, 'response': response})
+        return jsonify({'success': True, 'response': response, 'documents': doc_status, 'verification': verification})
 
+    except CaseNotFound as e:
+        return case_not_found(e)
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -278,104 +447,133 @@ def handle_extract_twostage():
     """Two-stage extraction: Llama 3.3 for quotes and categorization"""
     try:
         data = request.get_json()
-        documents = data.get('documents', {})
+        documents = request_documents(data)
 
         print(f"\n[Two-Stage] Processing {len(documents)} documents")
 
         print("[Stage 1] Extracting quotes with Llama 3.3...")
         all_quotes = []
         stage1_start = time.time()
-
-        for doc_name, doc_text in documents.items():
-            print(f"  Processing {doc_name}...", end=" ", flush=True)
-
-            prompt = f"""You must respond with ONLY a JSON object. No other text.
-
-Extract all sentences related to autism assessment from this document.
-
-Categories:
-- social: social interaction, engagement, relationships
-- communication: language, speech, gestures, pointing
-- repetitive: repetitive movements, stereotypies, routines
-- sensory: sensory responses, pain sensitivity
-- development: developmental milestones, early concerns
-
-Document:
-{doc_text[:3000]}
-
-Respond with ONLY this JSON filled with quotes:
-{{"social":[],"communication":[],"repetitive":[],"sensory":[],"development":[]}}"""
-
-            try:
-                response = call_huggingface(prompt, timeout=120)
-                quotes = parse_stage1_response(response, doc_name)
-                all_quotes.extend(quotes)
-                print(f"{len(quotes)} quotes")
-            except Exception as e:
-                print(f"Error: {e}")
+        cache = llm_cache_mode('twostage')
+        backend = llm_backend('twostage')
+
+        # Every document is covered in full, split into overlapping chunks.
+        # Responses are streamed, so each quote is verified while the rest
+        # of the completion is still generating
+        source_index = SourceIndex(documents)
+        # The deadline grows with the rounds of calls the chunks need
+        chunks = chunk_documents(documents.items(), STAGE1_CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS)
+        workers = parallel_workers(data.get('maxParallel'))
+        results = run_parallel(
+            lambda chunk: timed('stage1_call', stream_stage1_quotes, chunk, cache, source_index, backend),
+            chunks, max_workers=workers, timeout=fanout_timeout(len(chunks), workers, 120))
+
+        doc_status = []
+        for chunk, (quotes, error) in zip(chunks, results):
+            status = {'source': chunk['source'], 'part': chunk['part'], 'status': 'ok'}
+            doc_status.append(status)
+            if error:
+                print(f"  {chunk['source']} [{chunk['part']}]: Error: {error}")
+                status.update(status='error', error=str(error) or type(error).__name__)
+                continue
+            all_quotes.extend(quotes)
+            print(f"  {chunk['source']} [{chunk['part']}]: {len(quotes)} quotes")
+        failed_chunks = sum(1 for status in doc_status if status['status'] == 'error')
 
         stage1_time = time.time() - stage1_start
+        record_stage('stage1', stage1_time, chunks=len(chunks), failed=failed_chunks)
 
-        seen = set()
+        # Collapse exact and near-duplicate quotes (chunk overlaps, repeated
+        # findings across reports), keeping every source that reported them
+        quote_index = QuoteIndex()
         unique_quotes = []
         for q in all_quotes:
-            key = q["text"][:50]
-            if key not in seen:
-                seen.add(key)
-                unique_quotes.append(q)
+            entry, is_new = quote_index.add(q["text"], q["source"])
+            if is_new:
+                entry["category"] = q["category"]
+                entry["verification"] = q["verification"]
+                unique_quotes.append(entry)
 
         print(f"[Stage 1] Complete: {len(unique_quotes)} unique quotes in {stage1_time:.1f}s")
 
+        verification = verify_quotes(source_index, unique_quotes)
+
         print("[Stage 2] Categorizing with Llama 3.3...")
         stage2_start = time.time()
 
-        quotes_for_stage2 = unique_quotes[:30]
-        quotes_text = "\n".join([f'"{q["text"]}" [{q["source"]}]' for q in quotes_for_stage2])
-
-        prompt = f"""You must respond with ONLY a JSON object. No other text.
-
-Categorize these clinical quotes into DSM-5 autism criteria.
-
-CRITERIA:
-A1 = Social reciprocity: back-and-forth interaction, responding to name, sharing enjoyment
-A2 = Nonverbal: eye contact, gestures, pointing, facial expressions
-A3 = Relationships: peer interest, friendships, imaginative play
-B1 = Repetitive: stereotyped movements (rocking, flapping, toe walking), echolalia
-B2 = Routines: insistence on sameness, distress at changes
-B3 = Interests: restricted intense interests, fixations
-B4 = Sensory: over/under-reactive to sensory input
-C = Early onset: symptoms in early developmental period
-D = Impact: functional impairment
-E = Rule-outs: hearing/cognitive testing
-
-RULES:
-- "supporting" = quote shows the autism feature IS present
-- "contradicting" = quote shows the feature is NOT present or is typical
-- Include source document in brackets
-
-QUOTES:
-{quotes_text}
-
-Respond with ONLY this JSON:
-{{"A1":{{"supporting":[],"contradicting":[]}},"A2":{{"supporting":[],"contradicting":[]}},"A3":{{"supporting":[],"contradicting":[]}},"B1":{{"supporting":[],"contradicting":[]}},"B2":{{"supporting":[],"contradicting":[]}},"B3":{{"supporting":[],"contradicting":[]}},"B4":{{"supporting":[],"contradicting":[]}},"C":{{"supporting":[],"contradicting":[]}},"D":{{"supporting":[],"contradicting":[]}},"E":{{"supporting":[],"contradicting":[]}}}}"""
-
-        response = call_huggingface(prompt, timeout=180)
-        result = parse_stage2_response(response)
+        # Quotes the lexical pre-classifier is sure about are decided
+        # locally. The rest are categorized by the LLM, in batches of related
+        # quotes (same stage-1 category) that run concurrently
+        local = {}
+        pending = unique_quotes
+        if STAGE2_LOCAL_CLASSIFIER:
+            pending = []
+            decisions = CRITERIA_CLASSIFIER.classify([q["text"] for q in unique_quotes])
+            for q, decision in zip(unique_quotes, decisions):
+                if decision is None:
+                    pending.append(q)
+                    continue
+                crit, side, _ = decision
+                local.setdefault(crit, {'supporting': [], 'contradicting': []})[side].append(
+                    f'"{q["text"]}" [{", ".join(q["sources"])}]')
+        local_count = len(unique_quotes) - len(pending)
+        metrics.inc('aurum_stage2_quotes_total', local_count, route='local')
+
+        batches = stage2_batches(pending, STAGE2_BATCH_QUOTES)
+
+        def categorize(batch):
+            start = time.time()
+            response = timed('stage2_call', call_llm, build_stage2_prompt(batch),
+                             timeout=120, cache=cache, backend=backend)
+            return parse_stage2_response(response), time.time() - start
+
+        results = [None] * len(batches)
+        for i, result, error in iter_parallel(categorize, batches, STAGE2_PARALLEL,
+                                              timeout=fanout_timeout(len(batches), STAGE2_PARALLEL, 120)):
+            results[i] = (result, error)
+
+        batch_results = []
+        batch_times = []
+        quotes_categorized = local_count
+        for i, (batch, (result, error)) in enumerate(zip(batches, results)):
+            if error:
+                print(f"  Batch {i + 1}/{len(batches)}: Error: {error}")
+                continue
+            batch_evidence, seconds = result
+            record_stage2_labels(batch_evidence)
+            batch_results.append(batch_evidence)
+            batch_times.append(round(seconds, 2))
+            quotes_categorized += len(batch)
+        metrics.inc('aurum_stage2_quotes_total', quotes_categorized - local_count, route='llm')
+        evidence = merge_stage2_results([local] + batch_results)
 
         stage2_time = time.time() - stage2_start
-        print(f"[Stage 2] Complete in {stage2_time:.1f}s")
+        record_stage('stage2', stage2_time, batches=len(batches))
+        print(f"[Stage 2] Complete: {quotes_categorized}/{len(unique_quotes)} quotes ({local_count} local) in "
+              f"{len(batches)} batches, {stage2_time:.1f}s")
 
         return jsonify({
             'success': True,
-            'evidence': result,
+            'evidence': evidence,
+            'quotes': unique_quotes,
+            'documents': doc_status,
             'stats': {
                 'stage1_time': stage1_time,
+                'stage1_chunks': len(chunks),
+                'stage1_failed_chunks': failed_chunks,
                 'stage2_time': stage2_time,
                 'total_quotes': len(unique_quotes),
-                'quotes_categorized': len(quotes_for_stage2)
+                'quotes_categorized': quotes_categorized,
+                'stage2_batches': len(batches),
+                'stage2_failed_batches': len(batches) - len(batch_results),
+                'stage2_local': local_count,
+                'stage2_batch_times': batch_times,
+                'verification': verification
             }
         })
 
+    except CaseNotFound as e:
+        return case_not_found(e)
     except Exception as e:
         print(f"[Two-Stage Error] {e}")
         import traceback
@@ -384,31 +582,46 @@ Respond with ONLY this JSON:
 
 @app.route('/api/extract-functional', methods=['POST'])
 def handle_extract_functional():
-    """Extract functional assessment information from documents"""
+    """Extract functional assessment information from documents.
+
+    With FUNCTIONAL_MAP_REDUCE, a case that needs more than one call is
+    mapped per document in parallel and merged (see
+    extract_functional_map_reduce); 'mode': 'single' forces one call.
+    """
     try:
         data = request.get_json()
-        text = data.get('text', '')
+        text = request_text(data)
         model = data.get('model', 'llama-3.3-70b')
+        cache = llm_cache_mode('functional')
+        backend = llm_backend('functional')
 
         print(f"\n[Functional] Extracting functional assessment...")
         print(f"[Functional] Document length: {len(text)} chars")
 
+        calls = pack_chunks(chunk_documents(split_documents(text), CHUNK_TOKENS), PACK_TOKENS)
+        if FUNCTIONAL_MAP_REDUCE and data.get('mode') != 'single' and len(calls) > 1:
+            start = time.time()
+            parsed, doc_status = extract_functional_map_reduce(calls, cache, backend)
+            record_stage('functional', time.time() - start, calls=len(calls))
+            if parsed is None:
+                return jsonify({'success': False, 'error': 'No document could be extracted', 'documents': doc_status})
+            print(f"[Functional] Extracted {len([k for k,v in parsed.items() if v])} domains with content")
+            return jsonify({'success': True, 'response': json.dumps(parsed), 'documents': doc_status})
+
         prompt = build_functional_prompt(text)
-        result = call_huggingface(prompt, timeout=180)
+        result = timed('functional', call_llm, prompt, timeout=180, cache=cache, backend=backend)
 
-        clean = result.replace('```json', '').replace('```', '').strip()
-        start_idx = clean.find('{')
-        end_idx = clean.rfind('}') + 1
+        parsed = parse_llm_object(result)
 
-        if start_idx >= 0 and end_idx > start_idx:
-            json_str = clean[start_idx:end_idx]
-            parsed = json.loads(json_str)
+        if parsed is not None:
             print(f"[Functional] Extracted {len([k for k,v in parsed.items() if v])} domains with content")
-            return jsonify({'success': True, 'response': json_str})
+            return jsonify({'success': True, 'response': json.dumps(parsed)})
         else:
             print(f"[Functional] No valid JSON found")
             return jsonify({'success': False, 'error': 'No valid JSON in response'})
 
+    except CaseNotFound as e:
+        return case_not_found(e)
     except Exception as e:
         print(f"[Functional Error] {e}")
         import traceback
@@ -420,111 +633,395 @@ def handle_extract_hf():
     """Extract using HuggingFace API (Llama 3.3 70B) - faster but cloud-based"""
     try:
         data = request.get_json()
-        text = data.get('text', '')
+        text = request_text(data)
 
         print(f"\n[HF Extract] Text length: {len(text)}")
 
         # Split into documents
-        docs = []
-        current_doc = ""
-        current_name = ""
-        for line in text.split('\n'):
-            if line.startswith('--- ') and line.endswith(' ---'):
-                if current_doc.strip():
-                    docs.append((current_name, current_doc.strip()))
-                current_name = line[4:-4]
-                current_doc = ""
-            else:
-                current_doc += line + "\n"
-        if current_doc.strip():
-            docs.append((current_name, current_doc.strip()))
+        docs = split_documents(text)
 
         print(f"[HF Extract] Split into {len(docs)} documents")
 
         merged = {"A1":[],"A2":[],"A3":[],"B1":[],"B2":[],"B3":[],"B4":[],"C":[],"D":[],"E":[]}
-
-        for doc_name, doc_text in docs:
-            print(f"[HF Extract] Processing: {doc_name} ({len(doc_text)} chars)")
-
-            prompt = build_extraction_prompt(doc_text)
-            result = call_huggingface(prompt, timeout=120)
+        doc_status = []
+        quote_index = QuoteIndex()
+        cache = llm_cache_mode('extract')
+        backend = llm_backend('extract')
+
+        # Long documents are split into overlapping chunks on sentence boundaries,
+        # short ones share a call
+        calls = pack_chunks(chunk_documents(docs, CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS), PACK_TOKENS)
+        print(f"[HF Extract] {len(calls)} calls")
+        workers = parallel_workers(data.get('maxParallel'))
+        results = run_parallel(
+            lambda call: timed('extract_call', call_llm,
+                               build_extraction_prompt(call['text'], packed=len(call['members']) > 1),
+                               timeout=120, cache=cache, backend=backend),
+            calls, max_workers=workers, timeout=fanout_timeout(len(calls), workers, 120))
+
+        for call, (result, error) in zip(calls, results):
+            members = call['members']
+            print(f"[HF Extract] Processing: {', '.join(m['source'] + ' chunk ' + m['part'] for m in members)} ({len(call['text'])} chars)")
+
+            statuses = [{'source': m['source'], 'part': m['part'], 'status': 'ok'} for m in members]
+            doc_status.extend(statuses)
+            if error:
+                print(f"[HF Extract]   Failed: {error}")
+                for status in statuses:
+                    status.update(status='error', error=str(error) or type(error).__name__)
+                continue
 
             # Parse JSON response
-            clean = result.replace('```json', '').replace('```', '').strip()
-            start_idx = clean.find('{')
-            end_idx = clean.rfind('}') + 1
-
-            if start_idx >= 0 and end_idx > start_idx:
-                json_str = clean[start_idx:end_idx]
-                json_str = fix_json_quotes(json_str)
+            try:
+                doc_evidence = parse_llm_object(result, parse_llm_json)
+            except json.JSONDecodeError as e:
+                print(f"[HF Extract]   JSON error: {e}")
+                for status in statuses:
+                    status.update(status='error', error=f"invalid JSON in response: {e}")
+                continue
 
-                try:
-                    doc_evidence = json.loads(json_str)
-                    for key in merged:
-                        if key in doc_evidence and isinstance(doc_evidence[key], list):
-                            for quote in doc_evidence[key]:
-                                q = quote.strip().strip('"') if isinstance(quote, str) else str(quote)
-                                if q and len(q) > 20 and not any(existing["text"] == q for existing in merged[key]):
-                                    merged[key].append({"text": q, "source": doc_name})
-                    print(f"[HF Extract]   Got {sum(len(doc_evidence.get(k,[])) for k in merged)} quotes")
-                except json.JSONDecodeError as e:
-                    print(f"[HF Extract]   JSON error: {e}")
-            else:
+            if doc_evidence is None:
                 print(f"[HF Extract]   No JSON found")
+                for status in statuses:
+                    status.update(status='error', error='no JSON found in response')
+                continue
+
+            source_of = quote_locator(call)
+            for key in merged:
+                if key in doc_evidence and isinstance(doc_evidence[key], list):
+                    for quote in doc_evidence[key]:
+                        q = quote.strip().strip('"') if isinstance(quote, str) else str(quote)
+                        if q and len(q) > 20:
+                            entry, is_new = quote_index.add(q, source_of(q), group=key)
+                            if is_new:
+                                merged[key].append(entry)
+            print(f"[HF Extract]   Got {sum(len(doc_evidence.get(k,[])) for k in merged)} quotes")
+
+        # Check every quote really appears in the source documents
+        verification = verify_quotes(dict(docs), [q for quotes in merged.values() for q in quotes])
 
         response = json.dumps(merged)
         print(f"[HF Extract] Final: {sum(len(v) for v in merged.values())} total quotes")
 
-        return jsonify({'success': True, 'response': response})
+        return jsonify({'success': True, 'response': response, 'documents': doc_status, 'verification': verification})
 
+    except CaseNotFound as e:
+        return case_not_found(e)
     except Exception as e:
         print(f"[HF Extract Error] {e}")
         import traceback
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/extract-text', methods=['POST'])
+def handle_extract_text():
+    """Extract plain text from uploaded .docx/.pdf/.txt files (multipart field 'files')"""
+    try:
+        uploads = request.files.getlist('files')
+        print(f"\n[Extract Text] {len(uploads)} files")
+
+        documents = {}
+        errors = {}
+        futures = {}
+        pool = get_extract_pool()
+        for upload in uploads:
+            name = upload.filename
+            data = upload.read(EXTRACT_MAX_BYTES + 1)
+            if len(data) > EXTRACT_MAX_BYTES:
+                errors[name] = f'file larger than {EXTRACT_MAX_BYTES // (1024 * 1024)} MB'
+                continue
+            futures[name] = pool.submit(extract_document_text, name, data)
+
+        deadline = time.time() + EXTRACT_TIMEOUT
+        for name, future in futures.items():
+            try:
+                documents[name] = future.result(timeout=max(0, deadline - time.time()))
+                print(f"[Extract Text]   {name}: {len(documents[name])} chars")
+            except Exception as e:
+                future.cancel()
+                if isinstance(e, BrokenProcessPool):
+                    reset_extract_pool(pool)
+                errors[name] = str(e) or type(e).__name__
+                print(f"[Extract Text]   {name}: Failed: {errors[name]}")
+
+        return jsonify({'success': True, 'documents': documents, 'errors': errors})
+
+    except Exception as e:
+        print(f"[Extract Text Error] {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'error': str(e)})
+
 @app.route('/api/generate-report', methods=['POST'])
 def handle_generate_report():
     """Generate tailored reports for different audiences"""
     try:
         data = request.get_json()
+        backend = llm_backend('report')
+        report_type, parts, timeout = prepare_report_request(data, request_documents(data), backend)
 
-        report_type = data.get('reportType')
-        client_info = data.get('clientInfo', {})
-        evidence = data.get('evidence', {})
-        functional = data.get('functionalAssessment', {})
-        diagnostic = data.get('diagnosticDecisions', {})
-        case_note = data.get('caseNote', '')
-        documents = data.get('documents', {})
-        model = data.get('model', 'llama-3.3-70b')
+        start = time.time()
+        result = generate_report(parts, timeout, llm_cache_mode('report'), backend)
 
-        print(f"\n[Report] Evidence keys: {list(evidence.keys())}")
-        print(f"[Report] Documents: {list(documents.keys())}")
-        print(f"[Report] Generating {report_type} report for {client_info.get('name', 'Unknown')}")
+        metrics.observe('aurum_report_duration_seconds', time.time() - start, type=report_type, mode='blocking')
+        print(f"[Report] Generated {len(result)} chars")
+        return jsonify({'success': True, 'report': result, 'truncated': REPORT_TRUNCATED_MARKER in result})
 
-        prompt = build_report_prompt(report_type, client_info, evidence, functional, diagnostic, case_note, documents)
+    except CaseNotFound as e:
+        return case_not_found(e)
+    except Exception as e:
+        print(f"[Report Error] {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'error': str(e)})
 
-        # Longer reports need more tokens for the full template
-        if report_type == 'ndis':
-            max_tokens = 8000
-        elif report_type in ['teacher', 'gp', 'caregiver']:
-            max_tokens = 6000
-        else:
-            max_tokens = 2000
+@app.route('/api/generate-report-stream', methods=['POST'])
+def handle_generate_report_stream():
+    """Generate a report and relay tokens to the browser as Server-Sent Events"""
+    data = request.get_json()
+    cache = llm_cache_mode('report')
+    try:
+        backend = llm_backend('report')
+        # Resolved before the stream starts, so an unknown case is a plain 404
+        documents = request_documents(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)})
+    except CaseNotFound as e:
+        return case_not_found(e)
 
-        # NDIS needs longer timeout due to comprehensive template
-        timeout = 300 if report_type == 'ndis' else 180
-        result = call_huggingface(prompt, timeout=timeout, max_tokens=max_tokens)
+    def sse(event, payload):
+        return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
 
-        print(f"[Report] Generated {len(result)} chars")
-        return jsonify({'success': True, 'report': result})
+    def events():
+        start = time.time()
+        chars = 0
+        truncated = False
+        try:
+            report_type, parts, timeout = prepare_report_request(data, documents, backend)
+            if len(parts) > 1:
+                # The first section is relayed token by token while the others generate in the
+                # background; they follow a whole section at a time, in template order. On
+                # disconnect (or a timeout) the cancel event aborts the upstream calls of
+                # sections still generating
+                failed = 0
+                cancel = threading.Event()
+                rest = queue.Queue()
+                threading.Thread(target=queue_report_sections, name='report-sections', daemon=True,
+                                 args=(rest, parts, timeout, cache, backend, cancel)).start()
+                try:
+                    prompt, max_tokens = parts[0]
+                    # Text already relayed can't be regenerated, so a cut-off is marked
+                    try:
+                        for token in stream_llm(prompt, timeout=timeout, max_tokens=max_tokens, cache=cache,
+                                                backend=backend, raise_truncated=True):
+                            chars += len(token)
+                            yield sse('token', {'text': token})
+                        tail = '\n\n'
+                    except TruncatedError:
+                        truncated = True
+                        tail = REPORT_TRUNCATED_MARKER + '\n\n'
+                    except Exception as e:
+                        print(f"[Report] Section 1/{len(parts)} failed: {e}")
+                        failed += 1
+                        tail = '\n\n' + failed_section_marker(e) + '\n\n'
+                    chars += len(tail)
+                    yield sse('token', {'text': tail})
+                    for text, error in iter(rest.get, None):
+                        failed += error is not None
+                        truncated = truncated or REPORT_TRUNCATED_MARKER in text
+                        chars += len(text) + 2
+                        yield sse('token', {'text': text + '\n\n'})
+                finally:
+                    cancel.set()
+                if failed == len(parts):
+                    raise RuntimeError(f"all {failed} report sections failed")
+            else:
+                prompt, max_tokens = parts[0]
+                # If the client disconnects, the server closes this generator and
+                # GeneratorExit unwinds stream_llm, aborting the upstream call.
+                # Text already relayed can't be regenerated, so a cut-off is marked
+                try:
+                    for token in stream_llm(prompt, timeout=timeout, max_tokens=max_tokens, cache=cache,
+                                            backend=backend, raise_truncated=True):
+                        chars += len(token)
+                        yield sse('token', {'text': token})
+                except TruncatedError:
+                    truncated = True
+                    chars += len(REPORT_TRUNCATED_MARKER)
+                    yield sse('token', {'text': REPORT_TRUNCATED_MARKER})
+            metrics.observe('aurum_report_duration_seconds', time.time() - start, type=report_type, mode='stream')
+            print(f"[Report Stream] Generated {chars} chars in {time.time() - start:.1f}s")
+            yield sse('done', {'success': True, 'chars': chars, 'time': time.time() - start, 'truncated': truncated})
+        except GeneratorExit:
+            print(f"[Report Stream] Client disconnected after {chars} chars, upstream aborted")
+            raise
+        except Exception as e:
+            print(f"[Report Stream Error] {e}")
+            yield sse('error', {'success': False, 'error': str(e)})
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/generate-reports', methods=['POST'])
+def handle_generate_reports():
+    """Generate several report types for one case concurrently, as Server-Sent Events.
+
+    The case context (documents, evidence, functional summary and keyword
+    scans) is prepared once. Each report is sent as a 'report' event as
+    soon as it finishes, with its own timing, then 'done' summarises.
+    """
+    data = request.get_json()
+    cache = llm_cache_mode('report')
+    report_types = data.get('reportTypes') or ['caregiver', 'teacher', 'gp', 'ndis']
+    if not isinstance(report_types, list) or not all(isinstance(t, str) for t in report_types):
+        return jsonify({'success': False, 'error': 'reportTypes must be a list of report type names'}), 400
+    unknown = [t for t in report_types if t not in REPORT_TITLES]
+    if unknown:
+        return jsonify({'success': False, 'error': f"Unknown report types: {', '.join(unknown)}"}), 400
+    report_types = list(dict.fromkeys(report_types))
+    plans = {}
+    try:
+        backend = llm_backend('report')
+        # Resolved before the stream starts, so an unknown case is a plain 404
+        documents = request_documents(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)})
+    except CaseNotFound as e:
+        return case_not_found(e)
+
+    def sse(event, payload):
+        return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+    # Set when the client disconnects, so reports still generating abort their upstream calls
+    cancel = threading.Event()
+
+    def generate(report_type, deadline):
+        start = time.time()
+        text = generate_report(plans[report_type], report_timeout(report_type), cache, backend, cancel, deadline)
+        elapsed = time.time() - start
+        metrics.observe('aurum_report_duration_seconds', elapsed, type=report_type, mode='batch')
+        return text, elapsed
+
+    def events():
+        start = time.time()
+        timings = {}
+        try:
+            context = prepare_report_context(data, documents)
+            for report_type in report_types:
+                plans[report_type] = build_report_prompt(report_type, context, backend)
+            prepare_time = time.time() - start
+            print(f"[Reports] Prepared {len(report_types)} reports in {prepare_time:.2f}s: {report_types}")
+            # Every report's calls share the LLM slots, so the batch runs in rounds of
+            # LLM_MAX_INFLIGHT calls (counting possible regenerations); each report's
+            # sections get the same deadline as the batch
+            calls = sum(report_part_calls(max_tokens) for plan in plans.values() for _, max_tokens in plan)
+            deadline = fanout_timeout(calls, LLM_MAX_INFLIGHT,
+                                      max(report_timeout(report_type) for report_type in report_types))
+            print(f"[Reports] {calls} calls at most, deadline {deadline:.0f}s")
+            reports = iter_parallel(lambda report_type: generate(report_type, deadline), report_types,
+                                    len(report_types), deadline)
+            try:
+                for index, result, error in reports:
+                    report_type = report_types[index]
+                    if error is not None:
+                        print(f"[Reports] {report_type} failed: {error}")
+                        yield sse('report', {'type': report_type, 'success': False, 'error': str(error)})
+                        continue
+                    report, timings[report_type] = result
+                    print(f"[Reports] {report_type}: {len(report)} chars in {timings[report_type]:.1f}s")
+                    yield sse('report', {'type': report_type, 'success': True, 'report': report,
+                                         'time': timings[report_type],
+                                         'truncated': REPORT_TRUNCATED_MARKER in report})
+            finally:
+                cancel.set()
+                reports.close()
+            yield sse('done', {'success': len(timings) == len(report_types), 'time': time.time() - start,
+                               'prepareTime': prepare_time, 'times': timings})
+        except GeneratorExit:
+            print(f"[Reports] Client disconnected after {len(timings)}/{len(report_types)} reports, upstream aborted")
+            raise
+        except Exception as e:
+            print(f"[Reports Error] {e}")
+            yield sse('error', {'success': False, 'error': str(e)})
 
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/jobs/<kind>', methods=['POST'])
+def handle_job_submit(kind):
+    """Queue a long-running pipeline request and return its job id immediately"""
+    if kind not in JOB_HANDLERS:
+        return jsonify({'success': False, 'error': f'Unknown job type: {kind}'}), 404
+    try:
+        job_id = job_queue.submit(kind, request.get_json(), {'X-LLM-Cache': request.headers.get('X-LLM-Cache', '')})
+    except JobQueueFull as e:
+        return jsonify({'success': False, 'error': str(e)}), 429
+    print(f"[Jobs] Queued {kind} job {job_id}")
+    return jsonify({'success': True, 'jobId': job_id, 'status': 'queued'}), 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def handle_job_status(job_id):
+    """Job status; pass ?wait=N to long-poll up to N seconds for completion"""
+    wait = min(float(request.args.get('wait', 0) or 0), JOB_MAX_WAIT)
+    job = job_queue.get(job_id, wait=wait)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Unknown or expired job'}), 404
+    return jsonify({'success': True, **job})
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def handle_job_result(job_id):
+    """Return the finished job's response exactly as the synchronous endpoint would"""
+    wait = min(float(request.args.get('wait', 0) or 0), JOB_MAX_WAIT)
+    job = job_queue.get(job_id, wait=wait)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Unknown or expired job'}), 404
+    if job['status'] == 'done':
+        return jsonify(job['result'])
+    if job['status'] == 'failed' and job.get('result', {}).get('caseNotFound'):
+        return jsonify(job['result']), 404
+    if job['status'] in ('failed', 'expired'):
+        return jsonify({'success': False, 'status': job['status'], 'error': job.get('error')})
+    return jsonify({'success': False, 'status': job['status']}), 202
+
+@app.route('/api/cases', methods=['POST'])
+def handle_case_create():
+    """Create a case from {name: text} documents and/or {name: sha256} hashes already stored"""
+    return _case_upload(None)
+
+@app.route('/api/cases/<case_id>/documents', methods=['POST'])
+def handle_case_documents(case_id):
+    """Add or replace documents in a case; same body as case creation"""
+    return _case_upload(case_id)
+
+def _case_upload(case_id):
+    try:
+        data = request.get_json() or {}
+        case_id, stored, missing = case_store.put(case_id, data.get('documents') or {}, data.get('hashes') or {})
+        print(f"[Cases] {case_id}: stored {len(stored)} documents, {len(missing)} hashes unknown")
+        return jsonify({'success': True, 'caseId': case_id, 'documents': stored, 'missing': missing})
+    except CaseNotFound as e:
+        return jsonify({'success': False, 'error': str(e)}), 404
+    except CaseQuotaExceeded as e:
+        return jsonify({'success': False, 'error': str(e)}), 413
     except Exception as e:
-        print(f"[Report Error] {e}")
+        print(f"[Cases Error] {e}")
         import traceback
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/cases/<case_id>', methods=['GET'])
+def handle_case_get(case_id):
+    """List a case's documents as {name: {hash, size}}"""
+    try:
+        return jsonify({'success': True, 'caseId': case_id, 'documents': case_store.describe(case_id)})
+    except CaseNotFound as e:
+        return jsonify({'success': False, 'error': str(e)}), 404
+
+@app.route('/api/cases/<case_id>', methods=['DELETE'])
+def handle_case_delete(case_id):
+    case_store.delete(case_id)
+    return jsonify({'success': True})
+
 @app.route('/api/export-docx', methods=['POST'])
 def handle_export_docx():
     """Export case note as Word document"""
@@ -536,6 +1033,232 @@ def handle_export_docx():
 
 # ============== Helper Functions ==============
 
+def prepare_report_request(data, documents, backend):
+    """Build (report_type, [(prompt, max_tokens), ...], timeout) for a report request"""
+    report_type = data.get('reportType')
+    context = prepare_report_context(data, documents)
+    print(f"[Report] Generating {report_type} report for {context.client_info.get('name', 'Unknown')}")
+    return report_type, build_report_prompt(report_type, context, backend), report_timeout(report_type)
+
+def prepare_report_context(data, documents):
+    """The ReportContext for a report request, shared by every report type generated from it"""
+    context = ReportContext(data.get('clientInfo', {}), data.get('evidence', {}), data.get('functionalAssessment', {}),
+                            data.get('diagnosticDecisions', {}), data.get('caseNote', ''), documents)
+    print(f"\n[Report] Evidence keys: {list(context.evidence.keys())}")
+    print(f"[Report] Documents: {list(context.documents.keys())}")
+    return context
+
+def report_timeout(report_type):
+    # NDIS needs longer timeout due to comprehensive template
+    return 300 if report_type == 'ndis' else 180
+
+REPORT_TRUNCATED_MARKER = "\n\n> **[Cut off at the length limit. Regenerate the report to complete this part.]**"
+
+def complete_report_part(prompt, max_tokens, timeout, cache, backend, cancel=None, slot_timeout=None):
+    """One report completion. If it hits max_tokens it is regenerated once at REPORT_MAX_TOKENS, then marked.
+
+    With a cancel event the completion is streamed and abandoned as soon as
+    the event is set, which closes the upstream request mid-generation.
+    """
+    budgets = [max_tokens, REPORT_MAX_TOKENS][:report_part_calls(max_tokens)]
+    for budget in budgets:
+        try:
+            if cancel is None:
+                return call_llm(prompt, timeout=timeout, max_tokens=budget, cache=cache, backend=backend,
+                                raise_truncated=True, slot_timeout=slot_timeout)
+            return stream_report_part(prompt, budget, timeout, cache, backend, cancel, slot_timeout)
+        except TruncatedError as e:
+            print(f"[Report] Cut off at {budget} tokens")
+            truncated = e
+    return truncated.content.rstrip() + REPORT_TRUNCATED_MARKER
+
+def report_part_calls(max_tokens):
+    """Upstream calls complete_report_part may make: one, plus a regeneration if the budget can grow"""
+    return 2 if max_tokens < REPORT_MAX_TOKENS else 1
+
+def stream_report_part(prompt, max_tokens, timeout, cache, backend, cancel, slot_timeout=None):
+    """Collect a streamed completion, checking cancel between deltas"""
+    if cancel.is_set():
+        raise ReportCancelled("report cancelled")
+    deltas = stream_llm(prompt, timeout=timeout, max_tokens=max_tokens, cache=cache, backend=backend,
+                        raise_truncated=True, slot_timeout=slot_timeout)
+    text = []
+    try:
+        for delta in deltas:
+            if cancel.is_set():
+                raise ReportCancelled("report cancelled")
+            text.append(delta)
+    finally:
+        # Closing the stream unwinds stream_llm, which closes the upstream response
+        deltas.close()
+    return ''.join(text)
+
+def generate_report(parts, timeout, cache, backend, cancel=None, deadline=None):
+    """The report text: one completion, or sections generated in parallel and stitched in order.
+
+    deadline is for reports whose calls queue behind other work for LLM
+    slots (a batch): it bounds the whole report and each call's slot wait.
+    """
+    if len(parts) == 1:
+        prompt, max_tokens = parts[0]
+        return complete_report_part(prompt, max_tokens, timeout, cache, backend, cancel, deadline)
+    sections = list(generate_report_sections(parts, timeout, cache, backend, cancel, deadline))
+    errors = [error for _, error in sections if error is not None]
+    if len(errors) == len(sections):
+        raise errors[0]
+    return '\n\n'.join(text for text, _ in sections)
+
+def generate_report_sections(parts, timeout, cache, backend, cancel=None, deadline=None, offset=0):
+    """Yield (text, error) for each section in template order as soon as it and its predecessors are done.
+
+    Up to REPORT_SECTION_PARALLEL sections run at once, so the report takes
+    about as long as its slowest section. A failed section becomes a
+    visible marker rather than silently missing text. Pass a cancel event
+    to have sections streamed: setting it makes sections still generating
+    abort their upstream calls. deadline is as for generate_report. offset
+    numbers the sections in logs when parts are the tail of a report.
+    """
+    finished = {}
+    next_index = 0
+    generate = lambda part: timed('report_section', complete_report_part, part[0], part[1], timeout, cache, backend,
+                                  cancel, deadline)
+    if deadline is None:
+        # Sections run REPORT_SECTION_PARALLEL at a time, and each may be regenerated once after a cut-off
+        deadline = fanout_timeout(len(parts), REPORT_SECTION_PARALLEL,
+                                  timeout * max(report_part_calls(max_tokens) for _, max_tokens in parts))
+    sections = iter_parallel(generate, parts, REPORT_SECTION_PARALLEL, deadline)
+    try:
+        for index, result, error in sections:
+            if error is not None:
+                print(f"[Report] Section {offset + index + 1}/{offset + len(parts)} failed: {error}")
+                result = failed_section_marker(error)
+            finished[index] = (result.strip(), error)
+            while next_index in finished:
+                yield finished.pop(next_index)
+                next_index += 1
+    finally:
+        sections.close()
+
+def failed_section_marker(error):
+    return f"> **[This section could not be generated ({error}). Regenerate the report to complete it.]**"
+
+def queue_report_sections(out, parts, timeout, cache, backend, cancel):
+    """Put the (text, error) pairs of a report's sections after the first on out, then None when all are done"""
+    try:
+        for section in generate_report_sections(parts[1:], timeout, cache, backend, cancel, offset=1):
+            out.put(section)
+    finally:
+        out.put(None)
+
+def request_documents(data):
+    """The request's {name: text} documents: a stored case, stored hashes or inline"""
+    if data.get('caseId'):
+        return case_store.documents(data['caseId'])
+    if data.get('documentHashes'):
+        return case_store.resolve(data['documentHashes'])
+    return data.get('documents', {})
+
+def case_not_found(e):
+    """404 for a request naming an unknown or expired case; the client re-uploads it and retries"""
+    return jsonify({'success': False, 'error': str(e), 'caseNotFound': True}), 404
+
+def request_text(data):
+    """The request's text, or its documents joined as '--- name ---' sections"""
+    if data.get('text') or not (data.get('caseId') or data.get('documentHashes') or data.get('documents')):
+        return data.get('text', '')
+    return '\n\n'.join(f'--- {name} ---\n{text}' for name, text in request_documents(data).items())
+
+def split_documents(text):
+    """Split concatenated '--- name ---' text into (name, text) pairs"""
+    docs = []
+    current_doc = ""
+    current_name = ""
+    for line in text.split('\n'):
+        if line.startswith('--- ') and line.endswith(' ---'):
+            if current_doc.strip():
+                docs.append((current_name, current_doc.strip()))
+            current_name = line[4:-4]
+            current_doc = ""
+        else:
+            current_doc += line + "\n"
+    if current_doc.strip():
+        docs.append((current_name, current_doc.strip()))
+    return docs
+
+def parallel_workers(max_workers=None):
+    """How many calls run_parallel runs at once for a client's maxParallel"""
+    try:
+        workers = int(max_workers or EXTRACT_MAX_PARALLEL)
+    except (TypeError, ValueError):
+        workers = EXTRACT_MAX_PARALLEL
+    return max(1, min(workers, EXTRACT_MAX_PARALLEL))
+
+def fanout_timeout(count, workers, call_timeout):
+    """Deadline for count calls of up to call_timeout seconds each, run workers at a time"""
+    rounds = max(1, -(-count // max(1, workers)))
+    return call_timeout * rounds + 30
+
+def run_parallel(func, items, max_workers=None, timeout=None):
+    """Run func(item) for every item concurrently.
+
+    Returns a list of (result, error) tuples in the same order as items.
+    A failure or timeout in one item never cancels the others.
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    workers = min(parallel_workers(max_workers), len(items))
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = [executor.submit(func, item) for item in items]
+        wait_futures(futures, timeout=timeout)
+
+        results = []
+        for future in futures:
+            if not future.done():
+                future.cancel()
+                metrics.inc('aurum_timeouts_total', where='parallel')
+                results.append((None, TimeoutError(f"no result after {timeout}s")))
+            elif future.exception() is not None:
+                results.append((None, future.exception()))
+            else:
+                results.append((future.result(), None))
+        return results
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def iter_parallel(func, items, max_workers, timeout=None):
+    """Run func(item) for every item concurrently, yielding (index, result, error) as each finishes.
+
+    Items still running after timeout seconds are yielded with a
+    TimeoutError. Closing the generator early cancels items not yet started.
+    """
+    items = list(items)
+    if not items:
+        return
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items))))
+    try:
+        futures = {executor.submit(func, item): i for i, item in enumerate(items)}
+        pending = set(futures)
+        deadline = None if timeout is None else time.time() + timeout
+        while pending:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            done, pending = wait_futures(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            if not done:
+                for future in pending:
+                    future.cancel()
+                    metrics.inc('aurum_timeouts_total', where='parallel')
+                    yield futures[future], None, TimeoutError(f"no result after {timeout}s")
+                return
+            for future in done:
+                error = future.exception()
+                yield futures[future], None if error else future.result(), error
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
 def fix_red_flags(metadata):
     """Post-process to ensure red_flags only contains genuinely missing critical items"""
     red_flags = []
@@ -582,156 +1305,196 @@ def is_prompt_echo(text):
                 return True
     return False
 
-def fix_json_quotes(json_str):
-    """Leniently repair malformed JSON output from an LLM"""
-    s = (json_str or "").strip()
-
-    # Quick normalizations
+_QUOTE_RUN_RE = re.compile(r'("+)')
+_SPECIAL_CHAR_RE = re.compile(r'["\\\[\],]')
+_QUOTED_KEY_RE = re.compile(r'"([^"]+)"\s*:\s*\[')
+_BARE_KEY_RE = re.compile(r'(?<![A-Za-z0-9_])[0-9_]*([A-Za-z][A-Za-z0-9_]*)\s*:\s*\[')
+
+def _collapse_doubled_quotes(s):
+    """One left-to-right pass of ""X"" -> "X" (X without quotes), in linear time.
+
+    Works on maximal runs of quotes: a run of 4+ quotes halves in groups of
+    four, and the last two quotes of a run pair with the first two of the
+    next run around the text between them.
+    """
+    parts = _QUOTE_RUN_RE.split(s)  # text, run, text, run, ..., text
+    runs = len(parts) // 2
+    out = []
+    offset = 0  # leading quotes of this run already used by a pair on the left
+    for r in range(runs):
+        out.append(parts[2 * r])
+        length = len(parts[2 * r + 1])
+        kept = 1 if offset else 0
+        p = offset
+        while length - p >= 4:
+            kept += 2
+            p += 4
+        rest = length - p
+        offset = 0
+        if rest >= 2 and r + 1 < runs and len(parts[2 * r + 3]) >= 2:
+            kept += rest - 1
+            offset = 2
+        else:
+            kept += rest
+        out.append('"' * kept)
+    out.append(parts[-1])
+    return ''.join(out)
+
+def _unwrap_escaped_quotes(s):
+    """One left-to-right pass of "\\"X\\"" -> "X" (X within one line), in linear time"""
+    out = []
+    i = 0
+    line_end = -1
+    while True:
+        a = s.find('"\\"', i)
+        if a == -1:
+            break
+        if a >= line_end:
+            line_end = s.find('\n', a)
+            if line_end == -1:
+                line_end = len(s)
+        b = s.find('\\""', a + 3, line_end)
+        if b == -1:
+            # No closer on this line, so no opener before the newline can match
+            out.append(s[i:line_end])
+            i = line_end
+            continue
+        out.append(s[i:a])
+        out.append('"' + s[a + 3:b] + '"')
+        i = b + 3
+    out.append(s[i:])
+    return ''.join(out)
+
+def _normalize_model_quotes(s):
+    """Apply both quote repairs until nothing changes"""
     prev = None
     while prev != s:
         prev = s
-        s = re.sub(r'""([^"]*?)""', r'"\1"', s)
-
+        s = _collapse_doubled_quotes(s)
     prev = None
     while prev != s:
         prev = s
-        s = re.sub(r'"\\\"(.*?)\\\""', r'"\1"', s)
+        s = _unwrap_escaped_quotes(s)
+    return s
 
-    def strip_outer_quotes(token):
-        t = token.strip()
-        if len(t) >= 2 and t[0] == '"' and t[-1] == '"':
-            t = t[1:-1]
-        if len(t) >= 2 and t[0] in '""' and t[-1] in '""':
-            t = t[1:-1]
-        return t.strip()
-
-    def unescape_model_wrappers(t):
-        t = t.strip()
-        t = strip_outer_quotes(t)
-        t = re.sub(r'^\\"(.*)\\"$', r'\1', t)
-        t = re.sub(r'^"+(.*)"+$', r'\1', t)
-        return t.strip()
-
-    result = {}
-    key_iter = list(re.finditer(r'"([^"]+)"\s*:\s*\[', s))
-    if not key_iter:
-        key_iter = list(re.finditer(r'([A-Za-z][A-Za-z0-9_]*)\s*:\s*\[', s))
+def _array_tokens(s, bracket):
+    """Split the array opened at s[bracket] into raw item tokens.
 
+    Finds the matching ']' (or runs to the last character if there is none)
+    and splits on commas outside strings, visiting only special characters.
+    """
     n = len(s)
+    search = _SPECIAL_CHAR_RE.search
+    depth = 0
+    in_str = False
+    splits = []
+    end = -1
+    pos = bracket
+    while True:
+        m = search(s, pos)
+        if m is None:
+            break
+        i = m.start()
+        ch = s[i]
+        pos = i + 1
+        if in_str:
+            if ch == '\\':
+                pos = i + 2  # escape consumes the next character
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = True
+        elif ch == '[':
+            depth += 1
+        elif ch == ']':
+            depth -= 1
+            if depth == 0:
+                end = i
+                break
+        elif ch == ',':
+            splits.append(i)
+
+    if end == -1:
+        end = n - 1
+        splits = [i for i in splits if i < end]
+    bounds = [bracket] + splits + [end]
+    return [s[bounds[k] + 1:bounds[k + 1]] for k in range(len(bounds) - 1)]
+
+def _strip_model_wrappers(t):
+    """Strip quote wrappers that models put around items (""x"", \\"x\\")"""
+    t = t.strip()
+    for _ in range(2):
+        if len(t) >= 2 and t[0] == '"' and t[-1] == '"':
+            t = t[1:-1]
+    t = t.strip()
+    if len(t) >= 4 and t.startswith('\\"') and t.endswith('\\"') and '\n' not in t[2:-2]:
+        t = t[2:-2]
+    if len(t) >= 2 and t[0] == '"' and t[-1] == '"':
+        lead = min(len(t) - len(t.lstrip('"')), len(t) - 1)
+        if '\n' not in t[lead:-1]:
+            t = t[lead:-1]
+    return t.strip()
+
+def _clean_array_items(tokens):
+    """Turn raw tokens into quote strings; bare tokens continue the previous item"""
+    items = []  # each item is a list of pieces, joined once at the end
+    for tok in tokens:
+        t = tok.strip()
+        if not t:
+            continue
 
-    def find_matching_bracket(start_idx):
-        depth = 0
-        in_str = False
-        esc = False
-        i = start_idx
-        while i < n:
-            ch = s[i]
-            if in_str:
-                if esc:
-                    esc = False
-                elif ch == '\\':
-                    esc = True
-                elif ch == '"':
-                    in_str = False
-            else:
-                if ch == '"':
-                    in_str = True
-                elif ch == '[':
-                    depth += 1
-                elif ch == ']':
-                    depth -= 1
-                    if depth == 0:
-                        return i
+        i, j = 0, len(t)
+        while i < j and (t[i].isspace() or t[i] == ']'):
             i += 1
-        return -1
-
-    def split_array_items(array_body):
-        items = []
-        buf = []
-        in_str = False
-        esc = False
-        for ch in array_body:
-            if in_str:
-                buf.append(ch)
-                if esc:
-                    esc = False
-                elif ch == '\\':
-                    esc = True
-                elif ch == '"':
-                    in_str = False
-            else:
-                if ch == '"':
-                    in_str = True
-                    buf.append(ch)
-                elif ch == ',':
-                    token = "".join(buf).strip()
-                    items.append(token)
-                    buf = []
-                else:
-                    buf.append(ch)
-        token = "".join(buf).strip()
-        if token:
-            items.append(token)
-        return items
-
-    for m in key_iter:
-        key = m.group(1)
-        bracket_start = m.end() - 1
-        if bracket_start < 0 or bracket_start >= n or s[bracket_start] != '[':
+        while j > i and (t[j - 1].isspace() or t[j - 1] == '['):
+            j -= 1
+        t = t[i:j].strip()
+
+        if t.startswith('"') or t.endswith('"'):
+            t2 = _strip_model_wrappers(t)
+            if t2:
+                items.append([t2])
             continue
 
-        bracket_end = find_matching_bracket(bracket_start)
-        if bracket_end == -1:
-            bracket_end = n - 1
-
-        body = s[bracket_start + 1: bracket_end]
-        raw_tokens = split_array_items(body)
-
-        cleaned_items = []
-        for tok in raw_tokens:
-            t = tok.strip()
-            if not t:
-                continue
+        bare = _strip_model_wrappers(t)
+        if bare:
+            if items:
+                items[-1].append(" " if items[-1][-1].endswith((',', ';', ':')) else ", ")
+                items[-1].append(bare)
+            else:
+                items.append([bare])
 
-            t = re.sub(r'^[\s\]]+', '', t)
-            t = re.sub(r'[\s\[]+$', '', t).strip()
+    return [' '.join(''.join(it).split()).replace('\u201c', '"').replace('\u201d', '"') for it in items]
 
-            if t.startswith('"') or t.endswith('"') or t.startswith('"') or t.endswith('"'):
-                t2 = unescape_model_wrappers(t)
-                if t2:
-                    cleaned_items.append(t2)
-                continue
+def parse_llm_json(text):
+    """Leniently parse JSON-ish LLM output of the form {"key": ["quote", ...]}.
 
-            bare = unescape_model_wrappers(t)
-            if bare:
-                if cleaned_items:
-                    if cleaned_items[-1].endswith((',', ';', ':')):
-                        cleaned_items[-1] = cleaned_items[-1] + " " + bare
-                    else:
-                        cleaned_items[-1] = cleaned_items[-1] + ", " + bare
-                else:
-                    cleaned_items.append(bare)
+    Repairs doubled quotes (""x""), escaped wrappers ("\\"x\\""), unquoted
+    tokens (joined to the previous item), curly quotes and a missing
+    closing bracket, and returns Python objects directly. Every step is a
+    single left-to-right pass, so long or pathological output stays linear.
+    Output without any key arrays is handed to json.loads after the quote
+    repairs, which raises json.JSONDecodeError if it is still invalid.
+    """
+    s = _normalize_model_quotes((text or "").strip())
 
-        final_items = []
-        for it in cleaned_items:
-            x = re.sub(r'\s+', ' ', it).strip()
-            x = x.replace('\u201c', '"').replace('\u201d', '"')
-            final_items.append(x)
+    keys = [(m.group(1), m.end() - 1) for m in _QUOTED_KEY_RE.finditer(s)]
+    if not keys:
+        keys = [(m.group(1), m.end() - 1) for m in _BARE_KEY_RE.finditer(s)]
+    if not keys:
+        return json.loads(_unwrap_escaped_quotes(_collapse_doubled_quotes(s)))
 
-        result[key] = final_items
-
-    if not result:
-        s = re.sub(r'""([^"]*?)""', r'"\1"', s)
-        s = re.sub(r'"\\\"(.*?)\\\""', r'"\1"', s)
-        return s
-
-    return json.dumps(result, ensure_ascii=False)
+    result = {}
+    for key, bracket in keys:
+        result[key] = _clean_array_items(_array_tokens(s, bracket))
+    return result
 
-def build_extraction_prompt(text):
-    """Build DSM-5 extraction prompt"""
+def build_extraction_prompt(text, packed=False):
+    """Build DSM-5 extraction prompt; packed text holds several '--- name ---' documents"""
+    subject = "these clinical documents (each starts with a '--- name ---' line)" if packed else "this clinical document"
     return f"""You must respond with ONLY a JSON object. No explanations. No markdown.
 
-TASK: Extract EXACT word-for-word quotes from this clinical document for autism assessment.
+TASK: Extract EXACT word-for-word quotes from {subject} for autism assessment.
 
 CRITICAL INSTRUCTION: You MUST extract BOTH types of evidence:
 1. Evidence that a feature IS PRESENT (supports ASD)
@@ -756,7 +1519,7 @@ E - DIFFERENTIAL DIAGNOSIS
 3. Extract ALL relevant quotes - do not limit
 4. "Explicitly absent" statements ARE evidence - extract them
 
-=== DOCUMENT ===
+=== {'DOCUMENTS' if packed else 'DOCUMENT'} ===
 {text}
 
 Return ONLY this JSON with actual quotes:
@@ -765,6 +1528,192 @@ Return ONLY this JSON with actual quotes:
 Each array contains simple quote strings only - no objects, no source field.
 Empty array [] if no relevant quotes. Extract comprehensively."""
 
+def build_stage1_prompt(text):
+    """Build two-stage quote extraction prompt"""
+    return f"""You must respond with ONLY a JSON object. No other text.
+
+Extract all sentences related to autism assessment from this document.
+
+Categories:
+- social: social interaction, engagement, relationships
+- communication: language, speech, gestures, pointing
+- repetitive: repetitive movements, stereotypies, routines
+- sensory: sensory responses, pain sensitivity
+- development: developmental milestones, early concerns
+
+Document:
+{text}
+
+Respond with ONLY this JSON filled with quotes:
+{{"social":[],"communication":[],"repetitive":[],"sensory":[],"development":[]}}"""
+
+DSM5_CRITERIA = ['A1', 'A2', 'A3', 'B1', 'B2', 'B3', 'B4', 'C', 'D', 'E']
+
+# Stage-1 category -> the DSM-5 criteria its quotes usually belong to
+STAGE1_CRITERIA_HINTS = {
+    'social': ['A1', 'A3'],
+    'communication': ['A1', 'A2'],
+    'repetitive': ['B1', 'B2', 'B3'],
+    'sensory': ['B4'],
+    'development': ['C'],
+}
+
+def stage2_batches(quotes, batch_size):
+    """Split quotes into Stage 2 batches, keeping quotes of one stage-1 category together"""
+    order = {category: i for i, category in enumerate(STAGE1_CRITERIA_HINTS)}
+    ordered = sorted(quotes, key=lambda q: order.get(q.get('category'), len(order)))
+    batch_size = max(1, batch_size)
+    return [ordered[i:i + batch_size] for i in range(0, len(ordered), batch_size)]
+
+def build_stage2_prompt(quotes):
+    """Build two-stage categorization prompt for one batch of quotes"""
+    lines = []
+    for q in quotes:
+        line = f'"{q["text"]}" [{", ".join(q["sources"])}]'
+        hint = STAGE1_CRITERIA_HINTS.get(q.get('category'))
+        if hint:
+            line += f' (likely {"/".join(hint)})'
+        lines.append(line)
+    quotes_text = "\n".join(lines)
+    template = json.dumps({crit: {'supporting': [], 'contradicting': []} for crit in DSM5_CRITERIA},
+                          separators=(',', ':'))
+
+    return f"""You must respond with ONLY a JSON object. No other text.
+
+Categorize these clinical quotes into DSM-5 autism criteria.
+
+CRITERIA:
+A1 = Social reciprocity: back-and-forth interaction, responding to name, sharing enjoyment
+A2 = Nonverbal: eye contact, gestures, pointing, facial expressions
+A3 = Relationships: peer interest, friendships, imaginative play
+B1 = Repetitive: stereotyped movements (rocking, flapping, toe walking), echolalia
+B2 = Routines: insistence on sameness, distress at changes
+B3 = Interests: restricted intense interests, fixations
+B4 = Sensory: over/under-reactive to sensory input
+C = Early onset: symptoms in early developmental period
+D = Impact: functional impairment
+E = Rule-outs: hearing/cognitive testing
+
+RULES:
+- "supporting" = quote shows the autism feature IS present
+- "contradicting" = quote shows the feature is NOT present or is typical
+- "(likely ...)" is a first-pass guess; use whichever criteria the quote actually fits
+- Include source document in brackets
+
+QUOTES:
+{quotes_text}
+
+Respond with ONLY this JSON:
+{template}"""
+
+def merge_stage2_results(results):
+    """Merge Stage 2 evidence from several batches, dropping repeated quotes per criterion"""
+    merged = {crit: {'supporting': [], 'contradicting': []} for crit in DSM5_CRITERIA}
+    seen = set()
+    for result in results:
+        for crit, lists in result.items():
+            if not isinstance(lists, dict):
+                continue
+            entry = merged.setdefault(crit, {'supporting': [], 'contradicting': []})
+            for kind in ('supporting', 'contradicting'):
+                for quote in lists.get(kind) or []:
+                    if not isinstance(quote, str):
+                        continue
+                    key = (crit, kind, normalize_quote(quote))
+                    if key not in seen:
+                        seen.add(key)
+                        entry[kind].append(quote)
+    return merged
+
+FUNCTIONAL_DOMAINS = ['strengths', 'medical', 'cognitive', 'speech', 'motor', 'social', 'emotional', 'attention',
+                      'adaptive', 'background']
+
+def extract_functional_map_reduce(calls, cache, backend):
+    """Functional domains from each packed call in parallel, merged by one reduce call.
+
+    Returns (domains or None if every call failed, per-document statuses).
+    Up to FUNCTIONAL_MAP_PARALLEL calls run at once, so the map takes about
+    as long as the largest document. The reduce call only sees domains that
+    more than one call filled, as short summaries, so it stays cheap
+    whatever the size of the case; a domain found once is taken as is.
+    """
+    results = [None] * len(calls)
+    mapped = iter_parallel(
+        lambda call: timed('functional_map', call_llm, build_functional_prompt(call['text']),
+                           timeout=120, cache=cache, backend=backend),
+        calls, FUNCTIONAL_MAP_PARALLEL, timeout=fanout_timeout(len(calls), FUNCTIONAL_MAP_PARALLEL, 120))
+    for index, result, error in mapped:
+        results[index] = (result, error)
+
+    doc_status = []
+    findings = {domain: [] for domain in FUNCTIONAL_DOMAINS}  # domain -> [(sources, summary)]
+    for call, (result, error) in zip(calls, results):
+        sources = ', '.join(dict.fromkeys(m['source'] or 'Document' for m in call['members']))
+        statuses = [{'source': m['source'], 'part': m['part'], 'status': 'ok'} for m in call['members']]
+        doc_status.extend(statuses)
+        try:
+            if error:
+                raise error
+            partial = parse_llm_object(result)
+            if not isinstance(partial, dict):
+                raise ValueError('No valid JSON in response')
+        except Exception as e:
+            print(f"[Functional] {sources} failed: {e}")
+            for status in statuses:
+                status.update(status='error', error=str(e) or type(e).__name__)
+            continue
+        for domain in FUNCTIONAL_DOMAINS:
+            summary = partial.get(domain)
+            if isinstance(summary, str) and summary.strip():
+                findings[domain].append((sources, summary.strip()))
+
+    if all(status['status'] == 'error' for status in doc_status):
+        return None, doc_status
+
+    merged = {domain: found[0][1] if len(found) == 1 else '' for domain, found in findings.items()}
+    to_merge = {domain: found for domain, found in findings.items() if len(found) > 1}
+    print(f"[Functional] Map: {len(calls)} calls; reduce: {len(to_merge)} domains found in several documents")
+    if not to_merge:
+        return merged, doc_status
+
+    prompt = build_functional_merge_prompt(to_merge)
+    summary_tokens = sum(estimate_tokens(summary) for found in to_merge.values() for _, summary in found)
+    try:
+        result = timed('functional_reduce', call_llm, prompt, timeout=90,
+                       max_tokens=max(500, min(2000, summary_tokens)), cache=cache, backend=backend)
+        reduced = parse_llm_object(result)
+        if not isinstance(reduced, dict):
+            raise ValueError('No valid JSON in response')
+    except Exception as e:
+        print(f"[Functional] Reduce failed ({e}), joining summaries instead")
+        reduced = {}
+    for domain, found in to_merge.items():
+        summary = reduced.get(domain)
+        if isinstance(summary, str) and summary.strip():
+            merged[domain] = summary.strip()
+        else:
+            merged[domain] = ' '.join(dict.fromkeys(summary for _, summary in found))
+    return merged, doc_status
+
+def build_functional_merge_prompt(findings):
+    """Reduce prompt merging per-document functional summaries, {domain: [(sources, summary)]}"""
+    sections = '\n\n'.join(f"{domain}:\n" + '\n'.join(f"- [{sources}] {summary}" for sources, summary in found)
+                            for domain, found in findings.items())
+    fields = ',\n'.join(f'  "{domain}": "Merged summary..."' for domain in findings)
+    return f"""You must respond with ONLY a JSON object. No explanations. No markdown. Just JSON.
+
+Below are functional assessment summaries written separately for each clinical document of one case.
+For each domain, merge its summaries into one: combine the findings, remove repetition, keep specific
+details (ages, scores, named tools and services) and note where documents disagree. Do not add
+anything that is not in the summaries.
+
+{sections}
+
+Respond with ONLY this JSON structure:
+{{
+{fields}
+}}"""
+
 def build_functional_prompt(text):
     """Build functional assessment extraction prompt"""
     return f"""You must respond with ONLY a JSON object. No explanations. No markdown. Just JSON.
@@ -803,53 +1752,31 @@ Respond with ONLY this JSON structure:
 
 If no information is found for a domain, use an empty string ""."""
 
-def build_report_prompt(report_type, client_info, evidence, functional, diagnostic, case_note, documents=None):
-    """Build audience-specific report prompt"""
-    documents = documents or {}
-    name = client_info.get('name', '[Name]')
-    age = client_info.get('age', '')
-    pronouns = client_info.get('pronouns', 'they/them')
-
-    functional_summary = "\n".join([f"- {k}: {v[:200]}..." if len(str(v)) > 200 else f"- {k}: {v}"
-                                    for k, v in functional.items() if v])
-
-    # Format evidence for report
-    evidence_text = ""
-    for criterion, data in evidence.items():
-        if isinstance(data, dict) and 'quotes' in data:
-            quotes = data['quotes']
-        elif isinstance(data, list):
-            quotes = data
-        else:
-            continue
-
-        if quotes:
-            quote_list = ", ".join([f'"{q}"' if isinstance(q, str) else f'"{q.get("text", "")}"' for q in quotes[:5]])
-            evidence_text += f"- {criterion}: {quote_list}\n"
-
-    diagnosis_met = diagnostic.get('asdMet', False)
-    severity = diagnostic.get('severityLevel', 'Level 1')
-
-    base_context = f"""CLIENT: {name}, Age {age}
-PRONOUNS: {pronouns}
-DIAGNOSIS: {'ASD confirmed' if diagnosis_met else 'ASD not confirmed'} - {severity}
-
-EXTRACTED EVIDENCE:
-{evidence_text}
-
-FUNCTIONAL SUMMARY:
-{functional_summary}
-
-CASE NOTE EXCERPT:
-{case_note[:2000]}"""
+def build_report_prompt(report_type, context, backend):
+    """Build audience-specific report prompts; returns [(prompt, max_tokens), ...].
+
+    There is one prompt for the whole report, or for REPORT_SECTIONAL_TYPES
+    one per template section (see build_section_prompts). max_tokens is
+    sized from the template (see report_output_tokens) and the documents
+    get whatever of the backend's context window the rest of the prompt
+    and the completion leave (see report_doc_budget), shared by relevance
+    to the audience (see format_documents).
+    """
+    docs_slot = '\x00documents\x00'  # filled once the rest of the prompt is measured
+    name, age, pronouns = context.name, context.age, context.pronouns
+    diagnosis_met, severity = context.diagnosis_met, context.severity
+
+    def fill_template(template_name, *name_slots):
+        # Pre-fill the child's name into its template slots when we actually know it
+        values = {slot: name for slot in name_slots} if context.client_info.get('name') else None
+        return templates.render(template_name, values)
 
     if report_type == 'caregiver':
-        caregiver_template = get_caregiver_template()
-        docs_text = ""
-        for doc_name, doc_content in documents.items():
-            docs_text += f"\n--- {doc_name} ---\n{doc_content[:6000]}\n"
+        template_name = 'caregiver_template'
+        caregiver_template = template_text = fill_template(template_name, 'Name')
+        docs_text = docs_slot
 
-        return f"""Fill in this caregiver report template using the clinical documents provided.
+        prompt = f"""Fill in this caregiver report template using the clinical documents provided.
 
 CHILD: {name}
 AGE: {age}
@@ -873,12 +1800,11 @@ DIAGNOSIS: {'ASD confirmed' if diagnosis_met else 'ASD not confirmed'} - {severi
 Write the complete filled-in Caregiver Report now in Markdown format:"""
 
     elif report_type == 'teacher':
-        teacher_template = get_teacher_template()
-        docs_text = ""
-        for doc_name, doc_content in documents.items():
-            docs_text += f"\n--- {doc_name} ---\n{doc_content[:4000]}\n"
+        template_name = 'teacher_letter_template'
+        teacher_template = template_text = fill_template(template_name, 'Student Name')
+        docs_text = docs_slot
 
-        return f"""Fill in this teacher letter template using the clinical reports provided.
+        prompt = f"""Fill in this teacher letter template using the clinical reports provided.
 
 STUDENT: {name}
 AGE: {age}
@@ -895,12 +1821,11 @@ DIAGNOSIS: {'ASD confirmed' if diagnosis_met else 'ASD not confirmed'} - {severi
 Output the completed letter:"""
 
     elif report_type == 'gp':
-        gp_template = get_gp_template()
-        docs_text = ""
-        for doc_name, doc_content in documents.items():
-            docs_text += f"\n--- {doc_name} ---\n{doc_content[:4000]}\n"
+        template_name = 'gp_letter_template'
+        gp_template = template_text = fill_template(template_name, 'Client Name', 'Child/Client Name')
+        docs_text = docs_slot
 
-        return f"""Fill in this GP letter template using the clinical reports provided.
+        prompt = f"""Fill in this GP letter template using the clinical reports provided.
 
 PATIENT: {name}
 AGE: {age}
@@ -917,12 +1842,11 @@ DIAGNOSIS: {'ASD confirmed' if diagnosis_met else 'ASD not confirmed'} - {severi
 Output the completed letter:"""
 
     elif report_type == 'ndis':
-        ndis_template = get_ndis_template()
-        docs_text = ""
-        for doc_name, doc_content in documents.items():
-            docs_text += f"\n--- {doc_name} ---\n{doc_content[:6000]}\n"
+        template_name = 'ndis_template'
+        ndis_template = template_text = fill_template(template_name, 'Name')
+        docs_text = docs_slot
 
-        return f"""Fill in this NDIS Supporting Evidence template using the clinical documents provided.
+        prompt = f"""Fill in this NDIS Supporting Evidence template using the clinical documents provided.
 
 CHILD: {name}
 AGE: {age}
@@ -938,130 +1862,2839 @@ DIAGNOSIS: {'ASD confirmed' if diagnosis_met else 'ASD not confirmed'} - {severi
 Write the complete filled-in NDIS Supporting Evidence Report now in Markdown format:"""
 
     else:
-        return f"Generate a summary report for {name}."
-
-def get_gp_template():
-    """Load GP letter template"""
-    template_path = os.path.join(os.path.dirname(__file__), 'templates', 'gp_letter_template.md')
-    if os.path.exists(template_path):
-        try:
-            with open(template_path, 'r') as f:
-                return f.read()
-        except Exception as e:
-            print(f"[Template] Error loading GP template: {e}")
+        return [(f"Generate a summary report for {name}.", 2000)]
+
+    if report_type in REPORT_SECTIONAL_TYPES:
+        sections = split_sections(template_text)
+        if len(sections) > 1:
+            return build_section_prompts(report_type, sections, context, backend)
+
+    template = templates.get(template_name)
+    max_tokens = report_output_tokens(template.text, len(template.headings))
+    fixed_tokens = estimate_tokens(prompt.replace(docs_slot, ''))
+    doc_budget = report_doc_budget(backend, max_tokens, fixed_tokens, REPORT_DOC_TOKENS)
+    docs_text = format_documents(context.documents, doc_budget, report_type, scanned=context.scanned)
+    warn_trimmed_documents(context, doc_budget, report_type)
+    print(f"[Report] Plan: {fixed_tokens} prompt + {estimate_tokens(docs_text)}/{doc_budget} document tokens, "
+          f"max_tokens {max_tokens} for {len(template.headings)} sections")
+    return [(prompt.replace(docs_slot, docs_text), max_tokens)]
+
+def report_doc_budget(backend, max_tokens, fixed_tokens, cap=0):
+    """Document tokens that fit the backend's context window beside the rest of the prompt and the completion"""
+    budget = max(0, (REPORT_CONTEXT_TOKENS or backend.context_tokens) - max_tokens - fixed_tokens)
+    return min(budget, cap) if cap else budget
+
+def warn_trimmed_documents(context, doc_budget, report_type):
+    total = sum(estimate_tokens(text) for text in context.documents.values())
+    if total > doc_budget:
+        print(f"[Report] Warning: {report_type} documents trimmed to {doc_budget} of {total} tokens, "
+              f"keeping the most relevant excerpts")
+        metrics.inc('aurum_report_documents_trimmed_total', type=report_type)
+
+class ReportContext:
+    """What every report prompt for one case shares, prepared once per request.
+
+    Holds the client header, evidence and functional summaries, and each
+    document's lowercased text and REPORT_RELEVANCE_MATCHER hits, so
+    generating several report types formats and scans the case only once.
+    """
+
+    def __init__(self, client_info, evidence, functional, diagnostic, case_note, documents):
+        self.client_info = client_info
+        self.evidence = evidence
+        self.case_note = case_note
+        self.documents = documents or {}
+        self.name = client_info.get('name', '[Name]')
+        self.age = client_info.get('age', '')
+        self.pronouns = client_info.get('pronouns', 'they/them')
+        self.diagnosis_met = diagnostic.get('asdMet', False)
+        self.severity = diagnostic.get('severityLevel', 'Level 1')
+        self.client_header = f"""CHILD: {self.name}
+AGE: {self.age}
+PRONOUNS: {self.pronouns}
+DIAGNOSIS: {'ASD confirmed' if self.diagnosis_met else 'ASD not confirmed'} - {self.severity}"""
+
+        self.functional_summary = "\n".join([f"- {k}: {v[:200]}..." if len(str(v)) > 200 else f"- {k}: {v}"
+                                             for k, v in functional.items() if v])
+
+        # Format evidence for report
+        self.evidence_text = ""
+        for criterion, data in evidence.items():
+            if isinstance(data, dict) and 'quotes' in data:
+                quotes = data['quotes']
+            elif isinstance(data, list):
+                quotes = data
+            else:
+                continue
 
-    return """**GP Letter Template - Fallback**"""
+            if quotes:
+                quote_list = ", ".join([f'"{q}"' if isinstance(q, str) else f'"{q.get("text", "")}"'
+                                        for q in quotes[:5]])
+                self.evidence_text += f"- {criterion}: {quote_list}\n"
+
+        self.scanned = scan_documents(self.documents)
+
+def report_output_tokens(text, sections, floor=1000):
+    """Completion budget for filling template text: REPORT_OUTPUT_RATIO times its length plus an allowance per section.
+
+    A completion that still hits the budget is regenerated once at
+    REPORT_MAX_TOKENS (see complete_report_part).
+    """
+    tokens = int(estimate_tokens(text) * REPORT_OUTPUT_RATIO) + sections * REPORT_SECTION_TOKENS
+    return max(floor, min(REPORT_MAX_TOKENS, tokens))
+
+REPORT_TITLES = {'caregiver': 'Caregiver Report', 'ndis': 'NDIS Supporting Evidence Report',
+                 'teacher': 'teacher letter', 'gp': 'GP letter'}
+
+SECTION_INSTRUCTIONS = {
+    'caregiver': """- Use warm, supportive, plain language - no clinical jargon
+- Use neurodiversity-affirming language (differences not deficits)
+- If information is not in the documents, write "[To be discussed with family]" - do not invent""",
+    'ndis': """- Describe functional impact in concrete, everyday terms for NDIS planners
+- If information is not in the documents, write "[To be confirmed by clinician]" - do not invent""",
+}
+
+# Sections that draw on the extracted DSM-5 evidence or the functional assessment
+_CRITERIA_SECTION_RE = re.compile(r'DSM|criteri|diagnos', re.IGNORECASE)
+_FUNCTIONAL_SECTION_RE = re.compile(r'function|daily living|self-care|communication|sensory|support|goal',
+                                    re.IGNORECASE)
+_SECTION_WORD_RE = re.compile(r'[a-z][a-z-]{4,}')
+_SECTION_STOPWORDS = {'about', 'other', 'their', 'there', 'these', 'which', 'where', 'would', 'should', 'could',
+                      'include', 'including', 'describe', 'example', 'information', 'report', 'section', 'based',
+                      'relevant', 'specific', 'provide', 'details', 'name'}
+
+def section_matcher(section):
+    """KeywordMatcher for the most frequent distinctive words of a template section"""
+    words = [w for w in _SECTION_WORD_RE.findall(section.lower()) if w not in _SECTION_STOPWORDS]
+    common = [w for w, _ in Counter(words).most_common(25)]
+    return KeywordMatcher({'section': common}) if common else None
+
+def build_section_prompts(report_type, sections, context, backend):
+    """One (prompt, max_tokens) per template section, each with the excerpts most relevant to it"""
+    docs_slot = '\x00documents\x00'
+    parts = []
+    budgets = []
+    for section in sections:
+        extras = ''
+        if context.evidence_text and _CRITERIA_SECTION_RE.search(section):
+            extras += f"\n=== EXTRACTED DSM-5 EVIDENCE ===\n{context.evidence_text}"
+        if context.functional_summary and _FUNCTIONAL_SECTION_RE.search(section):
+            extras += f"\n=== FUNCTIONAL SUMMARY ===\n{context.functional_summary}\n"
+        prompt = f"""Write ONE section of a {REPORT_TITLES[report_type]} using the clinical documents provided. The other sections are written separately, so output only this section.
+
+{context.client_header}
+
+=== ORIGINAL CLINICAL DOCUMENTS (excerpts relevant to this section) ===
+{docs_slot}
+{extras}
+=== SECTION TEMPLATE ===
+{section.strip()}
+=== END SECTION ===
 
-def get_teacher_template():
-    """Load teacher letter template"""
-    template_path = os.path.join(os.path.dirname(__file__), 'templates', 'teacher_letter_template.md')
-    if os.path.exists(template_path):
+=== INSTRUCTIONS ===
+- Fill in every placeholder using actual information from the documents
+{SECTION_INSTRUCTIONS.get(report_type, '')}
+- Keep the section's headings and layout, and do not write any other section
+
+Write the completed section now in Markdown, starting with its heading:"""
+        max_tokens = report_output_tokens(section, len(find_headings(section)), floor=800)
+        fixed_tokens = estimate_tokens(prompt.replace(docs_slot, ''))
+        doc_budget = report_doc_budget(backend, max_tokens, fixed_tokens, REPORT_SECTION_DOC_TOKENS)
+        docs_text = format_documents(context.documents, doc_budget, report_type, section_matcher(section),
+                                     context.scanned)
+        parts.append((prompt.replace(docs_slot, docs_text), max_tokens))
+        budgets.append(doc_budget)
+    warn_trimmed_documents(context, min(budgets), report_type)
+    print(f"[Report] Plan: {len(parts)} sections of {report_type}, max_tokens "
+          f"{[max_tokens for _, max_tokens in parts]}")
+    return parts
+
+def call_llm(prompt, timeout=120, max_tokens=2000, cache='off', backend=None, raise_truncated=False,
+             slot_timeout=None):
+    """Run a chat completion and return its content.
+
+    backend: an LLMBackend (see llm_backend); defaults to LLM_BACKEND.
+    cache: 'use' reads and fills the LLM response cache, 'refresh' skips
+    the read but stores the new response, 'off' bypasses it entirely.
+    Provider calls go through the backend's LLMGuard (retries, hedging,
+    circuit breaker), all within timeout seconds. Waiting for a free LLM
+    slot is bounded separately by slot_timeout (default: timeout). A
+    completion cut off at max_tokens is returned as is, or with
+    raise_truncated raises TruncatedError and is not cached.
+    """
+    backend = backend or make_backend(LLM_BACKEND)
+    key = llm_cache.make_key(backend.cache_id, prompt, max_tokens)
+    if cache == 'use':
+        cached = llm_cache.get(key)
+        if cached is not None:
+            return cached
+
+    # Process-wide cap on in-flight provider calls, shared by all requests
+    slot_timeout = timeout if slot_timeout is None else slot_timeout
+    if not _llm_slots.acquire(timeout=slot_timeout):
+        metrics.inc('aurum_timeouts_total', where='llm_slot')
+        raise TimeoutError(f"no LLM slot free after {slot_timeout}s")
+    metrics.add('aurum_llm_inflight', 1, backend=backend.name)
+    start = time.time()
+    outcome = 'error'
+    usage = content = None
+    truncated = False
+    try:
+        content, usage, truncated = llm_guard(backend).call(
+            lambda remaining: backend.complete(prompt, max_tokens, remaining), max_tokens, timeout)
+        outcome = 'ok'
+    except CircuitOpenError:
+        outcome = 'rejected'
+        raise
+    except TimeoutError:
+        outcome = 'timeout'
+        raise
+    finally:
+        _llm_slots.release()
+        metrics.add('aurum_llm_inflight', -1, backend=backend.name)
+        record_llm_call(backend, outcome, time.time() - start, prompt, content, usage, max_tokens, truncated)
+
+    if truncated and raise_truncated:
+        raise TruncatedError(content, max_tokens)
+    if cache in ('use', 'refresh'):
+        llm_cache.put(key, content)
+    return content
+
+def stream_llm(prompt, timeout=120, max_tokens=2000, cache='off', backend=None, raise_truncated=False,
+               slot_timeout=None):
+    """Stream a chat completion, yielding content deltas.
+
+    Closing the generator early closes the upstream connection. Slot
+    waiting is bounded as in call_llm. With raise_truncated, a completion cut off at max_tokens raises
+    TruncatedError after its last delta and is not cached.
+    """
+    backend = backend or make_backend(LLM_BACKEND)
+    key = llm_cache.make_key(backend.cache_id, prompt, max_tokens)
+    if cache == 'use':
+        cached = llm_cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+    slot_timeout = timeout if slot_timeout is None else slot_timeout
+    if not _llm_slots.acquire(timeout=slot_timeout):
+        metrics.inc('aurum_timeouts_total', where='llm_slot')
+        raise TimeoutError(f"no LLM slot free after {slot_timeout}s")
+    metrics.add('aurum_llm_inflight', 1, backend=backend.name)
+    start = time.time()
+    outcome = 'error'
+    parts = []
+    truncated = False
+    try:
+        first, deltas = llm_guard(backend).open_stream(
+            lambda remaining: backend.stream(prompt, max_tokens, remaining), timeout)
         try:
-            with open(template_path, 'r') as f:
-                return f.read()
-        except Exception as e:
-            print(f"[Template] Error loading teacher template: {e}")
-
-    return """**Teacher Letter Template - Fallback**"""
+            for delta in itertools.chain([first], deltas):
+                if delta is LENGTH_LIMIT:
+                    truncated = True
+                elif delta is not None:
+                    parts.append(delta)
+                    yield delta
+        finally:
+            deltas.close()
+        outcome = 'ok'
+    except CircuitOpenError:
+        outcome = 'rejected'
+        raise
+    except TimeoutError:
+        outcome = 'timeout'
+        raise
+    except GeneratorExit:
+        outcome = 'cancelled'
+        raise
+    finally:
+        _llm_slots.release()
+        metrics.add('aurum_llm_inflight', -1, backend=backend.name)
+        record_llm_call(backend, outcome, time.time() - start, prompt, ''.join(parts), None, max_tokens, truncated)
+
+    if truncated and raise_truncated:
+        raise TruncatedError(''.join(parts), max_tokens)
+    if cache in ('use', 'refresh'):
+        llm_cache.put(key, ''.join(parts))
+
+def stream_stage1_quotes(chunk, cache, source_index, backend=None):
+    """Run Stage 1 on one chunk as a stream, verifying each quote as soon as it closes.
+
+    A completion cut off at max_tokens still yields every quote that closed.
+    """
+    stream = JSONItemStream()
+    quotes = []
+    for delta in stream_llm(build_stage1_prompt(chunk['text']), timeout=120, cache=cache, backend=backend):
+        for path, value in stream.feed(delta):
+            # {"category": ["quote", ...]} -> path (category, index)
+            if len(path) == 2 and isinstance(path[1], int) and isinstance(value, str) and len(value) > 15:
+                quotes.append({
+                    "text": value,
+                    "source": chunk['source'],
+                    "category": path[0],
+                    "verification": source_index.verify(value, prefer=chunk['source'])
+                })
+    return quotes
 
-def get_caregiver_template():
-    """Load caregiver report template"""
-    template_path = os.path.join(os.path.dirname(__file__), 'templates', 'caregiver_template.md')
-    if os.path.exists(template_path):
+def parse_stage2_response(response):
+    """Parse Stage 2 response into evidence dict"""
+    try:
+        data = parse_llm_object(response)
+    except json.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict):
+        return {}
+
+    for crit in data:
+        if not isinstance(data[crit], dict):
+            continue
+        if 'supporting' in data[crit]:
+            data[crit]['supporting'] = list(dict.fromkeys(data[crit]['supporting']))
+        if 'contradicting' in data[crit]:
+            data[crit]['contradicting'] = list(dict.fromkeys(data[crit]['contradicting']))
+    return data
+
+def parse_llm_object(text, parse=json.loads):
+    """Parse the JSON object in a completion with `parse`, or None if there is none.
+
+    A completion cut off mid-object (e.g. at max_tokens) has no closing
+    brace; it yields every item that closed before the cut instead of failing.
+    """
+    clean = text.replace('```json', '').replace('```', '').strip()
+    start_idx = clean.find('{')
+    if start_idx < 0:
+        return None
+    if not clean.endswith('}'):
+        stream = JSONItemStream()
+        stream.feed(clean[start_idx:])
+        if not stream.complete:
+            print(f"[JSON] Completion truncated, recovered {len(stream.root)} keys")
+            metrics.inc('aurum_json_parse_total', outcome='truncated')
+            return stream.root
+    end_idx = clean.rfind('}') + 1
+    json_str = clean[start_idx:end_idx]
+    try:
+        result = parse(json_str)
+    except json.JSONDecodeError:
+        metrics.inc('aurum_json_parse_total', outcome='failed')
+        raise
+    outcome = 'strict'
+    if parse is not json.loads:
+        # Count how often the lenient parser is actually needed
         try:
-            with open(template_path, 'r') as f:
-                return f.read()
-        except Exception as e:
-            print(f"[Template] Error loading caregiver template: {e}")
-
-    return """**Caregiver Report Template - Fallback**"""
+            json.loads(json_str)
+        except ValueError:
+            outcome = 'repaired'
+    metrics.inc('aurum_json_parse_total', outcome=outcome)
+    return result
+
+# ============== Streaming JSON ==============
+
+_JSON_STRING_RUN_RE = re.compile(r'[^"\\]+')
+_JSON_LITERAL_RE = re.compile(r'[^\s,:\[\]{}"]+')
+
+class JSONItemStream:
+    """Incremental JSON parser for completions that arrive in pieces.
+
+    feed() takes text as it streams in and returns (path, value) for every
+    value that closed in it: strings and literals as soon as their last
+    character arrives, objects and arrays when their bracket closes. path
+    is the tuple of keys and list indices leading to the value, so a Stage 1
+    quote arrives as (("social", 0), "...") and a Stage 2 entry as
+    (("A1", "supporting", 0), "..."). Text before the first bracket (prose,
+    code fences) is skipped. root holds everything that has closed so far,
+    which is what survives a completion cut off at max_tokens; complete is
+    set once the outermost bracket closes, and later text is ignored.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.complete = False
+        self._stack = []       # [container, pending key, path] per open container
+        self._string = None    # raw pieces while inside a string
+        self._escape = False
+        self._literal = ''
+        self._expect_key = False
+
+    def feed(self, text):
+        out = []
+        i, n = 0, len(text)
+        while i < n and not self.complete:
+            if self._string is not None:
+                i = self._scan_string(text, i, out)
+                continue
+            if not self._stack:
+                # Skip to the first bracket
+                starts = [j for j in (text.find('{', i), text.find('[', i)) if j >= 0]
+                if not starts:
+                    break
+                i = min(starts)
+
+            c = text[i]
+            if self._literal or c not in ' \t\r\n,:[]{}"':
+                m = _JSON_LITERAL_RE.match(text, i)
+                if m:
+                    self._literal += m.group()
+                    i = m.end()
+                if i < n:
+                    self._close_literal(out)
+                continue
 
-def get_ndis_template():
-    """Load NDIS template"""
-    template_path = os.path.join(os.path.dirname(__file__), 'templates', 'ndis_template.md')
-    if os.path.exists(template_path):
+            i += 1
+            if c == '"':
+                self._string = []
+            elif c in '{[':
+                container = {} if c == '{' else []
+                path = self._place(container)
+                self._stack.append([container, None, path])
+                self._expect_key = c == '{'
+            elif c in '}]':
+                container, _, path = self._stack.pop()
+                out.append((path, container))
+                self._expect_key = False
+                if not self._stack:
+                    self.complete = True
+            elif c == ':':
+                self._expect_key = False
+            elif c == ',':
+                self._expect_key = isinstance(self._stack[-1][0], dict)
+        return out
+
+    def _scan_string(self, text, i, out):
+        n = len(text)
+        while i < n:
+            if self._escape:
+                self._string.append(text[i])
+                self._escape = False
+                i += 1
+                continue
+            m = _JSON_STRING_RUN_RE.match(text, i)
+            if m:
+                self._string.append(m.group())
+                i = m.end()
+            elif text[i] == '\\':
+                self._string.append('\\')
+                self._escape = True
+                i += 1
+            else:
+                raw = ''.join(self._string)
+                self._string = None
+                try:
+                    value = json.loads('"' + raw + '"', strict=False)
+                except ValueError:
+                    value = raw
+                top = self._stack[-1]
+                if self._expect_key and isinstance(top[0], dict):
+                    top[1] = value
+                else:
+                    out.append((self._place(value), value))
+                return i + 1
+        return i
+
+    def _close_literal(self, out):
+        literal, self._literal = self._literal, ''
+        if self._expect_key:
+            return
         try:
-            with open(template_path, 'r') as f:
-                return f.read()
-        except Exception as e:
-            print(f"[Template] Error loading NDIS template: {e}")
-
-    return """**NDIS Supporting Evidence Template - Fallback**"""
+            value = json.loads(literal)
+        except ValueError:
+            return  # stray bare token
+        out.append((self._place(value), value))
+
+    def _place(self, value):
+        """Attach a value to the open container and return its path"""
+        if not self._stack:
+            self.root = value
+            return ()
+        container, key, path = self._stack[-1]
+        if isinstance(container, list):
+            container.append(value)
+            return path + (len(container) - 1,)
+        if key is None:
+            return path + (None,)  # value without a key, dropped
+        container[key] = value
+        self._stack[-1][1] = None
+        return path + (key,)
+
+# ============== Chunking ==============
+
+CHARS_PER_TOKEN = 4  # rough average for English clinical prose with Llama tokenizers
+
+_SECTION_RE = re.compile(r'\n[ \t]*\n\s*')
+_SENTENCE_RE = re.compile(r'(?<=[.!?;:])\s+|\n')
+
+def estimate_tokens(text):
+    """Cheap token estimate used for all prompt budgeting"""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def _text_units(text, max_chars):
+    """Split text into (start, end) spans on section and sentence boundaries.
+
+    Spans never exceed max_chars; an over-long sentence is cut at the last
+    whitespace that fits.
+    """
+    units = []
+    pos = 0
+    for boundary in _SECTION_RE.finditer(text + '\n\n'):
+        section_end = min(boundary.start(), len(text))
+        sentence_start = pos
+        for m in _SENTENCE_RE.finditer(text, pos, section_end):
+            if m.start() > sentence_start:
+                units.append((sentence_start, m.start()))
+            sentence_start = m.end()
+        if section_end > sentence_start:
+            units.append((sentence_start, section_end))
+        pos = boundary.end()
+
+    spans = []
+    for start, end in units:
+        while end - start > max_chars:
+            cut = text.rfind(' ', start + 1, start + max_chars)
+            if cut <= start:
+                cut = start + max_chars
+            spans.append((start, cut))
+            start = cut
+            while start < end and text[start].isspace():
+                start += 1
+        if end > start:
+            spans.append((start, end))
+    return spans
+
+def chunk_text(text, max_tokens, overlap_tokens=0):
+    """Split text into token-budgeted chunks that end on sentence/section boundaries.
+
+    Consecutive chunks share up to overlap_tokens of trailing sentences so a
+    quote that straddles a boundary is seen whole at least once. Each chunk
+    is a dict with the exact source slice and its character offsets.
+    """
+    max_chars = max(1, max_tokens * CHARS_PER_TOKEN)
+    overlap_chars = overlap_tokens * CHARS_PER_TOKEN
+    units = _text_units(text, max_chars)
+    if not units:
+        return []
+
+    chunks = []
+    i = 0
+    while i < len(units):
+        start = units[i][0]
+        j = i + 1
+        while j < len(units) and units[j][1] - start <= max_chars:
+            j += 1
+        end = units[j - 1][1]
+        chunks.append({'text': text[start:end], 'start': start, 'end': end})
+        if j >= len(units):
+            break
+        # Step back over trailing units that fit in the overlap window
+        k = j
+        while k - 1 > i and end - units[k - 1][0] <= overlap_chars:
+            k -= 1
+        i = k
+    return chunks
+
+def chunk_documents(docs, max_tokens, overlap_tokens=0):
+    """Chunk (name, text) pairs into a flat list tagged with source and part"""
+    chunks = []
+    for doc_name, doc_text in docs:
+        parts = chunk_text(doc_text, max_tokens, overlap_tokens)
+        for n, chunk in enumerate(parts, 1):
+            chunk['source'] = doc_name
+            chunk['part'] = f"{n}/{len(parts)}"
+            chunks.append(chunk)
+    return chunks
+
+def pack_chunks(chunks, pack_tokens, max_doc_tokens=None):
+    """Group chunks into LLM calls: small whole documents share a call, the rest go alone.
+
+    Whole documents of at most max_doc_tokens (default half the budget) are
+    bin-packed first-fit decreasing into calls of at most pack_tokens, each
+    introduced by a '--- name ---' line. Returns {'text', 'members'} calls
+    in document order; members are the chunks a call covers.
+    """
+    if max_doc_tokens is None:
+        max_doc_tokens = pack_tokens // 2
+    calls = []  # (first position, members)
+    small = []
+    for pos, chunk in enumerate(chunks):
+        tokens = estimate_tokens(chunk['text'])
+        if chunk['part'] == '1/1' and tokens <= max_doc_tokens:
+            small.append((tokens, pos, chunk))
+        else:
+            calls.append((pos, [chunk]))
+
+    bins = []  # [tokens, [(position, chunk)]]
+    for tokens, pos, chunk in sorted(small, key=lambda s: (-s[0], s[1])):
+        for b in bins:
+            if b[0] + tokens <= pack_tokens:
+                b[0] += tokens
+                b[1].append((pos, chunk))
+                break
+        else:
+            bins.append([tokens, [(pos, chunk)]])
+    for _, members in bins:
+        members.sort(key=lambda m: m[0])
+        calls.append((members[0][0], [chunk for _, chunk in members]))
+
+    calls.sort(key=lambda c: c[0])
+    return [{'text': members[0]['text'] if len(members) == 1 else
+             '\n\n'.join(f"--- {c['source']} ---\n{c['text']}" for c in members),
+             'members': members}
+            for _, members in calls]
+
+def quote_locator(call):
+    """Map a quote from a call's response back to the member document it came from"""
+    names = [m['source'] for m in call['members']]
+    if len(names) == 1:
+        return lambda quote: names[0]
+    pack_index = SourceIndex({m['source']: m['text'] for m in call['members']})
+    # Quotes the model reworded beyond recognition stay with the first document
+    return lambda quote: pack_index.verify(quote).get('source', names[0])
+
+def truncate_to_tokens(text, max_tokens):
+    """Keep the leading sentences of text that fit within max_tokens"""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    chunks = chunk_text(text, max_tokens)
+    return chunks[0]['text'] if chunks else ''
+
+def allocate_token_budgets(documents, total_tokens, weights=None):
+    """Share a token budget across documents so short ones don't waste it.
+
+    Each document gets a share proportional to its weight (equal by
+    default), and whatever a short document doesn't need is redistributed
+    to the longer ones.
+    """
+    sizes = {name: estimate_tokens(text) for name, text in documents.items()}
+    weights = weights or dict.fromkeys(sizes, 1.0)
+    budgets = {}
+    remaining = total_tokens
+    remaining_weight = sum(weights.values())
+    # Documents that need less than their share go first, freeing budget for the rest
+    for name in sorted(sizes, key=lambda name: sizes[name] / weights[name]):
+        share = int(remaining * weights[name] / remaining_weight) if remaining_weight > 1e-9 else 0
+        budgets[name] = min(sizes[name], share)
+        remaining -= budgets[name]
+        remaining_weight -= weights[name]
+    return budgets
+
+def relevant_excerpt(text, max_tokens, hits):
+    """The passages of text with the most weighted hits that fit in max_tokens, in document order.
+
+    hits is [(position, weight)]. The opening passage, which usually names
+    the child, the author and the assessment, wins ties.
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    passages = chunk_text(text, min(REPORT_PASSAGE_TOKENS, max_tokens))
+    scores = [0.0] * len(passages)
+    starts = [p['start'] for p in passages]
+    for position, weight in hits:
+        i = max(0, bisect.bisect_right(starts, position) - 1)
+        scores[i] += weight
+    if scores:
+        scores[0] += 0.5
+    chosen = []
+    used = 0
+    for i in sorted(range(len(passages)), key=lambda i: (-scores[i], i)):
+        tokens = estimate_tokens(passages[i]['text'])
+        if used + tokens <= max_tokens:
+            chosen.append(i)
+            used += tokens
+    return '\n[...]\n'.join(passages[i]['text'] for i in sorted(chosen))
+
+def scan_documents(documents):
+    """{name: (lowercased text, REPORT_RELEVANCE_MATCHER hits)} for format_documents"""
+    scanned = {}
+    for doc_name, doc_content in documents.items():
+        lowered = doc_content.lower()
+        scanned[doc_name] = (lowered, REPORT_RELEVANCE_MATCHER.scan(lowered))
+    return scanned
+
+def format_documents(documents, total_tokens, report_type=None, matcher=None, scanned=None):
+    """Concatenate documents for a report prompt within a shared token budget.
+
+    Documents that mention more of what the audience cares about (see
+    REPORT_RELEVANCE_MATCHER), or of matcher's 'section' keywords, get a
+    bigger share, and a document that doesn't fit keeps its most relevant
+    passages rather than its opening. scanned is scan_documents(documents),
+    when the caller already has it.
+    """
+    scanned = scanned or scan_documents(documents)
+    hits = {}
+    weights = {}
+    for doc_name, doc_content in documents.items():
+        lowered, found = scanned[doc_name]
+        hits[doc_name] = ([(position, 2.0) for position, _ in found.get(report_type, [])] +
+                          [(position, 1.0) for position, _ in found.get('core', [])])
+        if matcher is not None:
+            hits[doc_name] += [(position, 3.0) for position, _ in matcher.scan(lowered).get('section', [])]
+        # Hits per 100 tokens, on top of a base share every document keeps
+        density = sum(weight for _, weight in hits[doc_name]) * 100 / max(estimate_tokens(doc_content), 1)
+        weights[doc_name] = 1.0 + min(density, 4.0)
+    budgets = allocate_token_budgets(documents, total_tokens, weights)
+    return ''.join(f"\n--- {doc_name} ---\n{relevant_excerpt(doc_content, budgets[doc_name], hits[doc_name])}\n"
+                   for doc_name, doc_content in documents.items() if budgets[doc_name] > 0)
+
+# ============== Quote Deduplication ==============
+
+NEAR_DUP_JACCARD = float(os.environ.get('NEAR_DUP_JACCARD', '0.75'))
+
+_QUOTE_CHARS = str.maketrans({'\u201c': '"', '\u201d': '"', '\u2018': "'", '\u2019': "'", '\u2013': '-', '\u2014': '-'})
+_NON_WORD_RE = re.compile(r'[^\w]+')
+
+# Words that flip or qualify a finding: quotes differing in these are never near-duplicates
+_POLARITY_WORDS = frozenset([
+    'no', 'not', 'never', 'nor', 'neither', 'none', 'nil', 'without', 'cannot', 't', 'denies', 'denied',
+    'absent', 'lack', 'lacks', 'lacking', 'rarely', 'seldom', 'hardly', 'barely', 'unable', 'poor', 'poorly',
+    'good', 'well', 'normal', 'abnormal', 'typical', 'atypical', 'appropriate', 'inappropriate', 'limited',
+    'reduced', 'increased', 'impaired', 'intact',
+])
+
+def normalize_quote(text):
+    """Case, quote-style, punctuation and whitespace-insensitive form of a quote"""
+    return _NON_WORD_RE.sub(' ', text.translate(_QUOTE_CHARS).lower()).strip()
+
+class QuoteIndex:
+    """Deduplicates quotes in linear time, keeping provenance.
+
+    Exact duplicates are found through a hash of the normalized text. Near
+    duplicates (stray or missing words, truncation at chunk edges) are found
+    with MinHash LSH over word unigram and bigram shingles: a one-permutation
+    MinHash signature is split into bands, quotes sharing a band become
+    candidates, and candidates are confirmed by Jaccard similarity. Quotes
+    only collapse within the same group (e.g. DSM-5 criterion), and only
+    when they carry the same negation and polarity words, so "responds to
+    her name" and "never responds to her name" stay apart.
+    """
+
+    BINS = 32  # MinHash signature length
+    ROWS = 4   # signature values per LSH band
+
+    def __init__(self, threshold=NEAR_DUP_JACCARD):
+        self.threshold = threshold
+        self._exact = {}    # (group, normalized) -> entry
+        self._buckets = {}  # (group, polarity words, band index, band values) -> [(shingles, entry)]
+
+    @staticmethod
+    def _shingles(words):
+        return set(words) | {f'{a} {b}' for a, b in zip(words, words[1:])}
+
+    def _bands(self, shingles):
+        """One-permutation MinHash: each shingle hash lands in one bin, keep the min"""
+        bins = self.BINS
+        signature = [None] * bins
+        for h in {hash(sh) for sh in shingles}:
+            b, v = h % bins, h // bins
+            if signature[b] is None or v < signature[b]:
+                signature[b] = v
+        bands = []
+        for i in range(0, bins, self.ROWS):
+            band = tuple(signature[i:i + self.ROWS])
+            if any(v is not None for v in band):
+                bands.append((i, band))
+        return bands
+
+    def add(self, text, source, group=None):
+        """Index a quote; return (entry, is_new).
+
+        entry is the dict kept in results. For a duplicate, the source is
+        appended to entry['sources'] of the quote already indexed.
+        """
+        norm = normalize_quote(text)
+        entry = self._exact.get((group, norm))
+        if entry is None:
+            words = norm.split()
+            polarity = frozenset(w for w in words if w in _POLARITY_WORDS)
+            shingles = self._shingles(words) or {norm}
+            bands = self._bands(shingles)
+            checked = set()
+            for i, band in bands:
+                for other_shingles, other in self._buckets.get((group, polarity, i, band), ()):
+                    if id(other) in checked:
+                        continue
+                    checked.add(id(other))
+                    overlap = len(shingles & other_shingles)
+                    if overlap / (len(shingles) + len(other_shingles) - overlap) >= self.threshold:
+                        entry = other
+                        break
+                if entry is not None:
+                    break
+
+            if entry is None:
+                entry = {"text": text, "source": source, "sources": [source]}
+                self._exact[(group, norm)] = entry
+                for i, band in bands:
+                    self._buckets.setdefault((group, polarity, i, band), []).append((shingles, entry))
+                return entry, True
+            self._exact[(group, norm)] = entry
+
+        if source not in entry["sources"]:
+            entry["sources"].append(source)
+        return entry, False
+
+# ============== Quote Verification ==============
+
+FUZZY_QUOTE_MIN_SCORE = float(os.environ.get('FUZZY_QUOTE_MIN_SCORE', '0.5'))
+
+_WORD_RE = re.compile(r'\w+')
+
+class SourceIndex:
+    """Word n-gram index over a case's documents for verifying quotes.
+
+    Built once per request. Each document is tokenized into lowercase word
+    tokens that remember their character offsets in the original text, so
+    whitespace, punctuation and quote-style differences are ignored. A
+    trigram -> positions index lets each quote be checked against only the
+    places its rarest trigram occurs, instead of scanning every document.
+    """
+
+    N = 3
+
+    def __init__(self, documents):
+        self.names = []
+        self.tokens = []  # per document: list of lowercase words
+        self.spans = []   # per document: list of (start, end) offsets
+        self.index = {}   # n-gram -> [(doc id, token position)]
+        for doc_id, (name, text) in enumerate(documents.items()):
+            words = []
+            spans = []
+            for m in _WORD_RE.finditer(text):
+                words.append(m.group().lower())
+                spans.append(m.span())
+            self.names.append(name)
+            self.tokens.append(words)
+            self.spans.append(spans)
+            # Trigrams anchor normal quotes; unigrams cover one- and two-word ones
+            for n in (1, self.N):
+                for i in range(len(words) - n + 1):
+                    self.index.setdefault(tuple(words[i:i + n]), []).append((doc_id, i))
+
+    def verify(self, quote, prefer=None):
+        """Classify a quote as verbatim, fuzzy or hallucinated.
+
+        Returns a dict with the status, a 0-1 score and, when found, the
+        document name and character offsets of the match.
+        """
+        words = [w.lower() for w in _WORD_RE.findall(quote)]
+        if not words:
+            return {'status': 'hallucinated', 'score': 0.0}
+        n = self.N if len(words) >= self.N else 1
+        grams_postings = [(qi, self.index.get(tuple(words[qi:qi + n]), ()))
+                          for qi in range(len(words) - n + 1)]
+
+        # Exact: anchor on the rarest n-gram and compare the token run
+        qi, postings = min(grams_postings, key=lambda gp: len(gp[1]))
+        best = None
+        for doc_id, pos in postings:
+            start = pos - qi
+            if start >= 0 and self.tokens[doc_id][start:start + len(words)] == words:
+                best = (doc_id, start)
+                if prefer is None or self.names[doc_id] == prefer:
+                    break
+        if best is not None:
+            return self._match('verbatim', 1.0, best[0], best[1], best[1] + len(words))
+
+        # Fuzzy: vote for the alignment (document, quote start) most n-grams agree on
+        if n < self.N:
+            return {'status': 'hallucinated', 'score': 0.0}
+        votes = {}
+        for qi, postings in grams_postings:
+            if len(postings) > 1000:
+                continue  # boilerplate n-gram, carries no alignment signal
+            for doc_id, pos in postings:
+                key = (doc_id, (pos - qi) // 4)
+                votes[key] = votes.get(key, 0) + 1
+        if votes:
+            (doc_id, bucket), count = max(votes.items(), key=lambda kv: kv[1])
+            score = count / len(grams_postings)
+            if score >= FUZZY_QUOTE_MIN_SCORE:
+                matched = [pos for qi, postings in grams_postings for d, pos in postings
+                           if d == doc_id and (pos - qi) // 4 == bucket]
+                return self._match('fuzzy', round(score, 3), doc_id, min(matched), max(matched) + n)
+            return {'status': 'hallucinated', 'score': round(score, 3)}
+        return {'status': 'hallucinated', 'score': 0.0}
+
+    def _match(self, status, score, doc_id, first, last):
+        spans = self.spans[doc_id]
+        last = min(last, len(spans))
+        return {'status': status, 'score': score, 'source': self.names[doc_id],
+                'start': spans[first][0], 'end': spans[last - 1][1]}
+
+def verify_quotes(documents, quotes):
+    """Annotate quote dicts in place with a 'verification' result; return status counts.
+
+    documents may be a prebuilt SourceIndex; quotes verified earlier keep their result.
+    """
+    start = time.time()
+    source_index = documents if isinstance(documents, SourceIndex) else SourceIndex(documents)
+    counts = {'verbatim': 0, 'fuzzy': 0, 'hallucinated': 0}
+    for q in quotes:
+        if 'verification' not in q:
+            q['verification'] = source_index.verify(q['text'], prefer=q.get('source'))
+        counts[q['verification']['status']] += 1
+    print(f"[Verify] {len(quotes)} quotes in {(time.time() - start) * 1000:.1f}ms: {counts}")
+    return counts
+
+# ============== Keyword Matching ==============
+
+class KeywordMatcher:
+    """Finds every keyword from several labelled lists in a single pass.
+
+    All keywords are compiled into one alternation, longest first, and the
+    search restarts one character after each match start, so the longest
+    keyword at every position where any keyword starts is found. Shorter
+    keywords contained in a match are credited too, which makes a label hit
+    exactly when any of its keywords is a substring of the text (the same
+    answer as any(kw in text for kw in keywords)).
+    """
+
+    def __init__(self, groups):
+        self.groups = {label: list(keywords) for label, keywords in groups.items()}
+        keywords = sorted({kw for kws in self.groups.values() for kw in kws}, key=len, reverse=True)
+        # keyword -> [(label, offset of contained keyword, contained keyword)]
+        self._credits = {}
+        for kw in keywords:
+            credits = []
+            for label, kws in self.groups.items():
+                for sub in kws:
+                    offset = kw.find(sub)
+                    while offset >= 0:
+                        credits.append((label, offset, sub))
+                        offset = kw.find(sub, offset + 1)
+            self._credits[kw] = credits
+        self._regex = re.compile('|'.join(re.escape(kw) for kw in keywords))
+
+    def scan(self, text):
+        """Return {label: [(position, keyword), ...]} for every label that hit"""
+        hits = {}
+        seen = set()
+        search = self._regex.search
+        m = search(text)
+        while m:
+            start = m.start()
+            for label, offset, sub in self._credits[m.group(0)]:
+                key = (label, start + offset, sub)
+                if key not in seen:
+                    seen.add(key)
+                    hits.setdefault(label, []).append((start + offset, sub))
+            m = search(text, start + 1)
+        for positions in hits.values():
+            positions.sort()
+        return hits
+
+PRESCAN_NAME_MATCHER = KeywordMatcher({
+    'gp_referral': ['gp', 'referral', 'paed'],
+    'teacher_input': ['teacher', 'school', 'educator', 'kindergarten'],
+    'allied_report': ['speech', 'psych', 'social', 'worker', 'ot', 'occupational'],
+})
+
+PRESCAN_TEXT_MATCHER = KeywordMatcher({
+    'hearing_test': ['bera', 'abr', 'audiometry', 'audiolog', 'hearing screen', 'peripheral hearing', 'hearing test', 'brainstem auditory'],
+    'hearing_normal': ['normal', 'passed', 'within normal', 'no concerns'],
+    'gp_dev_history': ['milestone', 'developmental history', 'birth history', 'pregnancy', 'early development', 'developmental concerns'],
+    'report_dev_history': ['developmental history', 'milestone', 'birth', 'early development', 'background information'],
+    'previous_asd': ['previous autism', 'prior asd', 'previously assessed for autism', 'earlier autism assessment'],
+})
+
+# What each report audience needs from the clinical documents; 'core' is
+# diagnostic content every report draws on
+REPORT_RELEVANCE_MATCHER = KeywordMatcher({
+    'core': ['autism', 'asd', 'ados', 'adi-r', 'cars', 'social communication', 'repetitive', 'restricted',
+             'sensory', 'diagnos', 'criteri', 'dsm'],
+    'teacher': ['school', 'class', 'teacher', 'learning', 'literacy', 'numeracy', 'attention', 'concentrat',
+                'homework', 'peer', 'playground', 'curriculum', 'education', 'nccd', 'kindergarten',
+                'preschool', 'instruction', 'executive function'],
+    'gp': ['medical', 'medication', 'paediatric', 'pediatric', 'referral', 'hearing', 'vision', 'sleep', 'diet',
+           'growth', 'birth', 'pregnancy', 'milestone', 'family history', 'seizure', 'epilep', 'adhd', 'anxiety',
+           'co-occurring', 'comorbid'],
+    'caregiver': ['at home', 'carer', 'routine', 'bedtime', 'sleep', 'meal', 'eating', 'toilet',
+                  'dressing', 'sibling', 'meltdown', 'outing', 'strength', 'interest', 'play', 'calm'],
+    'ndis': ['ndis', 'function', 'daily living', 'self-care', 'self care', 'independen', 'support', 'therap',
+             'occupational', 'speech', 'capacity', 'assistive', 'safety', 'participation', 'impact', 'goal',
+             'funding', 'mobility'],
+})
+
+# ============== DSM-5 Pre-classifier ==============
+
+# Weighted n-grams per criterion. A trailing * matches any word starting
+# with the phrase; other phrases match whole words only
+DSM5_LEXICON = {
+    'A1': {'back and forth': 3, 'reciproc*': 2, 'sharing enjoyment': 3, 'share enjoyment': 3, 'shares enjoyment': 3,
+           'joint attention': 3, 'to his name': 3, 'to her name': 3, 'to their name': 3, 'to name': 3,
+           'name is called': 3, 'name called': 3, 'turn taking': 2, 'conversation*': 2, 'social approach*': 3,
+           'initiat*': 1, 'interaction*': 1, 'social smil*': 3, 'shows toys': 2, 'showing toys': 2,
+           'brings objects to show': 3, 'comfort*': 1, 'empathy': 2, 'respond*': 1},
+    'A2': {'eye contact': 3, 'eye gaze': 3, 'gaze': 2, 'point*': 2, 'gestur*': 3, 'facial expression*': 3,
+           'nonverbal': 3, 'body language': 3, 'waving': 2, 'waves': 1, 'nod*': 1, 'looks at faces': 3,
+           'tone of voice': 2, 'expressions': 1},
+    'A3': {'peer*': 2, 'friend*': 3, 'imaginative play': 3, 'pretend play': 3, 'make believe': 3,
+           'plays alone': 2, 'play alone': 2, 'prefers to play alone': 3, 'parallel play': 3, 'cooperative play': 3,
+           'other children': 2, 'interest in other children': 3, 'playground': 1, 'plays with other*': 2,
+           'group play': 2, 'relationship*': 2, 'solitary': 2, 'role play': 3},
+    'B1': {'flap*': 3, 'hand flap*': 3, 'rocking': 2, 'rocks': 2, 'toe walk*': 3, 'tiptoe*': 3, 'on his toes': 3,
+           'on her toes': 3, 'echolali*': 3, 'lines up': 3, 'lining up': 3, 'line up': 2, 'lined up': 3,
+           'spin*': 2, 'stereotyp*': 3, 'repetitive movement*': 3, 'repeats phrases': 3, 'repeats words': 3,
+           'scripting': 3, 'script*': 2, 'head bang*': 3, 'finger flick*': 3, 'mannerism*': 3, 'twirl*': 2,
+           'repetitive': 1, 'repeats': 1},
+    'B2': {'routine*': 3, 'sameness': 3, 'rigid*': 2, 'inflexib*': 3, 'transition*': 3, 'same route': 3,
+           'same way': 2, 'same order': 3, 'insist*': 2, 'ritual*': 3, 'unexpected change*': 3, 'chang*': 1,
+           'upset when': 1, 'distress*': 1, 'meltdown*': 1, 'predictab*': 2},
+    'B3': {'intense interest*': 3, 'interest* in': 1, 'obsess*': 3, 'fixat*': 3, 'preoccup*': 3, 'fascinat*': 2,
+           'restricted interest*': 3, 'perseverat*': 3, 'talks only about': 3, 'only wants to': 2, 'collect*': 1,
+           'special interest*': 3, 'narrow range': 2, 'dinosaur*': 1, 'trains': 1, 'timetable*': 1,
+           'unusual interest*': 3, 'attached to': 2},
+    'B4': {'sensory': 3, 'covers his ears': 3, 'covers her ears': 3, 'covers ears': 3, 'covering his ears': 3,
+           'ears': 1, 'loud noise*': 3, 'noise*': 2, 'noisy': 1, 'sound*': 1, 'textur*': 3, 'smell*': 2,
+           'sniff*': 2, 'pain': 2, 'mouth*': 2, 'lick*': 2, 'visual inspection': 3, 'food selectiv*': 3,
+           'fussy eat*': 2, 'picky eat*': 2, 'tags': 2, 'hand dryer*': 3, 'vacuum*': 2, 'bright light*': 3,
+           'touch*': 1, 'temperature': 1, 'sensory seek*': 3, 'overwhelm*': 1, 'under respon*': 2,
+           'over respon*': 2, 'hypersensitiv*': 3, 'hyposensitiv*': 3},
+    'C': {'since birth': 3, 'from an early age': 3, 'early age': 2, 'first noted': 3, 'first noticed': 3,
+          'first concern*': 3, 'months of age': 2, 'months old': 2, 'regress*': 3, 'lost words': 3,
+          'lost skills': 3, 'milestone*': 3, 'first words': 3, 'walked at': 3, 'babbl*': 3, 'infancy': 3,
+          'toddler': 2, 'early develop*': 3, 'developmental history': 3, 'as a baby': 3, 'since age': 2},
+    'D': {'impact*': 2, 'impair*': 2, 'daily living': 3, 'daily life': 3, 'unable to participate': 3,
+          'participat*': 2, 'exclu*': 2, 'suspend*': 3, 'suspension': 3, 'function*': 2, 'cope': 1, 'coping': 1,
+          'support needs': 3, 'requires support': 3, 'needs support': 3, 'one to one': 2, 'aide': 2,
+          'school refusal': 3, 'academic*': 2, 'self care': 3, 'toileting': 2, 'family life': 3,
+          'significant difficult*': 2, 'interfer*': 3, 'independen*': 2},
+    'E': {'bera': 3, 'abr': 3, 'audiolog*': 3, 'audiometr*': 3, 'hearing': 3, 'hearing test*': 3,
+          'hearing screen*': 3, 'tympan*': 3, 'vision': 2, 'ophthalm*': 3, 'optometr*': 3,
+          'cognitive assessment': 3, 'iq': 3, 'wppsi': 3, 'wisc': 3, 'intellectual*': 3, 'cognitive': 2,
+          'genetic*': 2, 'microarray': 3, 'fragile x': 3, 'differential*': 2, 'ruled out': 3, 'rule out': 3},
+}
+
+# Cue words deciding which side of a criterion a quote falls on
+DSM5_CUES = {
+    'negation': ['not', 'never', 'without', 't', 'cannot'],
+    'absence': ['no', 'nil', 'none', 'deny', 'denies', 'denied', 'denial', 'absent', 'not observed', 'not seen',
+                'not noted', 'not reported', 'never observed'],
+    # "not a concern", "no issues with": negated, but about the worry rather than the behaviour
+    'concern': ['concern*', 'issue*', 'problem*', 'worr*'],
+    'atypical': ['poor*', 'limited', 'reduced', 'minimal', 'fleeting', 'lack*', 'avoid*', 'rarely', 'seldom',
+                 'difficult*', 'unable', 'struggl*', 'inconsistent*', 'delay*', 'atypical*', 'unusual*',
+                 'abnormal*', 'impair*', 'distress*', 'upset*', 'refus*', 'only', 'loss', 'lost', 'regress*',
+                 'late', 'significant*', 'severe*', 'deficit*', 'alone', 'loner'],
+    'typical': ['good', 'appropriate*', 'age appropriate', 'typical', 'typically', 'normal*', 'within normal limits',
+                'unremarkable', 'intact', 'passed', 'no concerns', 'copes well', 'coping well', 'adapts', 'flexib*',
+                'handles'],
+}
+
+# How cues pick a side: 'deficit' criteria describe something missing (so a
+# negation supports them, unless it negates deficit language: "denies any
+# difficulties"); 'feature' criteria support as stated, contradict only on
+# an explicit absence ("no hand flapping") and leave quotes with a typical
+# cue to the LLM; the rule-outs in E support on an unnegated normal result.
+# A negated concern ("eye contact was not a concern") is left to the LLM
+DSM5_POLARITY = {'A1': 'deficit', 'A2': 'deficit', 'A3': 'deficit', 'B1': 'feature', 'B2': 'feature',
+                 'B3': 'feature', 'B4': 'feature', 'C': 'deficit', 'D': 'feature', 'E': 'ruleout'}
+
+class CriteriaClassifier:
+    """Lexical DSM-5 classifier that decides the obvious quotes without the LLM.
+
+    Every n-gram of every criterion and cue list goes into one
+    KeywordMatcher and a batch of quotes is scanned as one text, so a batch
+    costs a single regex pass. A quote's score for a criterion is the sum
+    of the weights of the distinct n-grams it contains. A quote is decided
+    only when its best criterion scores at least min_score and margin times
+    the runner-up, and its cues point one way; the rest go to the LLM.
+    """
+
+    def __init__(self, lexicon, cues, polarity, min_score=CLASSIFIER_MIN_SCORE, margin=CLASSIFIER_MARGIN):
+        self.polarity = polarity
+        self.min_score = min_score
+        self.margin = margin
+        self._cues = set(cues)
+        self._weights = {}
+        groups = {}
+        for label, phrases in lexicon.items():
+            groups[label] = []
+            for phrase, weight in phrases.items():
+                key = self._key(phrase)
+                groups[label].append(key)
+                self._weights[(label, key)] = weight
+        for label, phrases in cues.items():
+            groups[label] = [self._key(phrase) for phrase in phrases]
+        self._matcher = KeywordMatcher(groups)
+
+    @staticmethod
+    def _key(phrase):
+        # Normalized quotes are padded with spaces, so a leading space
+        # anchors the start of a word and a trailing one its end
+        return ' ' + phrase[:-1] if phrase.endswith('*') else f' {phrase} '
+
+    def scores(self, texts):
+        """Return ({criterion: score}, {cue, ...}) for each text, from one scan of the batch"""
+        starts = []
+        parts = []
+        offset = 0
+        for text in texts:
+            part = f' {normalize_quote(text)} '
+            starts.append(offset)
+            parts.append(part)
+            offset += len(part) + 1
+        results = [({}, set()) for _ in parts]
+        seen = set()
+        for label, hits in self._matcher.scan('\n'.join(parts)).items():
+            for position, key in hits:
+                i = bisect.bisect_right(starts, position) - 1
+                if (i, label, key) in seen:
+                    continue
+                seen.add((i, label, key))
+                scores, cues = results[i]
+                if label in self._cues:
+                    cues.add(label)
+                else:
+                    scores[label] = scores.get(label, 0) + self._weights[(label, key)]
+        return results
+
+    def classify(self, texts):
+        """Return (criterion, side, score) for each text the lexicon decides, None for the rest"""
+        decisions = []
+        for scores, cues in self.scores(texts):
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+            side = None
+            runner_up = ranked[1][1] if len(ranked) > 1 else 0
+            if ranked and ranked[0][1] >= self.min_score and ranked[0][1] >= self.margin * runner_up:
+                side = self._side(self.polarity[ranked[0][0]], cues)
+            decisions.append((ranked[0][0], side, ranked[0][1]) if side else None)
+        return decisions
+
+    @staticmethod
+    def _side(polarity, cues):
+        absent = 'absence' in cues
+        negated = absent or 'negation' in cues
+        atypical = 'atypical' in cues
+        typical = 'typical' in cues
+        if negated and 'concern' in cues:
+            return None
+        if polarity == 'ruleout':
+            return 'supporting' if typical and not (negated or atypical) else None
+        if polarity == 'feature':
+            if not (negated or typical):
+                return 'supporting'
+            return 'contradicting' if absent and not (atypical or typical) else None
+        if negated != atypical and not typical:
+            return 'supporting'
+        if typical and not (negated or atypical):
+            return 'contradicting'
+        return None
+
+CRITERIA_CLASSIFIER = CriteriaClassifier(DSM5_LEXICON, DSM5_CUES, DSM5_POLARITY)
+
+_STAGE2_ITEM_RE = re.compile(r'^\s*"?(.*?)"?\s*(?:\[[^\]]*\])?\s*$', re.S)
+_label_log_lock = threading.Lock()
+
+def record_stage2_labels(evidence):
+    """Append the LLM's Stage 2 labels to STAGE2_LABEL_LOG as JSON lines, for benchmark_classifier"""
+    if not STAGE2_LABEL_LOG:
+        return
+    lines = []
+    for crit, lists in evidence.items():
+        if not isinstance(lists, dict):
+            continue
+        for side in ('supporting', 'contradicting'):
+            for item in lists.get(side) or []:
+                text = _STAGE2_ITEM_RE.match(item).group(1).strip() if isinstance(item, str) else ''
+                if text:
+                    lines.append(json.dumps({'text': text, 'criterion': crit, 'side': side}))
+    if not lines:
+        return
+    try:
+        with _label_log_lock, open(STAGE2_LABEL_LOG, 'a', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+    except OSError as e:
+        print(f"[Stage 2] Could not record labels: {e}")
+
+def benchmark_classifier(labels, classifier=None):
+    """Score the pre-classifier against recorded Stage 2 labels.
+
+    labels are {'text', 'criterion', 'side'} dicts as written to
+    STAGE2_LABEL_LOG. A quote filed under several criteria counts as
+    correct under any of them.
+    """
+    classifier = classifier or CRITERIA_CLASSIFIER
+    expected = {}
+    for label in labels:
+        expected.setdefault(label['text'], set()).add((label['criterion'], label['side']))
+    texts = list(expected)
+    start = time.time()
+    decisions = classifier.classify(texts)
+    seconds = time.time() - start
+
+    decided = [(text, decision) for text, decision in zip(texts, decisions) if decision]
+    correct = sum(1 for text, (crit, side, _) in decided if (crit, side) in expected[text])
+    crit_correct = sum(1 for text, (crit, _, _) in decided if crit in {c for c, _ in expected[text]})
+    return {
+        'quotes': len(texts),
+        'decided_locally': len(decided),
+        'coverage': round(len(decided) / len(texts), 3) if texts else 0,
+        'accuracy': round(correct / len(decided), 3) if decided else None,
+        'criterion_accuracy': round(crit_correct / len(decided), 3) if decided else None,
+        'seconds': round(seconds, 4),
+        'quotes_per_sec': round(len(texts) / seconds) if seconds > 0 else None,
+    }
 
-def call_huggingface(prompt, timeout=120, max_tokens=2000):
-    """Call HuggingFace API via Together provider"""
-    token = HF_TOKEN or os.environ.get('HF_TOKEN', '')
+# ============== Template Registry ==============
 
-    if not token:
-        raise ValueError("HF_TOKEN environment variable not set")
+PLACEHOLDER_RE = re.compile(r'\{([^{}\n]+)\}|\\\[([^\]\n]+?)\\\]')
+# '#'..'###' headings, or setext headings underlined with === / --- (as pandoc writes them)
+HEADING_RE = re.compile(r'(?m)^#{1,3} \S.*$|^\S[^\n]*\n(?:=+|-{3,})[ \t]*$')
 
-    payload = json.dumps({
-        "model": "meta-llama/llama-3.3-70b-instruct",
-        "messages": [{"role": "user", "content": prompt}],
-        "max_tokens": max_tokens
-    })
+def find_headings(text):
+    """(title, offset, level) for every heading in markdown text"""
+    headings = []
+    for m in HEADING_RE.finditer(text):
+        line, _, underline = m.group(0).partition('\n')
+        if underline:
+            level = 1 if underline.startswith('=') else 2
+        else:
+            level = len(line) - len(line.lstrip('#'))
+        headings.append((line.lstrip('#').strip(), m.start(), level))
+    return headings
+
+def split_sections(text):
+    """Split markdown at its highest heading level that repeats; a preamble stays with the first section"""
+    headings = find_headings(text)
+    levels = [level for _, _, level in headings]
+    repeated = [level for level in sorted(set(levels)) if levels.count(level) > 1]
+    if not repeated:
+        return [text]
+    bounds = [0] + [offset for _, offset, level in headings if level == repeated[0]][1:] + [len(text)]
+    return [text[start:end] for start, end in zip(bounds, bounds[1:])]
+
+TEMPLATE_FALLBACKS = {
+    'gp_letter_template': '**GP Letter Template - Fallback**',
+    'teacher_letter_template': '**Teacher Letter Template - Fallback**',
+    'caregiver_template': '**Caregiver Report Template - Fallback**',
+    'ndis_template': '**NDIS Supporting Evidence Template - Fallback**',
+}
+
+class Template:
+    """A report template pre-split into static segments and placeholder slots.
+
+    segments has one more entry than slots; slot i sits between segments i
+    and i+1. Placeholders are either {Name} or markdown-escaped \\[Name\\].
+    headings lists (title, offset, level) for every section heading.
+    """
+
+    def __init__(self, text, mtime=None):
+        self.text = text
+        self.mtime = mtime
+        self.segments = []
+        self.slots = []         # slot names, e.g. 'Name'
+        self.placeholders = []  # raw placeholder text, e.g. '{Name}'
+        pos = 0
+        for m in PLACEHOLDER_RE.finditer(text):
+            self.segments.append(text[pos:m.start()])
+            self.slots.append(m.group(1) or m.group(2))
+            self.placeholders.append(m.group(0))
+            pos = m.end()
+        self.segments.append(text[pos:])
+        self.headings = find_headings(text)
+
+    def render(self, values=None):
+        """Fill the given slots, leaving every other placeholder as-is"""
+        if not values:
+            return self.text
+        parts = [self.segments[0]]
+        for i, slot in enumerate(self.slots):
+            value = values.get(slot)
+            parts.append(str(value) if value is not None else self.placeholders[i])
+            parts.append(self.segments[i + 1])
+        return ''.join(parts)
+
+class TemplateRegistry:
+    """Loads every templates/*.md once and serves it from memory.
+
+    Files are re-stat'ed at most every check_interval seconds and reloaded
+    only when their mtime changes. Missing templates fall back to a stub.
+    """
+
+    def __init__(self, directory, fallbacks=None, check_interval=2.0):
+        self.directory = directory
+        self.fallbacks = fallbacks or {}
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._templates = {}
+        self._checked = {}
+        for filename in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+            if filename.endswith('.md'):
+                self._load(filename[:-3])
+        print(f"[Template] Loaded {len(self._templates)} templates: {sorted(self._templates)}")
+
+    def _load(self, name):
+        path = os.path.join(self.directory, name + '.md')
+        try:
+            mtime = os.stat(path).st_mtime
+            with open(path, 'r') as f:
+                template = Template(f.read(), mtime)
+        except OSError as e:
+            if name in self._templates or os.path.exists(path):
+                print(f"[Template] Error loading {name}: {e}")
+            template = Template(self.fallbacks.get(name, ''))
+        self._templates[name] = template
+        self._checked[name] = time.time()
+        return template
+
+    def get(self, name):
+        with self._lock:
+            template = self._templates.get(name)
+            now = time.time()
+            if template is not None and now - self._checked.get(name, 0) < self.check_interval:
+                return template
+            self._checked[name] = now
+            if template is not None:
+                try:
+                    mtime = os.stat(os.path.join(self.directory, name + '.md')).st_mtime
+                except OSError:
+                    mtime = None
+                if mtime == template.mtime:
+                    return template
+            return self._load(name)
+
+    def text(self, name):
+        return self.get(name).text
+
+    def render(self, name, values=None):
+        return self.get(name).render(values)
+
+templates = TemplateRegistry(os.path.join(BASE_DIR, 'templates'), TEMPLATE_FALLBACKS)
+
+# ============== HTTP Connection Pool ==============
+
+class HTTPPool:
+    """Process-wide pool of HTTP/1.1 keep-alive connections.
+
+    Connections are keyed by (scheme, host, port), capped per host, and
+    evicted after sitting idle for idle_timeout seconds. Checkout is
+    thread-safe; callers beyond the per-host cap wait for a free slot.
+    """
+
+    def __init__(self, max_per_host=8, idle_timeout=60.0):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Condition()
+        self._idle = {}    # key -> deque of (conn, last_used)
+        self._active = {}  # key -> connections checked out or idle
+        self._stats = {'requests': 0, 'hits': 0, 'new_connections': 0,
+                       'waits': 0, 'evicted': 0, 'errors': 0}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = sum(len(q) for q in self._idle.values())
+            stats['open'] = sum(self._active.values())
+            return stats
+
+    def checkout(self, scheme, host, port, timeout):
+        """Return (conn, reused) for the host, waiting if it is at its cap"""
+        key = (scheme, host, port)
+        deadline = time.time() + timeout
+        with self._lock:
+            waited = False
+            while True:
+                self._evict_idle(key)
+                idle = self._idle.get(key)
+                if idle:
+                    conn, _ = idle.pop()
+                    self._stats['hits'] += 1
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    return conn, True
+                if self._active.get(key, 0) < self.max_per_host:
+                    self._active[key] = self._active.get(key, 0) + 1
+                    self._stats['new_connections'] += 1
+                    break
+                if not waited:
+                    self._stats['waits'] += 1
+                    waited = True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError(f"no connection to {host} free after {timeout}s")
+                self._lock.wait(remaining)
+
+        conn_cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return conn_cls(host, port, timeout=timeout), False
+
+    def checkin(self, scheme, host, port, conn, reusable=True):
+        """Return a connection to the pool, or close it if not reusable"""
+        key = (scheme, host, port)
+        with self._lock:
+            if reusable:
+                self._idle.setdefault(key, deque()).append((conn, time.time()))
+            else:
+                conn.close()
+                self._active[key] = max(0, self._active.get(key, 1) - 1)
+            self._lock.notify()
+
+    def _evict_idle(self, key):
+        idle = self._idle.get(key)
+        now = time.time()
+        while idle and now - idle[0][1] > self.idle_timeout:
+            conn, _ = idle.popleft()
+            conn.close()
+            self._active[key] = max(0, self._active.get(key, 1) - 1)
+            self._stats['evicted'] += 1
+
+    def request(self, method, url, body=None, headers=None, timeout=60):
+        """Send a request over a pooled connection and return the body bytes.
+
+        Non-2xx responses raise urllib.error.HTTPError, matching urlopen.
+        """
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme or 'http'
+        host = parts.hostname
+        port = parts.port or (443 if scheme == 'https' else 80)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        with self._lock:
+            self._stats['requests'] += 1
+
+        for attempt in range(2):
+            conn, reused = self.checkout(scheme, host, port, timeout)
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.checkin(scheme, host, port, conn, reusable=False)
+                # A reused connection may have been closed by the server while idle
+                if reused and attempt == 0:
+                    continue
+                with self._lock:
+                    self._stats['errors'] += 1
+                raise
+            except Exception:
+                self.checkin(scheme, host, port, conn, reusable=False)
+                with self._lock:
+                    self._stats['errors'] += 1
+                raise
+
+            self.checkin(scheme, host, port, conn, reusable=not resp.will_close)
+            if resp.status >= 400:
+                raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+            return data
 
-    req = urllib.request.Request(
-        'https://router.huggingface.co/novita/v3/openai/chat/completions',
-        data=payload.encode(),
-        headers={
+    def stream_lines(self, method, url, body=None, headers=None, timeout=60):
+        """Send a request and yield the response body line by line.
+
+        The connection only returns to the pool if the body was read to the
+        end; closing the generator early closes the connection instead.
+        """
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme or 'http'
+        host = parts.hostname
+        port = parts.port or (443 if scheme == 'https' else 80)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        with self._lock:
+            self._stats['requests'] += 1
+
+        conn, _ = self.checkout(scheme, host, port, timeout)
+        finished = False
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            resp = conn.getresponse()
+            if resp.status >= 400:
+                resp.read()
+                raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+            while True:
+                line = resp.readline()
+                if not line:
+                    break
+                yield line
+            finished = not resp.will_close
+        finally:
+            self.checkin(scheme, host, port, conn, reusable=finished)
+
+http_pool = HTTPPool(max_per_host=POOL_MAX_PER_HOST, idle_timeout=POOL_IDLE_TIMEOUT)
+
+# ============== LLM Backends ==============
+
+# Request model names -> backend model names
+MODEL_ALIASES = {
+    'llama-3.3-70b': {'hf': HF_MODEL, 'ollama': 'llama3.3:70b'},
+    'meta-llama/llama-3.3-70b-instruct': {'hf': 'meta-llama/llama-3.3-70b-instruct', 'ollama': 'llama3.3:70b'},
+}
+
+LENGTH_LIMIT = object()  # last item of a stream cut off at max_tokens
+
+class LLMBackend:
+    """One way of running chat completions. Instances are cheap and carry the model."""
+
+    name = None
+    hedge = True  # whether a duplicate request can finish sooner (see LLMGuard)
+    context_tokens = HF_CONTEXT_TOKENS  # prompt + completion the model accepts
+
+    def __init__(self, model=None):
+        self.model = self.resolve_model(model)
+
+    @property
+    def cache_id(self):
+        return f"{self.name}/{self.model}"
+
+    def resolve_model(self, requested):
+        return MODEL_ALIASES.get(requested, {}).get(self.name) or requested or self.default_model()
+
+    def default_model(self):
+        raise NotImplementedError
+
+    def complete(self, prompt, max_tokens, timeout):
+        """Return (completion text, (prompt tokens, completion tokens) or None if unreported, hit max_tokens)"""
+        raise NotImplementedError
+
+    def stream(self, prompt, max_tokens, timeout):
+        """Generator of completion text deltas, then LENGTH_LIMIT if the completion hit max_tokens"""
+        raise NotImplementedError
+
+class OpenAIChatBackend(LLMBackend):
+    """OpenAI-compatible /chat/completions, by default the HuggingFace router"""
+
+    name = 'hf'
+
+    def default_model(self):
+        return HF_MODEL
+
+    def resolve_model(self, requested):
+        model = super().resolve_model(requested)
+        return model if '/' in model else HF_MODEL
+
+    def _request(self, prompt, max_tokens, stream):
+        token = HF_TOKEN or os.environ.get('HF_TOKEN', '')
+        if not token:
+            raise ValueError("HF_TOKEN environment variable not set")
+        payload = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": max_tokens
+        }
+        headers = {
             'Content-Type': 'application/json',
             'Authorization': f'Bearer {token}',
             'User-Agent': 'Mozilla/5.0'
         }
-    )
-
-    with urllib.request.urlopen(req, timeout=timeout) as resp:
-        result = json.loads(resp.read())
-        return result['choices'][0]['message']['content']
-
-def parse_stage1_response(response, doc_name):
-    """Parse Stage 1 response into quote list"""
-    quotes = []
-    clean = response.replace('```json', '').replace('```', '').strip()
-    start_idx = clean.find('{')
-    end_idx = clean.rfind('}') + 1
-
-    if start_idx >= 0 and end_idx > start_idx:
+        if stream:
+            payload["stream"] = True
+            headers['Accept'] = 'text/event-stream'
+        return json.dumps(payload).encode(), headers
+
+    def complete(self, prompt, max_tokens, timeout):
+        body, headers = self._request(prompt, max_tokens, stream=False)
+        result = json.loads(http_pool.request('POST', HF_API_URL, body=body, headers=headers, timeout=timeout))
+        usage = result.get('usage') or {}
+        choice = result['choices'][0]
+        return (choice['message']['content'],
+                (usage['prompt_tokens'], usage['completion_tokens']) if 'completion_tokens' in usage else None,
+                choice.get('finish_reason') == 'length')
+
+    def stream(self, prompt, max_tokens, timeout):
+        body, headers = self._request(prompt, max_tokens, stream=True)
+        lines = http_pool.stream_lines('POST', HF_API_URL, body=body, headers=headers, timeout=timeout)
+        truncated = False
         try:
-            data = json.loads(clean[start_idx:end_idx])
-            for category, quote_list in data.items():
-                if isinstance(quote_list, list):
-                    for q in quote_list:
-                        if isinstance(q, str) and len(q) > 15:
-                            quotes.append({
-                                "text": q,
-                                "source": doc_name,
-                                "category": category
-                            })
-        except json.JSONDecodeError:
-            pass
-
-    return quotes
+            for line in lines:
+                line = line.strip()
+                if not line.startswith(b'data:'):
+                    continue
+                chunk = line[5:].strip()
+                if chunk == b'[DONE]':
+                    continue
+                choice = json.loads(chunk)['choices'][0]
+                delta = choice.get('delta', {}).get('content')
+                if delta:
+                    yield delta
+                truncated = truncated or choice.get('finish_reason') == 'length'
+        finally:
+            lines.close()
+        if truncated:
+            yield LENGTH_LIMIT
+
+class OllamaBackend(LLMBackend):
+    """Local Ollama /api/chat.
+
+    keep_alive keeps the model loaded between calls, and with
+    OLLAMA_PIN_MODEL every request runs on OLLAMA_MODEL, so a request
+    naming another model can't evict a 40 GB model from memory.
+    """
+
+    name = 'ollama'
+    hedge = False  # one local GPU: a duplicate would just queue behind the original
+    context_tokens = OLLAMA_NUM_CTX
+
+    def default_model(self):
+        return OLLAMA_MODEL
+
+    def resolve_model(self, requested):
+        if OLLAMA_PIN_MODEL:
+            return OLLAMA_MODEL
+        model = super().resolve_model(requested)
+        return model if '/' not in model else OLLAMA_MODEL
+
+    def _body(self, prompt, max_tokens, stream):
+        return json.dumps({
+            "model": self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "stream": stream,
+            "keep_alive": OLLAMA_KEEP_ALIVE,
+            "options": {"num_predict": max_tokens, "num_ctx": OLLAMA_NUM_CTX}
+        }).encode()
+
+    def complete(self, prompt, max_tokens, timeout):
+        body = http_pool.request('POST', f'{OLLAMA_URL}/api/chat', body=self._body(prompt, max_tokens, False),
+                                 headers={'Content-Type': 'application/json'}, timeout=timeout)
+        result = json.loads(body)
+        if 'error' in result:
+            raise RuntimeError(f"Ollama: {result['error']}")
+        return (result['message']['content'],
+                (result.get('prompt_eval_count', 0), result['eval_count']) if 'eval_count' in result else None,
+                result.get('done_reason') == 'length')
+
+    def stream(self, prompt, max_tokens, timeout):
+        lines = http_pool.stream_lines('POST', f'{OLLAMA_URL}/api/chat', body=self._body(prompt, max_tokens, True),
+                                       headers={'Content-Type': 'application/json'}, timeout=timeout)
+        try:
+            for line in lines:
+                if not line.strip():
+                    continue
+                chunk = json.loads(line)
+                if 'error' in chunk:
+                    raise RuntimeError(f"Ollama: {chunk['error']}")
+                delta = chunk.get('message', {}).get('content')
+                if delta:
+                    yield delta
+                if chunk.get('done'):
+                    if chunk.get('done_reason') == 'length':
+                        yield LENGTH_LIMIT
+                    break
+        finally:
+            lines.close()
+
+_FAKE_SENTENCE_RE = re.compile(r'[^.!?\n]{25,300}[.!?]')
+_FAKE_SECTION_RE = re.compile(r'^(?:=== DOCUMENTS? ===|Document:|DOCUMENT TEXT:|QUOTES:)$', re.M)
+
+class FakeBackend(LLMBackend):
+    """Offline backend for throughput work: deterministic output, configurable speed.
+
+    The completion is a pure function of the prompt. When the prompt ends
+    with a JSON template, the template is filled with sentences copied
+    verbatim from the prompt's document section, so parsing, dedup and
+    verification see realistic input; other prompts get prose. It waits
+    FAKE_LATENCY before the first token and then produces
+    FAKE_TOKENS_PER_SEC, and is cut off at max_tokens like a real model.
+    FAKE_ERROR_RATE of calls fail with a 503, to exercise LLMGuard.
+    """
+
+    name = 'fake'
+
+    def default_model(self):
+        return 'fake'
+
+    def resolve_model(self, requested):
+        return 'fake'
+
+    def completion(self, prompt, max_tokens):
+        rng = random.Random(hashlib.sha256(prompt.encode('utf-8', 'surrogatepass')).digest())
+        template = None
+        at = prompt.rfind('\n{')
+        if at >= 0:
+            try:
+                template, _ = json.JSONDecoder().raw_decode(prompt, at + 1)
+            except ValueError:
+                pass
+        sections = list(_FAKE_SECTION_RE.finditer(prompt, 0, at if template is not None else len(prompt)))
+        source = prompt[sections[-1].end():at] if sections else prompt
+        sentences = [s.strip() for s in _FAKE_SENTENCE_RE.findall(source)] or ['No relevant information found.']
+
+        def fill(value):
+            if isinstance(value, dict):
+                return {k: fill(v) for k, v in value.items()}
+            if isinstance(value, list):
+                return [rng.choice(sentences) for _ in range(rng.randint(0, 3))]
+            if isinstance(value, str) and value:
+                return ' '.join(rng.choice(sentences) for _ in range(rng.randint(1, 2)))
+            return value
+
+        if isinstance(template, dict):
+            content = json.dumps(fill(template))
+        else:
+            words = []
+            while len(words) < max_tokens // 4:
+                words.extend(rng.choice(sentences).split())
+            content = ' '.join(words)
+        limit = max_tokens * CHARS_PER_TOKEN
+        return content[:limit], len(content) > limit
+
+    def _pace(self, tokens):
+        if FAKE_TOKENS_PER_SEC > 0:
+            time.sleep(tokens / FAKE_TOKENS_PER_SEC)
+
+    def _maybe_fail(self):
+        if FAKE_ERROR_RATE and random.random() < FAKE_ERROR_RATE:
+            raise urllib.error.HTTPError('fake://', 503, 'Service Unavailable (FAKE_ERROR_RATE)', None, None)
+
+    def complete(self, prompt, max_tokens, timeout):
+        self._maybe_fail()
+        content, truncated = self.completion(prompt, max_tokens)
+        time.sleep(FAKE_LATENCY)
+        self._pace(estimate_tokens(content))
+        return content, None, truncated
+
+    def stream(self, prompt, max_tokens, timeout):
+        self._maybe_fail()
+        content, truncated = self.completion(prompt, max_tokens)
+        time.sleep(FAKE_LATENCY)
+        step = 4 * CHARS_PER_TOKEN  # about four tokens per delta
+        for i in range(0, len(content), step):
+            self._pace(4)
+            yield content[i:i + step]
+        if truncated:
+            yield LENGTH_LIMIT
+
+LLM_BACKENDS = {'hf': OpenAIChatBackend, 'openai': OpenAIChatBackend, 'ollama': OllamaBackend, 'fake': FakeBackend}
+
+def make_backend(name, model=None):
+    if name not in LLM_BACKENDS:
+        raise ValueError(f"unknown LLM backend: {name}")
+    return LLM_BACKENDS[name](model)
+
+def backend_config():
+    return {'default': LLM_BACKEND, 'endpoints': LLM_ENDPOINT_BACKENDS,
+            'ollama': {'model': OLLAMA_MODEL, 'pinned': OLLAMA_PIN_MODEL, 'keepAlive': OLLAMA_KEEP_ALIVE}}
+
+def llm_backend(endpoint):
+    """Resolve the backend for an endpoint from the request and config.
+
+    A 'backend' field wins, then 'useCloud' (false means local Ollama),
+    then LLM_ENDPOINT_BACKENDS, then LLM_BACKEND. 'model' picks the model.
+    """
+    data = request.get_json(silent=True) or {}
+    name = data.get('backend')
+    if not name and data.get('useCloud') is not None:
+        name = 'hf' if data['useCloud'] else 'ollama'
+    return make_backend(name or LLM_ENDPOINT_BACKENDS.get(endpoint, LLM_BACKEND), data.get('model'))
+
+# ============== LLM Resilience ==============
+
+class CircuitOpenError(RuntimeError):
+    """The backend's circuit breaker is open; the call was not attempted"""
+
+class ReportCancelled(RuntimeError):
+    """The report's client went away; the call was abandoned"""
+
+class TruncatedError(RuntimeError):
+    """The completion stopped at max_tokens; content holds the partial text"""
+
+    def __init__(self, content, max_tokens):
+        super().__init__(f"completion cut off at max_tokens={max_tokens}")
+        self.content = content
+        self.max_tokens = max_tokens
+
+def is_transient_error(e):
+    """Errors worth retrying: rate limits, provider 5xx and dropped connections"""
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code == 429 or e.code >= 500
+    return isinstance(e, (OSError, http.client.HTTPException)) and not isinstance(e, TimeoutError)
+
+def retry_delay(e, attempt):
+    """Full-jitter exponential backoff, or the provider's Retry-After if it sent one"""
+    retry_after = e.headers.get('Retry-After') if isinstance(e, urllib.error.HTTPError) and e.headers else None
+    if retry_after and retry_after.strip().isdigit():
+        return min(float(retry_after), LLM_RETRY_CAP)
+    return random.uniform(0, min(LLM_RETRY_CAP, LLM_RETRY_BASE * 2 ** attempt))
+
+class LLMGuard:
+    """Retries, hedging and a circuit breaker for one backend/model.
+
+    Transient failures (429, 5xx, dropped connections) are retried with
+    jittered backoff inside the caller's deadline. Once LLM_HEDGE_MIN_SAMPLES
+    latencies are known for a max_tokens budget, a call still running after
+    their p95 gets a duplicate request and the first success wins; hedges
+    only use a free LLM slot and are capped at LLM_HEDGE_MAX_RATIO of calls.
+    LLM_BREAKER_FAILURES consecutive calls failing after their retries
+    (transient errors or timeouts) open the breaker: calls then fail at once with CircuitOpenError until
+    LLM_BREAKER_COOLDOWN has passed, when a single trial call decides
+    whether it closes again. State is per worker process.
+    """
+
+    def __init__(self, name, hedge):
+        self.name = name
+        self.hedge = hedge and LLM_HEDGE
+        self._lock = threading.Lock()
+        self._latencies = {}  # max_tokens -> recent successful latencies
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._calls = 0
+        self._hedges = 0
+
+    def stats(self):
+        with self._lock:
+            if self._opened_at is None:
+                state = 'closed'
+            elif self._probing or time.time() >= self._opened_at + LLM_BREAKER_COOLDOWN:
+                state = 'half_open'
+            else:
+                state = 'open'
+            return {'state': state, 'failures': self._failures, 'calls': self._calls, 'hedges': self._hedges,
+                    'p95': {tokens: round(self._p95(samples), 2) for tokens, samples in self._latencies.items()
+                            if len(samples) >= LLM_HEDGE_MIN_SAMPLES}}
+
+    def call(self, attempt, max_tokens, timeout):
+        """Run attempt(timeout) -> (content, usage, truncated) with retries and hedging within timeout seconds"""
+        deadline = time.time() + timeout
+        self._admit()
+        for n in range(LLM_RETRIES + 1):
+            try:
+                result = self._hedged(attempt, max_tokens, deadline)
+            except Exception as e:
+                self._retry_or_raise(e, n, deadline)
+                continue
+            self._record(True)
+            return result
+
+    def open_stream(self, start, timeout):
+        """Start start(timeout) -> delta generator with retries until its first delta.
+
+        Returns (first delta or None, generator). Failures after the first
+        delta are not retried, since the caller has already relayed text.
+        """
+        deadline = time.time() + timeout
+        self._admit()
+        for n in range(LLM_RETRIES + 1):
+            deltas = start(max(deadline - time.time(), 0.1))
+            try:
+                first = next(deltas, None)
+            except Exception as e:
+                deltas.close()
+                self._retry_or_raise(e, n, deadline)
+                continue
+            self._record(True)
+            return first, deltas
+
+    def _retry_or_raise(self, e, n, deadline):
+        transient = is_transient_error(e)
+        delay = retry_delay(e, n)
+        if not transient or n == LLM_RETRIES or time.time() + delay >= deadline:
+            # Only calls that fail for provider reasons count against the breaker;
+            # timeouts do, but are not retried since the deadline is spent
+            self._record(not (transient or isinstance(e, TimeoutError)))
+            raise e
+        reason = str(e.code) if isinstance(e, urllib.error.HTTPError) else type(e).__name__
+        metrics.inc('aurum_llm_retries_total', backend=self.name, reason=reason)
+        print(f"[LLM] {self.name} attempt {n + 1} failed ({e}), retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+    def _admit(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            wait = self._opened_at + LLM_BREAKER_COOLDOWN - time.time()
+            if wait > 0 or self._probing:
+                metrics.inc('aurum_llm_breaker_rejections_total', backend=self.name)
+                raise CircuitOpenError(f"{self.name} circuit open after {self._failures} consecutive failures, "
+                                       f"retry in {max(wait, 1):.0f}s")
+            self._probing = True  # half-open: this call is the trial
+
+    def _record(self, ok):
+        with self._lock:
+            probing, self._probing = self._probing, False
+            if ok:
+                if self._opened_at is not None:
+                    print(f"[LLM] {self.name} circuit closed")
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if probing or (self._opened_at is None and self._failures >= LLM_BREAKER_FAILURES):
+                self._opened_at = time.time()
+                metrics.inc('aurum_llm_breaker_trips_total', backend=self.name)
+                print(f"[LLM] {self.name} circuit open for {LLM_BREAKER_COOLDOWN:.0f}s "
+                      f"after {self._failures} consecutive failures")
+
+    @staticmethod
+    def _p95(samples):
+        ordered = sorted(samples)
+        return ordered[int(len(ordered) * 0.95)]
+
+    def _hedge_delay(self, max_tokens):
+        if not self.hedge:
+            return None
+        with self._lock:
+            samples = self._latencies.get(max_tokens)
+            if not samples or len(samples) < LLM_HEDGE_MIN_SAMPLES or self._hedges >= LLM_HEDGE_MAX_RATIO * self._calls:
+                return None
+            return max(self._p95(samples), LLM_HEDGE_MIN_DELAY)
+
+    def _timed(self, attempt, max_tokens, timeout):
+        start = time.time()
+        result = attempt(max(timeout, 0.1))
+        with self._lock:
+            self._latencies.setdefault(max_tokens, deque(maxlen=LLM_LATENCY_WINDOW)).append(time.time() - start)
+        return result
+
+    def _hedged(self, attempt, max_tokens, deadline):
+        delay = self._hedge_delay(max_tokens)
+        with self._lock:
+            self._calls += 1
+        if delay is None or time.time() + delay >= deadline:
+            return self._timed(attempt, max_tokens, deadline - time.time())
+
+        primary = _hedge_pool.submit(self._timed, attempt, max_tokens, deadline - time.time())
+        done, _ = wait_futures([primary], timeout=delay)
+        # Never queue a hedge behind real work: it only runs on a free slot
+        if done or not _llm_slots.acquire(blocking=False):
+            return primary.result(timeout=max(deadline - time.time(), 0))
+        with self._lock:
+            self._hedges += 1
+        hedge = _hedge_pool.submit(self._timed, attempt, max_tokens, deadline - time.time())
+        hedge.add_done_callback(lambda _: _llm_slots.release())
+        print(f"[LLM] {self.name} no response after {delay:.1f}s (p95), hedging")
+
+        pending = {primary: 'primary', hedge: 'hedge'}
+        error = None
+        while pending:
+            done, _ = wait_futures(list(pending), timeout=max(deadline - time.time(), 0), return_when=FIRST_COMPLETED)
+            if not done:
+                raise TimeoutError(f"no LLM response within the deadline (hedged after {delay:.1f}s)")
+            for future in done:
+                winner = pending.pop(future)
+                if future.exception() is None:
+                    metrics.inc('aurum_llm_hedges_total', backend=self.name, winner=winner)
+                    return future.result()
+                error = future.exception()
+        metrics.inc('aurum_llm_hedges_total', backend=self.name, winner='none')
+        raise error
+
+# Runs primaries of hedgeable calls so the caller can wait on them with a timeout
+_hedge_pool = ThreadPoolExecutor(max_workers=2 * LLM_MAX_INFLIGHT, thread_name_prefix='llm-hedge')
+_llm_guards = {}
+_llm_guards_lock = threading.Lock()
+
+def llm_guard(backend):
+    """The LLMGuard shared by every call to this backend and model"""
+    with _llm_guards_lock:
+        guard = _llm_guards.get(backend.cache_id)
+        if guard is None:
+            guard = _llm_guards[backend.cache_id] = LLMGuard(backend.name, backend.hedge)
+        return guard
+
+def guard_stats():
+    with _llm_guards_lock:
+        guards = dict(_llm_guards)
+    return {cache_id: guard.stats() for cache_id, guard in guards.items()}
+
+# ============== Metrics ==============
+
+HISTOGRAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+METRIC_INFO = {
+    'aurum_http_requests_total': ('counter', 'HTTP requests by route, method and status'),
+    'aurum_http_request_duration_seconds': ('histogram', 'Time to response headers by route'),
+    'aurum_stage_duration_seconds': ('histogram', 'Pipeline stage latency'),
+    'aurum_report_duration_seconds': ('histogram', 'Report generation latency by report type'),
+    'aurum_llm_request_duration_seconds': ('histogram', 'Upstream LLM call latency, excluding the wait for a slot'),
+    'aurum_llm_inflight': ('gauge', 'LLM calls currently in flight'),
+    'aurum_llm_tokens_total': ('counter', 'LLM tokens, estimated at 4 chars/token when the provider reports no usage'),
+    'aurum_timeouts_total': ('counter', 'Timeouts: llm (upstream), llm_slot (no free slot), parallel (fan-out deadline)'),
+    'aurum_json_parse_total': ('counter', 'LLM JSON parses: strict, repaired (lenient parser needed), truncated, failed'),
+    'aurum_llm_retries_total': ('counter', 'LLM attempts retried after a transient error, by status or exception'),
+    'aurum_llm_hedges_total': ('counter', 'Hedged LLM calls by which request answered first'),
+    'aurum_llm_breaker_trips_total': ('counter', 'Times the LLM circuit breaker opened'),
+    'aurum_llm_breaker_rejections_total': ('counter', 'LLM calls failed fast by an open circuit breaker'),
+    'aurum_llm_truncated_total': ('counter', 'LLM completions cut off at max_tokens'),
+    'aurum_stage2_quotes_total': ('counter', 'Two-stage quotes categorized, by route: local (lexical) or llm'),
+    'aurum_report_documents_trimmed_total': ('counter', 'Reports whose documents did not fit the context window'),
+}
+
+class Metrics:
+    """Prometheus counters, gauges and histograms across gunicorn workers.
+
+    Each process keeps its own values and writes them to
+    directory/<pid>.json every flush_interval seconds. A scrape merges the
+    snapshots of all live workers (summing counters, gauges and histogram
+    buckets), so /metrics describes the whole server whichever worker
+    answers. Snapshots of workers that have exited are removed.
+    """
+
+    def __init__(self, directory, flush_interval, buckets=HISTOGRAM_BUCKETS):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._values = {}  # (name, label items) -> number, or [bucket counts..., sum, count]
+        self._flusher = None
+
+    def inc(self, name, value=1, **labels):
+        self.add(name, value, **labels)
+
+    def add(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+        self._start_flusher()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._values.get(key)
+            if hist is None:
+                hist = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[i] += 1
+                    break
+            hist[-2] += value
+            hist[-1] += 1
+        self._start_flusher()
+
+    def _start_flusher(self):
+        # Started lazily so it runs in the worker, not a pre-fork parent
+        if self._flusher is not None or self.flush_interval <= 0:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            snapshot = [[name, list(labels), value] for (name, labels), value in self._values.items()]
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[Metrics] Could not write snapshot: {e}")
+
+    def merged(self):
+        """Sum of the snapshots of all live workers, this one included"""
+        self.flush()
+        merged = {}
+        filenames = os.listdir(self.directory) if os.path.isdir(self.directory) else []
+        for filename in filenames:
+            pid = filename[:-len('.json')]
+            if not filename.endswith('.json') or not pid.isdigit():
+                continue
+            path = os.path.join(self.directory, filename)
+            if int(pid) != os.getpid():
+                try:
+                    os.kill(int(pid), 0)
+                except ProcessLookupError:
+                    os.remove(path)
+                    continue
+                except PermissionError:
+                    pass
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, labels, value in snapshot:
+                key = (name, tuple(tuple(item) for item in labels))
+                if isinstance(value, list):
+                    current = merged.get(key)
+                    merged[key] = value if current is None else [a + b for a, b in zip(current, value)]
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def render(self):
+        """Prometheus text exposition format"""
+        by_name = {}
+        for (name, labels), value in sorted(self.merged().items()):
+            by_name.setdefault(name, []).append((labels, value))
+        lines = []
+        for name, series in by_name.items():
+            kind, help_text = METRIC_INFO.get(name, ('untyped', ''))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in series:
+                if kind != 'histogram':
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets, value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {value[-1]}")
+                lines.append(f"{name}_sum{format_labels(labels)} {round(value[-2], 6)}")
+                lines.append(f"{name}_count{format_labels(labels)} {value[-1]}")
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+metrics = Metrics(METRICS_DIR, METRICS_FLUSH_INTERVAL)
+
+def log_event(event, **fields):
+    """Emit one structured JSON log line"""
+    if LOG_JSON:
+        print(json.dumps({'ts': round(time.time(), 3), 'event': event, **fields}), flush=True)
+
+def record_stage(stage, seconds, **fields):
+    metrics.observe('aurum_stage_duration_seconds', seconds, stage=stage)
+    log_event('stage', stage=stage, seconds=round(seconds, 3), **fields)
+
+def timed(stage, func, *args, **kwargs):
+    """Call func, recording its duration as a pipeline stage"""
+    start = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        record_stage(stage, time.time() - start)
+
+def record_llm_call(backend, outcome, seconds, prompt, content, usage, max_tokens=None, truncated=False):
+    metrics.observe('aurum_llm_request_duration_seconds', seconds, backend=backend.name, outcome=outcome)
+    if outcome == 'timeout':
+        metrics.inc('aurum_timeouts_total', where='llm')
+    if outcome == 'rejected':
+        return
+    if truncated:
+        metrics.inc('aurum_llm_truncated_total', backend=backend.name)
+    prompt_tokens, completion_tokens = usage or (estimate_tokens(prompt), estimate_tokens(content or ''))
+    metrics.inc('aurum_llm_tokens_total', prompt_tokens, backend=backend.name, kind='prompt')
+    metrics.inc('aurum_llm_tokens_total', completion_tokens, backend=backend.name, kind='completion')
+    log_event('llm_call', backend=backend.name, model=backend.model, outcome=outcome, seconds=round(seconds, 3),
+              prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, usage_reported=usage is not None,
+              max_tokens=max_tokens, truncated=truncated)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.time()
+
+@app.after_request
+def record_request(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    seconds = time.time() - g.get('request_start', time.time())
+    metrics.inc('aurum_http_requests_total', route=route, method=request.method, status=str(response.status_code))
+    metrics.observe('aurum_http_request_duration_seconds', seconds, route=route)
+    if route.startswith('/api/'):
+        log_event('request', route=route, method=request.method, status=response.status_code,
+                  seconds=round(seconds, 3))
+    return response
+
+# ============== LLM Response Cache ==============
+
+def llm_cache_mode(endpoint):
+    """Resolve the cache policy for an endpoint from config and request headers.
+
+    Endpoints opt in via LLM_CACHE_ENDPOINTS. Clients can send
+    'X-LLM-Cache: bypass' to skip the cache or 'refresh' to overwrite it.
+    """
+    if endpoint not in LLM_CACHE_ENDPOINTS:
+        return 'off'
+    header = request.headers.get('X-LLM-Cache', '').strip().lower()
+    if header in ('bypass', 'off', 'no-cache'):
+        return 'off'
+    if header == 'refresh':
+        return 'refresh'
+    return 'use'
+
+class LLMCache:
+    """Content-addressed cache of LLM completions.
+
+    Keys are sha256(model, max_tokens, prompt). A bounded in-memory LRU sits
+    in front of a SQLite file that every gunicorn worker shares. Entries
+    expire after ttl seconds; both tiers evict least recently used entries
+    once they exceed their byte budget.
+    """
+
+    def __init__(self, path, ttl, memory_bytes, disk_bytes):
+        self.path = path
+        self.ttl = ttl
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> (value, created)
+        self._memory_size = 0
+        self._local = threading.local()
+        self._puts = 0
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0,
+                       'writes': 0, 'evictions': 0, 'disk_errors': 0}
+
+    @staticmethod
+    def make_key(model, prompt, max_tokens):
+        digest = hashlib.sha256()
+        digest.update(f"{model}\0{max_tokens}\0".encode())
+        digest.update(prompt.encode('utf-8', 'surrogatepass'))
+        return digest.hexdigest()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_entries'] = len(self._memory)
+            stats['memory_bytes'] = self._memory_size
+            return stats
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute("""CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY, value TEXT NOT NULL,
+                created REAL NOT NULL, accessed REAL NOT NULL, size INTEGER NOT NULL)""")
+            db.execute('CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache(accessed)')
+            db.commit()
+            self._local.db = db
+        return db
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if now - entry[1] <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self._stats['memory_hits'] += 1
+                    return entry[0]
+                self._memory_pop(key)
 
-def parse_stage2_response(response):
-    """Parse Stage 2 response into evidence dict"""
-    clean = response.replace('```json', '').replace('```', '').strip()
-    start_idx = clean.find('{')
-    end_idx = clean.rfind('}') + 1
+        try:
+            db = self._db()
+            row = db.execute('SELECT value, created FROM llm_cache WHERE key = ?', (key,)).fetchone()
+            if row is not None and now - row[1] <= self.ttl:
+                db.execute('UPDATE llm_cache SET accessed = ? WHERE key = ?', (now, key))
+                db.commit()
+                self._memory_put(key, row[0], row[1])
+                self._count('disk_hits')
+                return row[0]
+        except sqlite3.Error as e:
+            print(f"[Cache] Disk read failed: {e}")
+            self._count('disk_errors')
+
+        self._count('misses')
+        return None
+
+    def put(self, key, value):
+        now = time.time()
+        self._memory_put(key, value, now)
+        try:
+            db = self._db()
+            db.execute('INSERT OR REPLACE INTO llm_cache (key, value, created, accessed, size) VALUES (?, ?, ?, ?, ?)',
+                       (key, value, now, now, len(value.encode())))
+            db.commit()
+            self._count('writes')
+            with self._lock:
+                self._puts += 1
+                sweep = self._puts % 50 == 1
+            if sweep:
+                self._evict_disk(db, now)
+        except sqlite3.Error as e:
+            print(f"[Cache] Disk write failed: {e}")
+            self._count('disk_errors')
+
+    def _memory_put(self, key, value, created):
+        size = len(value.encode())
+        with self._lock:
+            if key in self._memory:
+                self._memory_pop(key)
+            self._memory[key] = (value, created)
+            self._memory_size += size
+            while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+                self._memory_pop(next(iter(self._memory)))
+                self._stats['evictions'] += 1
+
+    def _memory_pop(self, key):
+        value, _ = self._memory.pop(key)
+        self._memory_size -= len(value.encode())
+
+    def _evict_disk(self, db, now):
+        """Drop expired rows, then least recently used rows over the byte budget"""
+        cur = db.execute('DELETE FROM llm_cache WHERE created < ?', (now - self.ttl,))
+        evicted = cur.rowcount
+        total = db.execute('SELECT COALESCE(SUM(size), 0) FROM llm_cache').fetchone()[0]
+        if total > self.disk_bytes:
+            excess = total - self.disk_bytes
+            for key, size in db.execute('SELECT key, size FROM llm_cache ORDER BY accessed').fetchall():
+                if excess <= 0:
+                    break
+                db.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+                excess -= size
+                evicted += 1
+        db.commit()
+        if evicted:
+            with self._lock:
+                self._stats['evictions'] += evicted
+
+llm_cache = LLMCache(LLM_CACHE_PATH, LLM_CACHE_TTL,
+                     int(LLM_CACHE_MEMORY_MB * 1024 * 1024), int(LLM_CACHE_DISK_MB * 1024 * 1024))
+
+# ============== Case Document Store ==============
+
+class CaseNotFound(Exception):
+    pass
+
+class CaseQuotaExceeded(Exception):
+    pass
+
+def document_hash(text):
+    return hashlib.sha256(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+class CaseStore:
+    """Case documents stored once, content-addressed by sha256 of their text.
+
+    A case maps document names to hashes; the texts live in a shared blob
+    table, so a document uploaded for two cases is stored once and a client
+    can attach it by hash without re-sending it. Everything is in a SQLite
+    file every gunicorn worker shares, with a per-process LRU of hot texts
+    in front (safe because content never changes under a hash). Cases
+    expire ttl seconds after last use; when the store exceeds its byte
+    budget the least recently used cases go first, then unreferenced texts.
+    """
+
+    def __init__(self, path, ttl, max_docs, max_doc_bytes, max_case_bytes, max_bytes, memory_bytes):
+        self.path = path
+        self.ttl = ttl
+        self.max_docs = max_docs
+        self.max_doc_bytes = max_doc_bytes
+        self.max_case_bytes = max_case_bytes
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # hash -> text
+        self._memory_size = 0
+        self._local = threading.local()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute("""CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY, text TEXT NOT NULL, size INTEGER NOT NULL)""")
+            db.execute("""CREATE TABLE IF NOT EXISTS cases (
+                id TEXT PRIMARY KEY, created REAL NOT NULL, accessed REAL NOT NULL)""")
+            db.execute("""CREATE TABLE IF NOT EXISTS case_documents (
+                case_id TEXT NOT NULL, name TEXT NOT NULL, hash TEXT NOT NULL, position INTEGER NOT NULL,
+                PRIMARY KEY (case_id, name))""")
+            db.execute('CREATE INDEX IF NOT EXISTS case_documents_hash ON case_documents(hash)')
+            db.execute('CREATE INDEX IF NOT EXISTS cases_accessed ON cases(accessed)')
+            self._local.db = db
+        return db
+
+    def put(self, case_id, documents, hashes):
+        """Store {name: text} documents and attach {name: hash} ones to a case (new if case_id is None).
+
+        Returns (case_id, {name: hash} stored, [names whose hash is unknown]).
+        """
+        blobs = {}
+        stored = {}
+        for name, text in documents.items():
+            size = len(text.encode('utf-8', 'surrogatepass'))
+            if size > self.max_doc_bytes:
+                raise CaseQuotaExceeded(f"{name} is larger than {self.max_doc_bytes // (1024 * 1024)} MB")
+            digest = document_hash(text)
+            blobs[digest] = (text, size)
+            stored[name] = digest
+
+        now = time.time()
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if case_id is None:
+                case_id = uuid.uuid4().hex
+                db.execute('INSERT INTO cases (id, created, accessed) VALUES (?, ?, ?)', (case_id, now, now))
+            elif not db.execute('UPDATE cases SET accessed = ? WHERE id = ? AND accessed >= ?',
+                                (now, case_id, now - self.ttl)).rowcount:
+                raise CaseNotFound(f"case {case_id} not found or expired")
+            self._evict(db, now, keep=case_id)
+
+            missing = []
+            for name, digest in hashes.items():
+                if name in stored:
+                    continue
+                if digest in blobs or db.execute('SELECT 1 FROM blobs WHERE hash = ?', (digest,)).fetchone():
+                    stored[name] = digest
+                else:
+                    missing.append(name)
+
+            for digest, (text, size) in blobs.items():
+                db.execute('INSERT OR IGNORE INTO blobs (hash, text, size) VALUES (?, ?, ?)', (digest, text, size))
+            position = db.execute('SELECT COALESCE(MAX(position), -1) + 1 FROM case_documents WHERE case_id = ?',
+                                  (case_id,)).fetchone()[0]
+            for name, digest in stored.items():
+                db.execute('DELETE FROM case_documents WHERE case_id = ? AND name = ?', (case_id, name))
+                db.execute('INSERT INTO case_documents (case_id, name, hash, position) VALUES (?, ?, ?, ?)',
+                           (case_id, name, digest, position))
+                position += 1
+
+            count, size = db.execute("""SELECT COUNT(*), COALESCE(SUM(b.size), 0) FROM case_documents d
+                JOIN blobs b ON b.hash = d.hash WHERE d.case_id = ?""", (case_id,)).fetchone()
+            if count > self.max_docs:
+                raise CaseQuotaExceeded(f"case has more than {self.max_docs} documents")
+            if size > self.max_case_bytes:
+                raise CaseQuotaExceeded(f"case is larger than {self.max_case_bytes // (1024 * 1024)} MB")
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+        for digest, (text, size) in blobs.items():
+            self._memory_put(digest, text)
+        return case_id, stored, missing
+
+    def documents(self, case_id):
+        """{name: text} of a case in upload order; refreshes its TTL"""
+        db = self._db()
+        now = time.time()
+        if not db.execute('UPDATE cases SET accessed = ? WHERE id = ? AND accessed >= ?',
+                          (now, case_id, now - self.ttl)).rowcount:
+            raise CaseNotFound(f"case {case_id} not found or expired")
+        rows = db.execute('SELECT name, hash FROM case_documents WHERE case_id = ? ORDER BY position',
+                          (case_id,)).fetchall()
+        return self.resolve(dict(rows))
+
+    def resolve(self, hashes):
+        """{name: text} for {name: hash}; every hash must be stored"""
+        texts = {}
+        with self._lock:
+            for digest in hashes.values():
+                if digest in self._memory:
+                    self._memory.move_to_end(digest)
+                    texts[digest] = self._memory[digest]
+        wanted = [d for d in set(hashes.values()) if d not in texts]
+        if wanted:
+            db = self._db()
+            for i in range(0, len(wanted), 500):
+                batch = wanted[i:i + 500]
+                rows = db.execute(f"SELECT hash, text FROM blobs WHERE hash IN ({','.join('?' * len(batch))})",
+                                  batch).fetchall()
+                for digest, text in rows:
+                    texts[digest] = text
+                    self._memory_put(digest, text)
+        missing = [name for name, digest in hashes.items() if digest not in texts]
+        if missing:
+            raise CaseNotFound(f"documents not stored: {', '.join(missing)}")
+        return {name: texts[digest] for name, digest in hashes.items()}
+
+    def describe(self, case_id):
+        db = self._db()
+        row = db.execute('SELECT accessed FROM cases WHERE id = ?', (case_id,)).fetchone()
+        if row is None or row[0] < time.time() - self.ttl:
+            raise CaseNotFound(f"case {case_id} not found or expired")
+        rows = db.execute("""SELECT d.name, d.hash, b.size FROM case_documents d JOIN blobs b ON b.hash = d.hash
+            WHERE d.case_id = ? ORDER BY d.position""", (case_id,)).fetchall()
+        return {name: {'hash': digest, 'size': size} for name, digest, size in rows}
+
+    def delete(self, case_id):
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM cases WHERE id = ?', (case_id,))
+            db.execute('DELETE FROM case_documents WHERE case_id = ?', (case_id,))
+            self._drop_orphans(db)
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def _evict(self, db, now, keep=None):
+        """Drop expired cases, then least recently used ones while over the byte budget"""
+        expired = [row[0] for row in db.execute('SELECT id FROM cases WHERE accessed < ?', (now - self.ttl,))]
+        total = db.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+        if total > self.max_bytes:
+            for (case_id,) in db.execute('SELECT id FROM cases WHERE accessed >= ? AND id != ? ORDER BY accessed',
+                                         (now - self.ttl, keep)).fetchall():
+                expired.append(case_id)
+                total -= db.execute("""SELECT COALESCE(SUM(size), 0) FROM blobs WHERE hash IN (
+                    SELECT hash FROM case_documents WHERE case_id = ?) AND hash NOT IN (
+                    SELECT hash FROM case_documents WHERE case_id != ?)""", (case_id, case_id)).fetchone()[0]
+                if total <= self.max_bytes:
+                    break
+        if not expired:
+            return
+        for case_id in expired:
+            db.execute('DELETE FROM cases WHERE id = ?', (case_id,))
+            db.execute('DELETE FROM case_documents WHERE case_id = ?', (case_id,))
+        self._drop_orphans(db)
+        print(f"[Cases] Evicted {len(expired)} cases")
+
+    def _drop_orphans(self, db):
+        db.execute('DELETE FROM blobs WHERE hash NOT IN (SELECT hash FROM case_documents)')
+
+    def _memory_put(self, digest, text):
+        size = len(text)
+        if size > self.memory_bytes:
+            return
+        with self._lock:
+            if digest in self._memory:
+                self._memory.move_to_end(digest)
+                return
+            self._memory[digest] = text
+            self._memory_size += size
+            while self._memory_size > self.memory_bytes:
+                _, old = self._memory.popitem(last=False)
+                self._memory_size -= len(old)
+
+case_store = CaseStore(CASE_DB_PATH, CASE_TTL, CASE_MAX_DOCS, int(CASE_MAX_DOC_MB * 1024 * 1024),
+                       int(CASE_MAX_MB * 1024 * 1024), int(CASE_STORE_MAX_MB * 1024 * 1024),
+                       int(CASE_MEMORY_MB * 1024 * 1024))
+
+# ============== Background Jobs ==============
+
+class JobQueueFull(Exception):
+    pass
+
+class JobQueue:
+    """Runs pipeline handlers on a background thread pool.
+
+    Job state and results live in a SQLite file, so any gunicorn worker can
+    answer status and result polls for a job submitted to another worker.
+    Each process bounds its own queue depth; unfinished jobs expire after
+    JOB_TIMEOUT and finished results are dropped after JOB_RESULT_TTL.
+    """
+
+    def __init__(self, path, workers, max_pending, timeout, result_ttl):
+        self.path = path
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._local = threading.local()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL,
+                created REAL NOT NULL, started REAL, finished REAL, result TEXT, error TEXT)""")
+            db.commit()
+            self._local.db = db
+        return db
+
+    def submit(self, kind, payload, headers=None):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise JobQueueFull(f'Job queue full ({self.max_pending} pending), try again shortly')
+            self._pending += 1
+
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        db = self._db()
+        db.execute('DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?', (now - self.result_ttl,))
+        db.execute('DELETE FROM jobs WHERE finished IS NULL AND created < ?', (now - self.timeout - self.result_ttl,))
+        db.execute('INSERT INTO jobs (id, kind, status, created) VALUES (?, ?, ?, ?)', (job_id, kind, 'queued', now))
+        db.commit()
 
-    if start_idx >= 0 and end_idx > start_idx:
         try:
-            data = json.loads(clean[start_idx:end_idx])
-            for crit in data:
-                if 'supporting' in data[crit]:
-                    data[crit]['supporting'] = list(dict.fromkeys(data[crit]['supporting']))
-                if 'contradicting' in data[crit]:
-                    data[crit]['contradicting'] = list(dict.fromkeys(data[crit]['contradicting']))
-            return data
-        except json.JSONDecodeError:
+            self._executor.submit(self._run, job_id, kind, payload, headers or {})
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+        return job_id
+
+    def _run(self, job_id, kind, payload, headers):
+        db = self._db()
+        try:
+            created = db.execute('SELECT created FROM jobs WHERE id = ?', (job_id,)).fetchone()[0]
+            if time.time() - created > self.timeout:
+                self._finish(job_id, 'expired', error='Job expired before it started')
+                return
+
+            db.execute('UPDATE jobs SET status = ?, started = ? WHERE id = ?', ('running', time.time(), job_id))
+            db.commit()
+
+            # Run the existing view function against a synthetic request
+            with app.test_request_context(f'/api/{kind}', method='POST', json=payload, headers=headers):
+                response = app.make_response(JOB_HANDLERS[kind]())
+            result = response.get_json()
+            status = 'done' if result.get('success') else 'failed'
+            self._finish(job_id, status, result=result, error=result.get('error'))
+            print(f"[Jobs] {kind} job {job_id} {status}")
+        except Exception as e:
+            print(f"[Jobs] {kind} job {job_id} crashed: {e}")
+            self._finish(job_id, 'failed', error=str(e))
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def _finish(self, job_id, status, result=None, error=None):
+        db = self._db()
+        db.execute('UPDATE jobs SET status = ?, finished = ?, result = ?, error = ? WHERE id = ?',
+                   (status, time.time(), json.dumps(result) if result is not None else None, error, job_id))
+        db.commit()
+
+    def get(self, job_id, wait=0):
+        """Fetch a job, polling the store for up to wait seconds until it finishes"""
+        deadline = time.time() + wait
+        db = self._db()
+        while True:
+            row = db.execute('SELECT kind, status, created, started, finished, result, error FROM jobs WHERE id = ?',
+                             (job_id,)).fetchone()
+            if row is None:
+                return None
+            kind, status, created, started, finished, result, error = row
+            if status in ('queued', 'running') and time.time() - created > self.timeout:
+                status, error = 'expired', 'Job did not finish in time'
+            if status not in ('queued', 'running') or time.time() >= deadline:
+                break
+            time.sleep(0.25)
+
+        job = {'jobId': job_id, 'kind': kind, 'status': status,
+               'queuedFor': (started or time.time()) - created}
+        if finished:
+            job['runTime'] = finished - (started or created)
+        if error:
+            job['error'] = error
+        if result is not None and status in ('done', 'failed'):
+            job['result'] = json.loads(result)
+        return job
+
+JOB_HANDLERS = {
+    'extract_twostage': handle_extract_twostage,
+    'extract-functional': handle_extract_functional,
+    'generate-report': handle_generate_report,
+}
+
+job_queue = JobQueue(JOB_DB_PATH, JOB_WORKERS, JOB_MAX_PENDING, JOB_TIMEOUT, JOB_RESULT_TTL)
+
+# ============== Document Text Extraction ==============
+
+_W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+def extract_docx_text(data):
+    """Plain text of a .docx, paragraphs separated by blank lines like mammoth's extractRawText.
+
+    word/document.xml is decompressed and fed to an incremental XML parser
+    64 KB at a time, and each paragraph is cleared once read, so memory
+    stays flat however long the report is.
+    """
+    paragraphs = []
+    runs = []
+    parser = ET.XMLPullParser(events=('end',))
+    total = 0
+    with zipfile.ZipFile(io.BytesIO(data)) as docx, docx.open('word/document.xml') as xml:
+        while True:
+            piece = xml.read(65536)
+            if not piece:
+                break
+            total += len(piece)
+            if total > EXTRACT_MAX_XML_BYTES:
+                raise ValueError('document.xml is too large')
+            parser.feed(piece)
+            for _, elem in parser.read_events():
+                if elem.tag == _W + 't':
+                    runs.append(elem.text or '')
+                elif elem.tag == _W + 'tab':
+                    runs.append('\t')
+                elif elem.tag in (_W + 'br', _W + 'cr'):
+                    runs.append('\n')
+                elif elem.tag == _W + 'p':
+                    paragraphs.append(''.join(runs))
+                    runs = []
+                    elem.clear()
+    parser.close()
+    return '\n\n'.join(paragraphs)
+
+def extract_pdf_text(data):
+    """Plain text of a PDF, one line per page like the browser's pdf.js parser"""
+    reader = PdfReader(io.BytesIO(data))
+    return '\n'.join(page.extract_text() or '' for page in reader.pages)
+
+def extract_document_text(filename, data):
+    """Runs in the extraction process pool: plain text of one uploaded file"""
+    lower = filename.lower()
+    if lower.endswith('.docx'):
+        return extract_docx_text(data)
+    if lower.endswith('.pdf'):
+        return extract_pdf_text(data)
+    if lower.endswith('.txt'):
+        return data.decode('utf-8', errors='replace')
+    raise ValueError(f"unsupported file type: {filename}")
+
+_extract_pool = None
+_extract_pool_lock = threading.Lock()
+
+def get_extract_pool():
+    """Process pool for text extraction, started on first use in each worker.
+
+    Processes come from a forkserver (spawn where there is none) rather
+    than forking this multi-threaded worker, whose locks another thread
+    may hold at the moment of the fork.
+    """
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _extract_pool = ProcessPoolExecutor(max_workers=EXTRACT_PROCESSES,
+                                                mp_context=multiprocessing.get_context(method))
+        return _extract_pool
+
+def reset_extract_pool(pool):
+    """Drop a pool whose process died so the next request starts a fresh one"""
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is pool:
+            _extract_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+# ============== Static Asset Pipeline ==============
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+_DATA_URI_RE = re.compile(r'data:(image/[\w.+-]+);base64,([A-Za-z0-9+/=]+)')
+
+class StaticAssets:
+    """Fingerprinted, precompressed static files served from memory.
+
+    At startup the index page's inline base64 images are written out as
+    content-addressed files served at /assets/ and the page is rewritten to
+    point at them. Text assets then get brotli and gzip variants (gzip only
+    if the brotli module is missing), kept only if they are meaningfully smaller, and
+    every asset gets a content-hash ETag. Fingerprinted files are cached as immutable;
+    everything else must revalidate, which is a 304 when unchanged.
+    Extracted files and compressed variants are also written to out_dir,
+    so later workers and restarts reuse them instead of recompressing.
+    """
+
+    ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+    def __init__(self, base_dir, out_dir, index_name):
+        self.base_dir = base_dir
+        self.out_dir = out_dir
+        self._assets = {}  # url path -> {'type', 'etag', 'immutable', 'variants'}
+        start = time.time()
+        for filename in sorted(os.listdir(base_dir)):
+            path = os.path.join(base_dir, filename)
+            if filename.lower().endswith(ASSET_EXTENSIONS) and not filename.startswith('.') and os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    body = f.read()
+                if filename == index_name:
+                    body = _DATA_URI_RE.sub(self._extract_image, body.decode('utf-8')).encode('utf-8')
+                self._add(filename, body)
+        sizes = {enc: sum(len(a['variants'].get(enc, a['variants']['identity'])) for a in self._assets.values())
+                 for enc in ('identity',) + self.ENCODINGS}
+        print(f"[Assets] {len(self._assets)} assets in {time.time() - start:.1f}s, bytes: {sizes}")
+
+    def has(self, path):
+        return path in self._assets
+
+    def _extract_image(self, match):
+        body = base64.b64decode(match.group(2))
+        ext = mimetypes.guess_extension(match.group(1)) or ''
+        filename = f"{hashlib.sha256(body).hexdigest()[:16]}{ext}"
+        self._write(filename, body)
+        self._add('assets/' + filename, body, immutable=True)
+        return '/assets/' + filename
+
+    def _add(self, path, body, immutable=False):
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if content_type.startswith('text/'):
+            content_type += '; charset=utf-8'
+        digest = hashlib.sha256(body).hexdigest()[:16]
+        variants = {'identity': body}
+        # PNG/JPEG/WebP are already compressed; only text-like types are worth it
+        for encoding in self.ENCODINGS if self._compressible(content_type) else ():
+            compressed = self._compress(digest, encoding, body)
+            if len(compressed) < len(body) * 0.9:
+                variants[encoding] = compressed
+        self._assets[path] = {'type': content_type, 'etag': digest,
+                              'immutable': immutable, 'variants': variants}
+
+    @staticmethod
+    def _compressible(content_type):
+        return not content_type.startswith('image/') or content_type.startswith('image/svg')
+
+    def _compress(self, digest, encoding, body):
+        name = f"compressed/{digest}.{encoding}"
+        try:
+            with open(os.path.join(self.out_dir, name), 'rb') as f:
+                return f.read()
+        except OSError:
             pass
+        if encoding == 'br':
+            compressed = brotli.compress(body, quality=11)
+        else:
+            compressed = gzip.compress(body, compresslevel=9, mtime=0)
+        self._write(name, compressed)
+        return compressed
+
+    def _write(self, name, body):
+        """Write atomically; the pipeline still works from memory if this fails"""
+        path = os.path.join(self.out_dir, name)
+        if os.path.exists(path):
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(body)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[Assets] Could not write {name}: {e}")
+
+    def response(self, path):
+        """Serve an asset, negotiating Content-Encoding and answering conditional requests"""
+        asset = self._assets[path]
+        variants = asset['variants']
+        encoding, best = 'identity', 0
+        for candidate in self.ENCODINGS:
+            q = request.accept_encodings[candidate]
+            if candidate in variants and q > best:
+                encoding, best = candidate, q
+
+        etag = asset['etag'] if encoding == 'identity' else f"{asset['etag']}-{encoding}"
+        headers = {
+            'ETag': f'"{etag}"',
+            'Vary': 'Accept-Encoding',
+            'Cache-Control': (f'public, max-age={ASSET_MAX_AGE}, immutable' if asset['immutable']
+                              else 'no-cache')
+        }
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers=headers)
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return Response(variants[encoding], content_type=asset['type'], headers=headers)
 
-    return {}
+static_assets = StaticAssets(BASE_DIR, ASSET_DIR, 'asd_workflow_aurum.html')
 
 # ============== Main ==============
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['benchmark-classifier']:
+        # python app.py benchmark-classifier labels.jsonl (a STAGE2_LABEL_LOG file)
+        with open(sys.argv[2], encoding='utf-8') as f:
+            labels = [json.loads(line) for line in f if line.strip()]
+        print(json.dumps(benchmark_classifier(labels), indent=2))
+        sys.exit(0)
+
     port = int(os.environ.get('PORT', 8080))
 
     print("=" * 60)
@@ -0,0 +1,190 @@
+"""Check parse_llm_json against the fix_json_quotes + json.loads it replaced.
+
+    python bench/json_repair.py check      # golden corpus (bench/json_repair_corpus.jsonl)
+    python bench/json_repair.py fuzz [N]   # N random inputs per generator, compared live
+    python bench/json_repair.py scaling    # old vs new timings as the input doubles
+    python bench/json_repair.py corpus     # rewrite the golden corpus from the baseline
+
+Two parsers agree on an input when they return equal objects or both
+raise json.JSONDecodeError.
+"""
+import gc
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import parse_llm_json  # noqa: E402
+from json_repair_baseline import baseline_parse  # noqa: E402
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'json_repair_corpus.jsonl')
+
+KEYS = ['A1', 'A2', 'A3', 'B1', 'B2', 'B3', 'B4', 'C', 'D', 'E']
+WORDS = ['child', 'does', 'not', 'make', 'eye', 'contact', 'lines', 'up', 'toys', 'routine',
+         'teacher', 'reports', 'peers', 'plays', 'alone', 'upset', 'when', 'changes', 'occur']
+
+# Hand-written cases for each repair; the corpus adds generated ones
+CASES = [
+    '{"A1": ["He does not make eye contact"]}',
+    '{"A1": [""He does not make eye contact""]}',
+    '{"A1": ["\\"He does not make eye contact\\""]}',
+    '{"A1": ["“He does not make eye contact”"]}',
+    '{"A1": ["first quote", second part, "third"]}',
+    '{"A1": ["ends with a colon:", bare words]}',
+    '{"A1": [bare first, "quoted"]}',
+    '{"A1": ["unterminated array", "still going"',
+    '{"A1": ["a"], "B2": ["b", "c"], "E": []}',
+    '{"A1": ["a",, "b"]}',
+    '{"A1": ["   extra    inner   spaces   "]}',
+    '{"A1": ["nested [brackets] inside"]}',
+    '{"A1": ["escaped \\\\ backslash"]}',
+    '{A1: ["bare key"], B1: ["another"]}',
+    '{"A1": [""""quadruple""""]}',
+    '{"A1": ["\\"escaped wrapper without closer"]}',
+    '{"summary": "no arrays here"}',
+    '{"summary": ""doubled value""}',
+    '{"summary": "\\"escaped value\\""}',
+    '{"A1": "not an array"}',
+    '{}',
+    '',
+    'not json at all',
+    '{"A1": [}',
+    '{"A1" "x"}',
+    '{:}',
+]
+
+def outcome(parse, text):
+    try:
+        return 'ok', parse(text)
+    except json.JSONDecodeError:
+        return 'error', 'JSONDecodeError'
+
+def random_chars(rng):
+    """Character-level noise over the characters the repair cares about"""
+    alphabet = '{}[]",:\\ \n' + 'abcAB1' + '“”'
+    body = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 40)))
+    return rng.choice(['', '{', '{"A1": [', '{A1: [']) + body
+
+def random_item(rng):
+    text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 8)))
+    wrap = rng.choice(['plain', 'plain', 'doubled', 'escaped', 'smart', 'bare', 'colon', 'open'])
+    if wrap == 'doubled':
+        return f'""{text}""'
+    if wrap == 'escaped':
+        return f'"\\"{text}\\""'
+    if wrap == 'smart':
+        return f'"“{text}”"'
+    if wrap == 'bare':
+        return text
+    if wrap == 'colon':
+        return f'"{text}:"'
+    if wrap == 'open':
+        return f'"\\"{text}'
+    return f'"{text}"'
+
+def random_output(rng):
+    """Model-shaped output: key arrays with mixed item wrappers, sometimes cut off"""
+    keys = rng.sample(KEYS, rng.randint(1, 5))
+    quote_key = rng.random() < 0.9
+    fields = []
+    for key in keys:
+        items = [random_item(rng) for _ in range(rng.randint(0, 5))]
+        sep = rng.choice([', ', ',', ',\n  ', ',, '])
+        name = f'"{key}"' if quote_key else key
+        fields.append(f'{name}: [{sep.join(items)}]')
+    text = '{' + ', '.join(fields) + '}'
+    if rng.random() < 0.2:
+        text = text[:rng.randint(1, len(text))]
+    return text
+
+GENERATORS = {'chars': random_chars, 'outputs': random_output}
+
+def check():
+    failures = 0
+    with open(CORPUS_PATH, encoding='utf-8') as f:
+        cases = [json.loads(line) for line in f if line.strip()]
+    for case in cases:
+        expected = ('error', case['error']) if 'error' in case else ('ok', case['expected'])
+        got = outcome(parse_llm_json, case['input'])
+        if got != expected:
+            failures += 1
+            print(f"MISMATCH {case['input']!r}\n  expected {expected}\n  got      {got}")
+    print(f"{len(cases) - failures}/{len(cases)} corpus cases match")
+    return failures
+
+def fuzz(count):
+    failures = 0
+    for name, generate in GENERATORS.items():
+        rng = random.Random(name)
+        for _ in range(count):
+            text = generate(rng)
+            old, new = outcome(baseline_parse, text), outcome(parse_llm_json, text)
+            if old != new:
+                failures += 1
+                if failures <= 10:
+                    print(f"MISMATCH {text!r}\n  baseline {old}\n  new      {new}")
+        print(f"{name}: {count} inputs compared")
+    print(f"{failures} mismatches")
+    return failures
+
+def write_corpus():
+    rng = random.Random(0)
+    inputs = CASES + [random_output(rng) for _ in range(200)] + [random_chars(rng) for _ in range(100)]
+    with open(CORPUS_PATH, 'w', encoding='utf-8') as f:
+        for text in dict.fromkeys(inputs):
+            kind, value = outcome(baseline_parse, text)
+            case = {'input': text, 'expected': value} if kind == 'ok' else {'input': text, 'error': value}
+            f.write(json.dumps(case, ensure_ascii=False) + '\n')
+    print(f"wrote {CORPUS_PATH}")
+    return 0
+
+SHAPES = {
+    'items': lambda n: '{"A1": [' + ', '.join(f'"quote number {i}"' for i in range(n)) + ']}',
+    'doubled': lambda n: '{"A1": [' + ', '.join(f'""quote number {i}""' for i in range(n)) + ']}',
+    'bare': lambda n: '{"A1": ["first", ' + ', '.join(f'bare {i}' for i in range(n)) + ']}',
+    'unclosed escapes': lambda n: '{"A1": [' + ', '.join(f'"\\"quote number {i}' for i in range(n)) + ']}',
+}
+
+def best_time(parse, text, repeat=3):
+    best = float('inf')
+    gc.disable()  # as timeit does, so collections don't land in one size's timing
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            try:
+                parse(text)
+            except json.JSONDecodeError:
+                pass
+            best = min(best, time.perf_counter() - start)
+    finally:
+        gc.enable()
+    return best
+
+def scaling():
+    sizes = [1000, 2000, 4000, 8000]
+    print(f"{'shape':<18}{'items':>7}{'baseline ms':>13}{'new ms':>9}{'x base':>8}{'x new':>7}")
+    for shape, build in SHAPES.items():
+        previous = None
+        for n in sizes:
+            text = build(n)
+            old, new = best_time(baseline_parse, text), best_time(parse_llm_json, text)
+            growth = f"{old / previous[0]:>8.1f}{new / previous[1]:>7.1f}" if previous else ''
+            print(f"{shape:<18}{n:>7}{old * 1000:>13.1f}{new * 1000:>9.1f}{growth}")
+            previous = (old, new)
+    print("x base / x new: time growth when the input doubles (2.0 is linear, 4.0 quadratic)")
+    return 0
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'check'
+    if command == 'check':
+        sys.exit(1 if check() else 0)
+    if command == 'fuzz':
+        sys.exit(1 if fuzz(int(sys.argv[2]) if len(sys.argv) > 2 else 20000) else 0)
+    if command == 'scaling':
+        sys.exit(scaling())
+    if command == 'corpus':
+        sys.exit(write_corpus())
+    sys.exit(__doc__)
@@ -0,0 +1,156 @@
+"""The fix_json_quotes + json.loads repair that parse_llm_json replaced.
+
+Kept verbatim from the original app.py (f5d792f) as the reference
+that bench/json_repair.py compares parse_llm_json against.
+"""
+import json
+import re
+
+def fix_json_quotes(json_str):
+    """Leniently repair malformed JSON output from an LLM"""
+    s = (json_str or "").strip()
+
+    # Quick normalizations
+    prev = None
+    while prev != s:
+        prev = s
+        s = re.sub(r'""([^"]*?)""', r'"\1"', s)
+
+    prev = None
+    while prev != s:
+        prev = s
+        s = re.sub(r'"\\\"(.*?)\\\""', r'"\1"', s)
+
+    def strip_outer_quotes(token):
+        t = token.strip()
+        if len(t) >= 2 and t[0] == '"' and t[-1] == '"':
+            t = t[1:-1]
+        if len(t) >= 2 and t[0] in '""' and t[-1] in '""':
+            t = t[1:-1]
+        return t.strip()
+
+    def unescape_model_wrappers(t):
+        t = t.strip()
+        t = strip_outer_quotes(t)
+        t = re.sub(r'^\\"(.*)\\"$', r'\1', t)
+        t = re.sub(r'^"+(.*)"+$', r'\1', t)
+        return t.strip()
+
+    result = {}
+    key_iter = list(re.finditer(r'"([^"]+)"\s*:\s*\[', s))
+    if not key_iter:
+        key_iter = list(re.finditer(r'([A-Za-z][A-Za-z0-9_]*)\s*:\s*\[', s))
+
+    n = len(s)
+
+    def find_matching_bracket(start_idx):
+        depth = 0
+        in_str = False
+        esc = False
+        i = start_idx
+        while i < n:
+            ch = s[i]
+            if in_str:
+                if esc:
+                    esc = False
+                elif ch == '\\':
+                    esc = True
+                elif ch == '"':
+                    in_str = False
+            else:
+                if ch == '"':
+                    in_str = True
+                elif ch == '[':
+                    depth += 1
+                elif ch == ']':
+                    depth -= 1
+                    if depth == 0:
+                        return i
+            i += 1
+        return -1
+
+    def split_array_items(array_body):
+        items = []
+        buf = []
+        in_str = False
+        esc = False
+        for ch in array_body:
+            if in_str:
+                buf.append(ch)
+                if esc:
+                    esc = False
+                elif ch == '\\':
+                    esc = True
+                elif ch == '"':
+                    in_str = False
+            else:
+                if ch == '"':
+                    in_str = True
+                    buf.append(ch)
+                elif ch == ',':
+                    token = "".join(buf).strip()
+                    items.append(token)
+                    buf = []
+                else:
+                    buf.append(ch)
+        token = "".join(buf).strip()
+        if token:
+            items.append(token)
+        return items
+
+    for m in key_iter:
+        key = m.group(1)
+        bracket_start = m.end() - 1
+        if bracket_start < 0 or bracket_start >= n or s[bracket_start] != '[':
+            continue
+
+        bracket_end = find_matching_bracket(bracket_start)
+        if bracket_end == -1:
+            bracket_end = n - 1
+
+        body = s[bracket_start + 1: bracket_end]
+        raw_tokens = split_array_items(body)
+
+        cleaned_items = []
+        for tok in raw_tokens:
+            t = tok.strip()
+            if not t:
+                continue
+
+            t = re.sub(r'^[\s\]]+', '', t)
+            t = re.sub(r'[\s\[]+$', '', t).strip()
+
+            if t.startswith('"') or t.endswith('"') or t.startswith('"') or t.endswith('"'):
+                t2 = unescape_model_wrappers(t)
+                if t2:
+                    cleaned_items.append(t2)
+                continue
+
+            bare = unescape_model_wrappers(t)
+            if bare:
+                if cleaned_items:
+                    if cleaned_items[-1].endswith((',', ';', ':')):
+                        cleaned_items[-1] = cleaned_items[-1] + " " + bare
+                    else:
+                        cleaned_items[-1] = cleaned_items[-1] + ", " + bare
+                else:
+                    cleaned_items.append(bare)
+
+        final_items = []
+        for it in cleaned_items:
+            x = re.sub(r'\s+', ' ', it).strip()
+            x = x.replace('\u201c', '"').replace('\u201d', '"')
+            final_items.append(x)
+
+        result[key] = final_items
+
+    if not result:
+        s = re.sub(r'""([^"]*?)""', r'"\1"', s)
+        s = re.sub(r'"\\\"(.*?)\\\""', r'"\1"', s)
+        return s
+
+    return json.dumps(result, ensure_ascii=False)
+
+def baseline_parse(text):
+    """What the extract handlers did before parse_llm_json"""
+    return json.loads(fix_json_quotes(text))
@@ -0,0 +1,104 @@
+"""Check KeywordMatcher against the any(kw in text) loops it replaced in prescan.
+
+    python bench/keyword_matching.py check [N]   # N random texts: labels and hit positions
+    python bench/keyword_matching.py scaling     # timings as documents grow and multiply
+
+scan() must report a label exactly when any of its keywords is a
+substring of the text, with every occurrence of every keyword as a hit.
+"""
+import gc
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import PRESCAN_NAME_MATCHER, PRESCAN_TEXT_MATCHER  # noqa: E402
+
+MATCHERS = {'name': PRESCAN_NAME_MATCHER, 'text': PRESCAN_TEXT_MATCHER}
+FILLER = ['the', 'child', 'was', 'seen', 'at', 'clinic', 'mother', 'reports', 'sleep', 'is', 'settled',
+          'plays', 'with', 'blocks', 'and', 'trains', 'no', 'family', 'history', 'noted', 'review', 'in']
+
+def any_loops(groups, text):
+    """The previous prescan check: one substring scan per keyword"""
+    return {label for label, keywords in groups.items() if any(kw in text for kw in keywords)}
+
+def all_occurrences(groups, text):
+    """Every (position, keyword) per label, found by repeated str.find"""
+    hits = {}
+    for label, keywords in groups.items():
+        for kw in keywords:
+            pos = text.find(kw)
+            while pos >= 0:
+                hits.setdefault(label, []).append((pos, kw))
+                pos = text.find(kw, pos + 1)
+    return {label: sorted(positions) for label, positions in hits.items()}
+
+def random_text(rng, matcher, words):
+    """Filler words with keywords and keyword fragments mixed in, sometimes run together"""
+    keywords = [kw for kws in matcher.groups.values() for kw in kws]
+    parts = []
+    for _ in range(words):
+        roll = rng.random()
+        if roll < 0.15:
+            parts.append(rng.choice(keywords))
+        elif roll < 0.25:
+            kw = rng.choice(keywords)
+            parts.append(kw[:rng.randint(1, len(kw))])
+        else:
+            parts.append(rng.choice(FILLER))
+    return ''.join(rng.choice([' ', ' ', ' ', '', '-', '\n']) + part for part in parts)
+
+def check(count):
+    failures = 0
+    for name, matcher in MATCHERS.items():
+        rng = random.Random(name)
+        for _ in range(count):
+            text = random_text(rng, matcher, rng.randint(0, 60))
+            hits = matcher.scan(text)
+            if set(hits) != any_loops(matcher.groups, text) or hits != all_occurrences(matcher.groups, text):
+                failures += 1
+                if failures <= 10:
+                    print(f"MISMATCH {name} {text!r}\n  scan {hits}\n  find {all_occurrences(matcher.groups, text)}")
+        print(f"{name}: {count} texts compared")
+    print(f"{failures} mismatches")
+    return failures
+
+def best_time(func, repeat=3):
+    best = float('inf')
+    gc.disable()  # as timeit does
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - start)
+    finally:
+        gc.enable()
+    return best
+
+def scaling():
+    rng = random.Random(0)
+    matcher = PRESCAN_TEXT_MATCHER
+    # Keywords every few words, and plain filler where any() has to scan every keyword to the end
+    docs = {'keywords': random_text(rng, matcher, 7000)[:40_000],
+            'no hits': ' '.join(rng.choice(FILLER) for _ in range(10_000))[:40_000]}
+    print(f"{'text':<10}{'input':<18}{'scan ms':>9}{'any() ms':>10}{'hits/doc':>10}")
+    for kind, doc in docs.items():
+        cases = [('1 doc x 40 KB', [doc]), ('1 doc x 400 KB', [doc * 10]), ('1 doc x 4 MB', [doc * 100]),
+                 ('10 docs x 40 KB', [doc] * 10), ('100 docs x 40 KB', [doc] * 100)]
+        for label, texts in cases:
+            scan = best_time(lambda: [matcher.scan(text) for text in texts])
+            loops = best_time(lambda: [any_loops(matcher.groups, text) for text in texts])
+            hits = sum(len(positions) for positions in matcher.scan(texts[0]).values())
+            print(f"{kind:<10}{label:<18}{scan * 1000:>9.1f}{loops * 1000:>10.1f}{hits:>10}")
+    print("scan finds every hit position in one pass; any() stops at the first hit per label")
+    return 0
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'check'
+    if command == 'check':
+        sys.exit(1 if check(int(sys.argv[2]) if len(sys.argv) > 2 else 3000) else 0)
+    if command == 'scaling':
+        sys.exit(scaling())
+    sys.exit(__doc__)